@@ -7,6 +7,7 @@
 #
 ##############################################################################
 
+from Acquisition import aq_base
 from zope.component import adapts
 from zope.interface import implements
 
@@ -22,6 +23,7 @@ from Products.Zuul.utils import ZuulMessageFactory as _t
 
 from . import CLASS_NAME, MODULE_NAME
 from .HBaseComponent import HBaseComponent
+from .HBaseTable import table_batch
 from .utils import updateToMany, updateToOne
 
 
@@ -34,6 +36,9 @@ class HBaseHRegion(HBaseComponent):
     region_hash = None
     memstore_flush_size = None
     max_file_size = None
+    # Path of the performance data of a region modeled with the old id,
+    # which could not be moved when the ZenPack was upgraded.
+    _rrd_path = None
 
     _properties = HBaseComponent._properties + (
         {'id': 'table', 'type': 'string'},
@@ -45,14 +50,82 @@ class HBaseHRegion(HBaseComponent):
     )
 
     _relations = HBaseComponent._relations + (
-        # ('table', ToOne(ToManyCont, MODULE_NAME['HBaseHRegion'], 'regions')),
         ('server', ToOne(ToManyCont, MODULE_NAME['HBaseHRegion'], 'regions')),
+        ('hbase_table', ToOne(ToMany, MODULE_NAME['HBaseTable'], 'regions')),
     )
 
     def device(self):
         # return self.table().device()
         return self.server().device()
 
+    def manage_afterAdd(self, item, container):
+        super(HBaseHRegion, self).manage_afterAdd(item, container)
+        # Not updated region by region when the region server or the
+        # device is added with the region.
+        if aq_base(item) is not aq_base(self):
+            return
+        server = self.server()
+        server.region_changed(self.id, True)
+        # Only the stored index is updated, as building it would walk
+        # all the region servers.
+        index = getattr(aq_base(self.device()), '_hbase_region_index', None)
+        if index is not None:
+            index[self.id] = server.id
+
+    def manage_beforeDelete(self, item, container):
+        if aq_base(item) is aq_base(self):
+            server = self.server()
+            server.region_changed(self.id, False)
+            index = getattr(
+                aq_base(self.device()), '_hbase_region_index', None)
+            if index is not None and index.get(self.id) == server.id:
+                del index[self.id]
+        super(HBaseHRegion, self).manage_beforeDelete(item, container)
+
+    def getTableId(self):
+        """
+        Return the id of the related table.
+        """
+        if not hasattr(aq_base(self), 'hbase_table'):
+            return None
+        table = self.hbase_table()
+        return table.id if table else None
+
+    def setTableId(self, table_id, batch=None):
+        """
+        Relate the region to the table with the given id on the same
+        device. The region is left unrelated if the table is not modeled
+        yet, and is related when the region is modeled next time.
+
+        @param table_id: id of the table
+        @type table_id: str
+        @param batch: batch of the relations to the tables of the device
+            to queue the update to, which the caller applies. If omitted,
+            the update is applied at once.
+        @type batch: RelationshipBatch
+        """
+        # Components modeled before the relationship was added.
+        if not hasattr(aq_base(self), 'hbase_table'):
+            self.buildRelations()
+        if batch is not None:
+            batch.to_one(self.hbase_table, table_id)
+            return
+        batch = table_batch(self.device())
+        batch.to_one(self.hbase_table, table_id)
+        # Invalidates the impact edges cached for the device.
+        if batch.apply():
+            self.device().setLastChange()
+
+    def rrdPath(self):
+        """
+        Return the path of the region performance data, which does not
+        depend on the region server, so the data survives the region moves.
+        """
+        if self._rrd_path:
+            return self._rrd_path
+        return 'Devices/{0}/hbase_regions/{1}'.format(
+            self.device().id, self.id)
+
 
 class IHBaseHRegionInfo(IComponentInfo):
     '''
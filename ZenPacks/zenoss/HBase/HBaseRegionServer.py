@@ -7,6 +7,7 @@
 #
 ##############################################################################
 
+from Acquisition import aq_base
 from zope.component import adapts
 from zope.interface import implements
 
@@ -22,6 +23,7 @@ from Products.Zuul.utils import ZuulMessageFactory as _t
 
 from . import CLASS_NAME, MODULE_NAME
 from .HBaseComponent import HBaseComponent
+from .utils import region_digest
 
 
 class HBaseRegionServer(HBaseComponent):
@@ -36,6 +38,8 @@ class HBaseRegionServer(HBaseComponent):
     logflush_interval = None
     # remodel component if ZooKeeper added or removed
     remodel = None
+    # Digest of the region ids, updated as the regions are added and removed.
+    _region_digest = None
 
     _properties = HBaseComponent._properties + (
         {'id': 'start_code', 'type': 'string'},
@@ -57,6 +61,53 @@ class HBaseRegionServer(HBaseComponent):
     def device(self):
         return self.hbase_host()
 
+    @property
+    def region_ids(self):
+        return self.regions.objectIds()
+
+    @property
+    def region_digest(self):
+        """
+        Return the digest of the ids of the regions on the server. It is
+        computed on every read until it is stored.
+        """
+        if self._region_digest is None:
+            return region_digest(self.regions.objectIds())
+        return self._region_digest
+
+    def build_region_digest(self):
+        """
+        Store the digest of the regions if it is not stored yet.
+        """
+        if self._region_digest is None:
+            self._region_digest = region_digest(self.regions.objectIds())
+
+    def region_changed(self, region_id, added):
+        """
+        Update the stored digest of the regions when a region is added
+        or about to be removed.
+
+        @param region_id: id of the region
+        @type region_id: str
+        @param added: True if the region is added, False if removed
+        @type added: bool
+        """
+        # Computed on read until it is stored.
+        if self._region_digest is not None:
+            self._region_digest ^= region_digest([region_id])
+
+    def manage_beforeDelete(self, item, container):
+        # Drop the regions from the stored index at once, as the
+        # regions do not update it when deleted with their server.
+        if aq_base(item) is aq_base(self):
+            index = getattr(
+                aq_base(self.device()), '_hbase_region_index', None)
+            if index is not None:
+                for region_id in self.regions.objectIds():
+                    if index.get(region_id) == self.id:
+                        del index[region_id]
+        super(HBaseRegionServer, self).manage_beforeDelete(item, container)
+
     def check_zookeeper(self):
         '''
         Check if ZooKeeper component is on device
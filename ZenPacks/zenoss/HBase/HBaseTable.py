@@ -7,6 +7,7 @@
 #
 ##############################################################################
 
+from Acquisition import aq_base
 from zope.component import adapts
 from zope.interface import implements
 
@@ -22,7 +23,7 @@ from Products.Zuul.utils import ZuulMessageFactory as _t
 
 from . import CLASS_NAME, MODULE_NAME
 from .HBaseComponent import HBaseComponent
-from .utils import updateToMany, updateToOne
+from .utils import RelationshipBatch, updateToMany, updateToOne
 
 
 class HBaseTable(HBaseComponent):
@@ -43,14 +44,32 @@ class HBaseTable(HBaseComponent):
     _relations = HBaseComponent._relations + (
         ('hbase_host', ToOne(
             ToManyCont, 'Products.ZenModel.Device.Device', 'hbase_tables')),
-        # ('regions', ToManyCont(
-        #     ToOne, MODULE_NAME['HBaseHRegion'], 'table')),
+        ('regions', ToMany(ToOne, MODULE_NAME['HBaseHRegion'], 'hbase_table')),
     )
 
     def device(self):
         return self.hbase_host()
 
 
+def table_batch(device):
+    """
+    Return a RelationshipBatch of the relations to the tables of the
+    device. Tables modeled before the relationship to the regions was
+    added get it when the batch changes their relations.
+    """
+    return RelationshipBatch(
+        device, CLASS_NAME['HBaseTable'], prepare=build_table_relations)
+
+
+def build_table_relations(table):
+    """
+    Build the relationships of a table modeled before the relationship
+    to the regions was added.
+    """
+    if not hasattr(aq_base(table), 'regions'):
+        table.buildRelations()
+
+
 class IHBaseTableInfo(IComponentInfo):
     '''
     API Info interface for HBaseTable.
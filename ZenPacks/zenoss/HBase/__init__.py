@@ -12,17 +12,22 @@ executed at startup time in all Zope clients.
 """
 import math
 import logging
+import os
+import time
 log = logging.getLogger('zen.HBase')
 
 import Globals
+import transaction
 
+from Acquisition import aq_base
+from BTrees.OOBTree import OOBTree
 from Products.Zuul import getFacade
 from Products.ZenEvents.EventManagerBase import EventManagerBase
 from Products.ZenModel.Device import Device
 from Products.ZenModel.ZenPack import ZenPack as ZenPackBase
 from Products.ZenRelations.RelSchema import ToManyCont, ToOne
 from Products.ZenRelations.zPropertyCategory import setzPropertyCategory
-from Products.ZenUtils.Utils import unused, monkeypatch
+from Products.ZenUtils.Utils import unused, monkeypatch, zenPath
 from Products.Zuul.interfaces import ICatalogTool
 
 unused(Globals)
@@ -34,6 +39,15 @@ setzPropertyCategory('zHBasePassword', 'HBase')
 setzPropertyCategory('zHBaseRestPort', 'HBase')
 setzPropertyCategory('zHBaseMasterPort', 'HBase')
 setzPropertyCategory('zHBaseRegionServerPort', 'HBase')
+setzPropertyCategory('zHBaseMaxConnectionsPerHost', 'HBase')
+setzPropertyCategory('zHBaseConnectionIdleTimeout', 'HBase')
+setzPropertyCategory('zHBaseMaxConcurrentRequests', 'HBase')
+setzPropertyCategory('zHBaseRequestTimeout', 'HBase')
+setzPropertyCategory('zHBaseModelingTimeout', 'HBase')
+setzPropertyCategory('zHBaseConfRefreshInterval', 'HBase')
+setzPropertyCategory('zHBaseMaxBackoff', 'HBase')
+setzPropertyCategory('zHBaseTableStateMode', 'HBase')
+setzPropertyCategory('zHBaseSchemaCacheTTL', 'HBase')
 
 # Modules containing model classes. Used by zenchkschema to validate
 # bidirectional integrity of defined relationships.
@@ -55,6 +69,15 @@ for product_name in productNames:
 # Useful for components' ids.
 NAME_SPLITTER = '(.)'
 
+# Seconds between the checks for events of deleted components of a device,
+# unless the modeled components of the device change.
+CLEAR_EVENTS_INTERVAL = 600
+
+# Device id -> (time of the last check for events of deleted components,
+# fingerprint of the modeled components), for the checks made less than
+# CLEAR_EVENTS_INTERVAL ago.
+_clear_events_checks = {}
+
 # Define new device relations.
 NEW_DEVICE_RELATIONS = (
     ('hbase_servers', 'HBaseRegionServer'),
@@ -67,6 +90,16 @@ NEW_COMPONENT_TYPES = (
     'ZenPacks.zenoss.HBase.HBaseHRegion.HBaseHRegion',
     )
 
+# Components contained in devices. Regions are removed with their servers.
+DEVICE_COMPONENT_TYPES = (
+    'ZenPacks.zenoss.HBase.HBaseRegionServer.HBaseRegionServer',
+    'ZenPacks.zenoss.HBase.HBaseTable.HBaseTable',
+    )
+
+# Number of devices or components changed between intermediate commits
+# when the ZenPack is installed or removed.
+CHUNK_SIZE = 500
+
 # Add new relationships to Device if they don't already exist.
 for relname, modname in NEW_DEVICE_RELATIONS:
     if relname not in (x[0] for x in Device._relations):
@@ -111,54 +144,261 @@ def tables(self):
 
 
 def regions(self):
-    region_ids = [
-        region.region_hash for regionsv in self.hbase_servers()
-        for region in regionsv.regions()
-    ]
-    return region_ids
+    return list(self.hbase_region_index.keys())
+
+
+def region_index(self):
+    """
+    Return the index of region ids to the ids of the region servers
+    they are on. It is stored when the device is modeled and kept up to
+    date as the regions are added and removed. Until then it is computed
+    on every read, so reading it never writes to ZODB.
+    """
+    index = getattr(aq_base(self), '_hbase_region_index', None)
+    if index is None:
+        index = OOBTree()
+        for server in self.hbase_servers():
+            for region_id in server.regions.objectIds():
+                index[region_id] = server.id
+    return index
+
+
+def build_region_index(self):
+    """
+    Store the index of region ids if it is not stored yet, and return
+    it. Called when the device is modeled and the ZenPack is installed.
+    """
+    if getattr(aq_base(self), '_hbase_region_index', None) is None:
+        self._hbase_region_index = self.hbase_region_index
+    return self._hbase_region_index
+
+
+def server_digests(self):
+    """
+    Return the state and the digest of the regions of each region server,
+    which the monitoring plugin compares with the cluster status to find
+    the changed region servers. No region is loaded to build it.
+    """
+    return dict(
+        (server.id, (server.is_alive, server.region_digest))
+        for server in self.hbase_servers()
+    )
+
+
+def getRegionServerChanges(self):
+    """
+    Always differs from the value set by the monitoring plugin, so
+    ApplyDataMap calls setRegionServerChanges.
+    """
+    return None
+
+
+def setRegionServerChanges(self, changes):
+    """
+    Add and remove the given region servers only, leaving the rest of
+    them and their regions untouched, which a RelationshipMap of all
+    the region servers would have to compare. Regions moved between
+    region servers are cut and pasted, so they keep their identity
+    rather than being deleted and created again.
+
+    @param changes: 'add' list of attribute dicts of the added region
+        servers, 'move' dict of region ids to the ids of the region
+        servers they are on now and 'remove' list of ids of the removed
+        region servers. Regions of the 'move' dict modeled on another
+        region server are moved.
+    @type changes: dict
+    """
+    from ZenPacks.zenoss.HBase.HBaseRegionServer import HBaseRegionServer
+
+    changed = False
+    existing = set(self.hbase_servers.objectIds())
+    for attributes in changes.get('add', ()):
+        server_id = attributes['id']
+        if server_id not in existing:
+            self.hbase_servers._setObject(
+                server_id, HBaseRegionServer(server_id))
+            changed = True
+        server = self.hbase_servers._getOb(server_id)
+        for name, value in attributes.items():
+            if name != 'id':
+                setattr(server, name, value)
+        server.build_region_digest()
+        server.index_object()
+    # Regions are moved before their old region servers are removed.
+    index = self.build_region_index()
+    for region_id, target in changes.get('move', {}).items():
+        source = index.get(region_id)
+        if source is None or source == target:
+            continue
+        try:
+            old = self.hbase_servers._getOb(source).regions
+            new = self.hbase_servers._getOb(target).regions
+        except AttributeError:
+            continue
+        if region_id in old.objectIds():
+            new.manage_pasteObjects(old.manage_cutObjects([region_id]))
+            changed = True
+    for server_id in changes.get('remove', ()):
+        if server_id in existing:
+            self.hbase_servers._delObject(server_id)
+            changed = True
+    # Invalidates the impact edges cached for the device.
+    if changed:
+        self.setLastChange()
+
+
+def getRegionTables(self):
+    """
+    Always differs from the value set by the modeler and the monitoring
+    plugin, so ApplyDataMap calls setRegionTables.
+    """
+    return None
+
+
+def setRegionTables(self, tables):
+    """
+    Relate the regions to their tables. The updates are queued to one
+    RelationshipBatch, so the tables are looked up with a single catalog
+    query and each table is indexed once.
+
+    @param tables: ids of the tables by the ids of the regions
+    @type tables: dict
+    """
+    from ZenPacks.zenoss.HBase.HBaseTable import table_batch
+
+    batch = table_batch(self)
+    index = self.hbase_region_index
+    for region_id, table_id in tables.items():
+        try:
+            region = self.hbase_servers._getOb(index[region_id]) \
+                .regions._getOb(region_id)
+        except (AttributeError, KeyError):
+            continue
+        region.setTableId(table_id, batch)
+    # Invalidates the impact edges cached for the device.
+    if batch.apply():
+        self.setLastChange()
 
 
 def getClearEvents(self):
     """
-    Attempt to clear all non-existing component events.
+    Return the fingerprint of the components the events were last
+    cleared for, or None once CLEAR_EVENTS_INTERVAL has passed since.
 
-    The modeler plugin calls setClearEvents which will cause
-    ApplyDataMap to call this getter method first to validate that
-    the setter even needs to be run.
+    The modeler and the monitoring plugin set the fingerprint of the
+    modeled region servers and regions, so ApplyDataMap calls
+    setClearEvents only when they changed or the interval has passed,
+    and the components are not looked up otherwise.
     """
-    self.clear_events()
-    return True
+    last = _clear_events_checks.get(self.id)
+    if last and time.time() - last[0] < CLEAR_EVENTS_INTERVAL:
+        return last[1]
+    return None
 
 
 def setClearEvents(self, value):
     """
-    This method should typically never be called because the
-    getClearEvents method will always return the same value that
-    the modeler plugin sets.
+    Clear the events of deleted components. Called by ApplyDataMap when
+    getClearEvents returns another value.
+
+    @param value: fingerprint of the modeled components
+    @type value: int
     """
-    self.clear_events()
+    self.clear_events(value)
 
 
-def clear_events(self):
+def clear_events(self, fingerprint=None):
     """
     Discover and clear all events, related to components which had
-    been deleted.
-    """
-    zep = getFacade('zep')
-    zep_filter = zep.createEventFilter(
-        element_identifier=(self.id),
-        event_class=('/Status'),
-        severity=(5, 4),
-        status=(0, 1)
-    )
-    results = zep.getEventSummariesGenerator(filter=zep_filter)
+    been deleted. The events are looked up and closed once the current
+    transaction is committed. Nothing is done if the events were
+    cleared for the same fingerprint less than CLEAR_EVENTS_INTERVAL ago.
+    """
+    if fingerprint is not None and self.getClearEvents() == fingerprint:
+        return
+    component_ids = set(brain.id for brain in self.componentSearch())
+    transaction.get().addAfterCommitHook(
+        close_events, args=(self.id, component_ids, fingerprint))
 
-    component_list = [x.getObject().id for x in self.componentSearch()]
-    for res in results:
-        key = res['occurrence'][0]['actor'].get('element_sub_identifier')
-        if key and key not in component_list:
-            del_filter = zep.createEventFilter(uuid=res['uuid'])
-            zep.closeEventSummaries(eventFilter=del_filter)
+
+def close_events(status, device_id, component_ids, fingerprint):
+    """
+    Close the events of the device components which are not in
+    component_ids with a single ZEP request. Runs as an after commit
+    hook, so ZEP is not called while the transaction is open.
+
+    @param status: whether the transaction was committed
+    @type status: bool
+    @param device_id: id of the device
+    @type device_id: str
+    @param component_ids: ids of the existing components
+    @type component_ids: set
+    @param fingerprint: fingerprint of the modeled components
+    @type fingerprint: int
+    """
+    if not status:
+        return
+    try:
+        zep = getFacade('zep')
+        zep_filter = zep.createEventFilter(
+            element_identifier=(device_id),
+            event_class=('/Status'),
+            severity=(5, 4),
+            status=(0, 1)
+        )
+        uuids = []
+        for res in zep.getEventSummariesGenerator(filter=zep_filter):
+            key = res['occurrence'][0]['actor'].get('element_sub_identifier')
+            if key and key not in component_ids:
+                uuids.append(res['uuid'])
+        if uuids:
+            zep.closeEventSummaries(
+                eventFilter=zep.createEventFilter(uuid=uuids))
+    except Exception:
+        # After commit hooks must not raise, the next check will retry.
+        log.exception('Failed to clear events of deleted components '
+                      'of %s', device_id)
+        return
+    now = time.time()
+    # Checks older than the interval are not used any more, which also
+    # drops the ones of deleted devices.
+    for key, (checked, _) in _clear_events_checks.items():
+        if now - checked >= CLEAR_EVENTS_INTERVAL:
+            del _clear_events_checks[key]
+    _clear_events_checks[device_id] = (now, fingerprint)
+
+
+def needs_cluster_template(collectors, templates):
+    """
+    Return True if HBaseCollector or HBaseTableCollector collectors are
+    used and HBaseCluster monitoring template is not bound.
+    """
+    if 'HBaseCollector' not in collectors and \
+            'HBaseTableCollector' not in collectors:
+        return False
+    return not filter(lambda x: 'HBaseCluster' in x, templates)
+
+
+def getHBaseClusterTemplate(self):
+    """
+    Return True if HBaseCluster monitoring template does not need to be
+    bound to the device.
+    """
+    return not needs_cluster_template(
+        self.getProperty('zCollectorPlugins') or (),
+        self.getProperty('zDeviceTemplates') or ())
+
+
+def setHBaseClusterTemplate(self, value):
+    """
+    Bind HBaseCluster monitoring template to the device. Called by
+    ApplyDataMap when the device is modeled, if getHBaseClusterTemplate
+    returns False.
+    """
+    if value and not self.getHBaseClusterTemplate():
+        self.bindTemplates(
+            list(self.getProperty('zDeviceTemplates') or ()) +
+            ['HBaseCluster'])
 
 
 @monkeypatch('Products.ZenModel.Device.Device')
@@ -167,17 +407,15 @@ def getRRDTemplates(self):
     Returns all the templates bound to this Device and
     add HBaseCluster monitoring template if HBaseCollector or
     HBaseTableCollector collectors are used.
-    """
 
+    Nothing is written here, the template is bound when the device is
+    modeled. Until then it is added to the returned templates only.
+    """
     result = original(self)
-    # Check if 'HBaseCluster' monitoring template is bound to device and bind if not
-    if filter(lambda x: 'HBaseCluster' in x.id, result):
-        return result
-
-    collectors = self.getProperty('zCollectorPlugins')
-    if 'HBaseCollector' in collectors or 'HBaseTableCollector' in collectors:
-        self.bindTemplates([x.id for x in result] + ['HBaseCluster'])
-        result = original(self)
+    if not self.getHBaseClusterTemplate():
+        template = self.getRRDTemplateByName('HBaseCluster')
+        if template and template.id not in [x.id for x in result]:
+            result.append(template)
     return result
 
 
@@ -186,14 +424,27 @@ Device.getErrorNotification = getErrorNotification
 Device.regionserver_ids = property(regionservers)
 Device.table_ids = property(tables)
 Device.region_ids = property(regions)
+Device.hbase_region_index = property(region_index)
+Device.build_region_index = build_region_index
+Device.server_digests = property(server_digests)
+Device.getRegionServerChanges = getRegionServerChanges
+Device.setRegionServerChanges = setRegionServerChanges
+Device.getRegionTables = getRegionTables
+Device.setRegionTables = setRegionTables
 Device.getClearEvents = getClearEvents
 Device.setClearEvents = setClearEvents
 Device.clear_events = clear_events
+Device.getHBaseClusterTemplate = getHBaseClusterTemplate
+Device.setHBaseClusterTemplate = setHBaseClusterTemplate
 
 
 class ZenPack(ZenPackBase):
     """
     ZenPack loader that handles custom installation and removal tasks.
+
+    The install and removal steps commit every CHUNK_SIZE changes and
+    skip the objects already updated, so an interrupted install or
+    removal is resumed by running it again.
     """
 
     packZProperties = [
@@ -203,6 +454,15 @@ class ZenPack(ZenPackBase):
         ('zHBaseRestPort', '8080', 'string'),
         ('zHBaseMasterPort', '60010', 'string'),
         ('zHBaseRegionServerPort', '60030', 'string'),
+        ('zHBaseMaxConnectionsPerHost', 4, 'int'),
+        ('zHBaseConnectionIdleTimeout', 360, 'int'),
+        ('zHBaseMaxConcurrentRequests', 10, 'int'),
+        ('zHBaseRequestTimeout', 30, 'int'),
+        ('zHBaseModelingTimeout', 300, 'int'),
+        ('zHBaseConfRefreshInterval', 3600, 'int'),
+        ('zHBaseMaxBackoff', 1800, 'int'),
+        ('zHBaseTableStateMode', 'table.jsp', 'string'),
+        ('zHBaseSchemaCacheTTL', 3600, 'int'),
     ]
 
     def install(self, app):
@@ -211,21 +471,24 @@ class ZenPack(ZenPackBase):
         log.info('Adding HBase relationships to existing devices')
         self._buildDeviceRelations()
 
+        log.info('Renaming HBase regions modeled with region server ids')
+        self._migrateRegions()
+
+        log.info('Indexing HBase regions')
+        self._buildRegionIndexes()
+
     def remove(self, app, leaveObjects=False):
         if not leaveObjects:
             log.info('Removing HBase components')
-            cat = ICatalogTool(app.zport.dmd)
-            for brain in cat.search(types=NEW_COMPONENT_TYPES):
-                component = brain.getObject()
-                component.getPrimaryParent()._delObject(component.id)
+            self._removeComponents(app)
 
             # Remove our Device relations additions.
             Device._relations = tuple(
                 [x for x in Device._relations
-                    if x[0] not in NEW_DEVICE_RELATIONS])
+                    if x[0] not in dict(NEW_DEVICE_RELATIONS)])
 
             log.info('Removing HBase device relationships')
-            self._buildDeviceRelations()
+            self._buildDeviceRelations(installed=False)
 
         super(ZenPack, self).remove(app, leaveObjects=leaveObjects)
 
@@ -253,6 +516,155 @@ class ZenPack(ZenPackBase):
             except ValueError:
                 pass
 
-    def _buildDeviceRelations(self):
+    def _removeComponents(self, app):
+        """
+        Remove HBase components committing every CHUNK_SIZE removals,
+        so that no single transaction holds all of them. The regions of
+        each region server are removed in chunks before the region
+        server. Components removed by an interrupted run are not found
+        again.
+        """
+        dmd = app.zport.dmd
+        removed = 0
+        # Region servers first, so the tables have no regions left.
+        for type_ in DEVICE_COMPONENT_TYPES:
+            paths = [brain.getPath() for brain in
+                     ICatalogTool(dmd).search(types=(type_,))]
+            for path in paths:
+                try:
+                    component = dmd.unrestrictedTraverse(path)
+                except (AttributeError, KeyError):
+                    continue
+                # Drop the region index and digest, so that they are not
+                # updated for every removed region.
+                device = component.device()
+                if hasattr(aq_base(device), '_hbase_region_index'):
+                    del device._hbase_region_index
+                if type_ == CLASS_NAME['HBaseRegionServer']:
+                    component._region_digest = None
+                    for region_id in list(component.regions.objectIds()):
+                        component.regions._delObject(region_id)
+                        removed = self._commitChunk(removed)
+                component.getPrimaryParent()._delObject(component.id)
+                removed = self._commitChunk(removed)
+        transaction.commit()
+        log.info('Removed %s HBase components', removed)
+
+    def _commitChunk(self, removed):
+        """
+        Count a removed component and commit every CHUNK_SIZE removals.
+        """
+        removed += 1
+        if removed % CHUNK_SIZE == 0:
+            transaction.commit()
+            log.info('Removed %s HBase components', removed)
+        return removed
+
+    def _buildDeviceRelations(self, installed=True):
+        """
+        Build relationships of the devices which miss the HBase
+        relationships when installed, or still have them when removed.
+        Changes are committed every CHUNK_SIZE devices, and the devices
+        updated by an interrupted run are skipped.
+
+        @param installed: whether the ZenPack is installed or removed
+        @type installed: bool
+        """
+        relnames = [relname for relname, modname in NEW_DEVICE_RELATIONS]
+        checked = built = 0
         for d in self.dmd.Devices.getSubDevicesGen():
-            d.buildRelations()
+            checked += 1
+            changed = False
+            if any(hasattr(aq_base(d), relname) != installed
+                   for relname in relnames):
+                d.buildRelations()
+                changed = True
+            if not installed and hasattr(aq_base(d), '_hbase_region_index'):
+                del d._hbase_region_index
+                changed = True
+            if changed:
+                built += 1
+                if built % CHUNK_SIZE == 0:
+                    transaction.commit()
+                    log.info('Updated relationships of %s devices', built)
+            if checked % CHUNK_SIZE == 0:
+                # Drop the devices already seen from the ZODB cache.
+                self.dmd._p_jar.cacheGC()
+        transaction.commit()
+        log.info('Updated relationships of %s of %s devices', built, checked)
+
+    def _migrateRegions(self):
+        """
+        Rename the regions modeled with ids prefixed by the id of their
+        region server to the ids of the region names, committing every
+        CHUNK_SIZE regions. Regions already renamed are skipped, so the
+        step can be repeated.
+        """
+        dmd = self.dmd
+        paths = [brain.getPath() for brain in ICatalogTool(dmd).search(
+            types=(CLASS_NAME['HBaseHRegion'],))]
+        paths = [x for x in paths if NAME_SPLITTER in x.rsplit('/', 1)[-1]]
+        for i, path in enumerate(paths, 1):
+            try:
+                region = dmd.unrestrictedTraverse(path)
+            except (AttributeError, KeyError):
+                continue
+            self._renameRegion(region)
+            if i % CHUNK_SIZE == 0:
+                transaction.commit()
+                log.info('Renamed %s of %s HBase regions', i, len(paths))
+        transaction.commit()
+
+    def _renameRegion(self, region):
+        """
+        Rename the region keeping the object, and move its performance
+        data to the path of the new id. If the data is not found on this
+        host, the region keeps using the old path. A stale copy of a
+        region already modeled with the new id is removed.
+        """
+        device = region.device()
+        regions = region.getPrimaryParent()
+        old_id = region.id
+        new_id = old_id.split(NAME_SPLITTER, 1)[1]
+        skip = len(device.getPrimaryPath()) - 1
+        old_path = 'Devices/' + '/'.join(region.getPrimaryPath()[skip:])
+        # Stored on the first region of the device, so that it is not
+        # computed from all the region servers for every region.
+        if new_id in device.build_region_index():
+            regions._delObject(old_id)
+            return
+        regions.manage_renameObject(old_id, new_id)
+        region = regions._getOb(new_id)
+
+        source = zenPath('perf', old_path)
+        target = zenPath('perf', region.rrdPath())
+        if os.path.exists(target):
+            return
+        if os.path.isdir(source):
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            os.rename(source, target)
+        else:
+            region._rrd_path = old_path
+
+    def _buildRegionIndexes(self):
+        """
+        Store the region index of each device and the region digest of
+        each region server which miss them, committing every CHUNK_SIZE
+        region servers.
+        """
+        dmd = self.dmd
+        paths = [brain.getPath() for brain in ICatalogTool(dmd).search(
+            types=(CLASS_NAME['HBaseRegionServer'],))]
+        for i, path in enumerate(paths, 1):
+            try:
+                server = dmd.unrestrictedTraverse(path)
+            except (AttributeError, KeyError):
+                continue
+            server.build_region_digest()
+            server.device().build_region_index()
+            if i % CHUNK_SIZE == 0:
+                transaction.commit()
+                log.info('Indexed %s of %s HBase region servers',
+                         i, len(paths))
+        transaction.commit()
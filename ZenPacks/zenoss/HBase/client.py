@@ -0,0 +1,264 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2014, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+"""
+HTTP client shared by the modeler and datasource plugins to access HBase
+REST gateway and the master and region server info ports.
+
+Requests go through Agents backed by persistent HTTPConnectionPools, so
+connections are kept open and reused between requests and collection
+cycles instead of being set up for each request as
+twisted.web.client.getPage does. For https this is what saves the TLS
+handshakes, TLS sessions are not resumed on new connections.
+
+Compressed responses are asked for and decoded as they are received. The
+sizes of the response bodies before and after decoding are logged at debug
+level every REPORT_INTERVAL seconds.
+"""
+
+import time
+import zlib
+
+from logging import getLogger
+
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.ssl import ClientContextFactory
+from twisted.python.failure import Failure
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, RedirectAgent, ResponseDone
+)
+from twisted.web.error import Error
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+from ZenPacks.zenoss.HBase.utils import HBaseException
+
+log = getLogger('zen.HBase')
+
+# Default values of zHBaseMaxConnectionsPerHost, zHBaseConnectionIdleTimeout
+# and zHBaseRequestTimeout zProperties.
+MAX_CONNECTIONS_PER_HOST = 4
+CONNECTION_IDLE_TIMEOUT = 360
+REQUEST_TIMEOUT = 30
+
+# (max connections per host, idle timeout) -> HTTPConnectionPool
+_pools = {}
+
+# Only gzip is asked for. Some servers send raw deflate streams instead of
+# the zlib format for 'deflate', and the two cannot be told apart reliably.
+ACCEPT_ENCODING = 'gzip'
+# Content encodings decoded by zlib.
+ENCODINGS = ('gzip', 'x-gzip')
+
+# Seconds between the reports of the counters.
+REPORT_INTERVAL = 300
+
+# Response body bytes received over the network and after decoding since
+# the last report.
+counters = {
+    'received_bytes': 0,
+    'decoded_bytes': 0,
+    'since': time.time(),
+}
+
+
+class ContextFactory(ClientContextFactory):
+    """
+    SSL context factory which creates a single context and shares it
+    between all the connections, so it is not created for each of them.
+    Sharing the context does not resume TLS sessions, each new connection
+    makes a full handshake.
+    """
+    _context = None
+
+    def getContext(self, hostname=None, port=None):
+        if self._context is None:
+            self._context = ClientContextFactory.getContext(self)
+        return self._context
+
+_context_factory = ContextFactory()
+
+
+class BodyReceiver(protocol.Protocol):
+    """
+    Protocol collecting the response body, or feeding it to the reader
+    chunk by chunk if one is given. Compressed body is decoded chunk by
+    chunk too.
+    """
+    def __init__(self, finished, reader=None, encoding=None):
+        self.finished = finished
+        self.reader = reader
+        self.chunks = []
+        self.error = None
+        self.decoder = None
+        if encoding in ENCODINGS:
+            # Accepts both gzip and zlib headers.
+            self.decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def dataReceived(self, data):
+        counters['received_bytes'] += len(data)
+        if self.finished.called:
+            # The reader is done, the rest of the body is only drained so
+            # that the connection goes back to the pool.
+            return
+        if self.error is None:
+            try:
+                if self.decoder is not None:
+                    data = self.decoder.decompress(data)
+                self.deliver(data)
+            except Exception:
+                self.error = Failure()
+
+    def deliver(self, data):
+        counters['decoded_bytes'] += len(data)
+        if self.reader is None:
+            self.chunks.append(data)
+            return
+        self.reader.feed(data)
+        if getattr(self.reader, 'done', False) and not self.finished.called:
+            # The reader has got all it needs. The rest of the body is
+            # still received, as closing the connection would keep it
+            # from being reused.
+            self.finished.callback(self.reader.close())
+
+    def connectionLost(self, reason):
+        # The request was cancelled.
+        if self.finished.called:
+            return
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.errback(reason)
+        elif self.error is not None:
+            self.finished.errback(self.error)
+        else:
+            try:
+                if self.decoder is not None:
+                    self.deliver(self.decoder.flush())
+                if self.reader is None:
+                    result = ''.join(self.chunks)
+                else:
+                    result = self.reader.close()
+            except Exception:
+                self.finished.errback(Failure())
+            else:
+                self.finished.callback(result)
+
+
+def report_counters():
+    """
+    Log the sizes of the response bodies received since the last report
+    and reset the counters, at most once per REPORT_INTERVAL seconds.
+    """
+    now = time.time()
+    if now - counters['since'] < REPORT_INTERVAL:
+        return
+    received, decoded = counters['received_bytes'], counters['decoded_bytes']
+    if decoded:
+        log.debug(
+            'Received %s bytes of HBase responses in %d seconds, '
+            '%s bytes decoded, %.1f%% saved by compression',
+            received, now - counters['since'], decoded,
+            100.0 * (decoded - received) / decoded)
+    counters.update(received_bytes=0, decoded_bytes=0, since=now)
+
+
+def get_pool(max_connections, idle_timeout):
+    """
+    Return the connection pool for the given settings.
+
+    @param max_connections: number of persistent connections per host
+    @type max_connections: int
+    @param idle_timeout: seconds an idle connection is kept open
+    @type idle_timeout: int
+    @return: HTTPConnectionPool
+    """
+    key = (max_connections, idle_timeout)
+    if key not in _pools:
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = max_connections
+        pool.cachedConnectionTimeout = idle_timeout
+        _pools[key] = pool
+    return _pools[key]
+
+
+def read_body(response, reader=None):
+    """
+    Return a deferred firing with the response body, or with the result
+    of the reader fed with it. Responses with error status fail with
+    twisted.web.error.Error the same way getPage does.
+    """
+    def cancel(d):
+        receiver.transport.stopProducing()
+
+    finished = defer.Deferred(cancel)
+    if response.code >= 400:
+        reader = None
+    encoding = response.headers.getRawHeaders('content-encoding', [''])[0]
+    receiver = BodyReceiver(finished, reader, encoding.strip().lower())
+    response.deliverBody(receiver)
+    if response.code >= 400:
+        def error(body):
+            raise Error(str(response.code), response.phrase, body)
+        finished.addCallback(error)
+
+    def report(result):
+        report_counters()
+        return result
+    finished.addBoth(report)
+    return finished
+
+
+def fetch(url, headers=None, max_connections=MAX_CONNECTIONS_PER_HOST,
+          idle_timeout=CONNECTION_IDLE_TIMEOUT, timeout=REQUEST_TIMEOUT,
+          reader=None):
+    """
+    Request the url through a pooled persistent connection. Compressed
+    response is asked for and decoded transparently.
+
+    @param url: the url to request
+    @type url: str
+    @param headers: request headers
+    @type headers: dict
+    @param max_connections: number of persistent connections per host
+    @type max_connections: int
+    @param idle_timeout: seconds an idle connection is kept open
+    @type idle_timeout: int
+    @param timeout: seconds to wait for the whole response, no limit if 0
+    @type timeout: int
+    @param reader: incremental parser with feed(data) and close() methods
+        the body is fed to as it is received. The deferred fires as soon
+        as its optional done attribute is True, and the rest of the body
+        is read without being decoded or parsed.
+    @type reader: object
+    @return: deferred firing with the response body or the result of
+        reader.close()
+    """
+    agent = RedirectAgent(Agent(
+        reactor, _context_factory,
+        pool=get_pool(max_connections, idle_timeout)
+    ))
+    headers = dict(headers or {})
+    headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+    d = agent.request('GET', url, Headers(
+        dict((name, [value]) for name, value in headers.items())
+    ))
+    d.addCallback(read_body, reader)
+    if timeout:
+        timer = reactor.callLater(timeout, d.cancel)
+
+        def check_timeout(result):
+            if timer.active():
+                timer.cancel()
+            elif isinstance(result, Failure):
+                # The request was cancelled by the timer.
+                raise HBaseException(
+                    'Request to {0} timed out after {1} seconds'.format(
+                        url, timeout))
+            return result
+        d.addBoth(check_timeout)
+    return d
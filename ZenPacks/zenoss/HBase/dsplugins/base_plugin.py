@@ -8,20 +8,192 @@
 #
 ######################################################################
 
+import time
+
 from logging import getLogger
 
-from twisted.web.client import getPage
 from twisted.internet import defer
+from twisted.web.error import Error
 
 from Products.ZenEvents import ZenEventClasses
+from ZenPacks.zenoss.HBase import client
 from ZenPacks.zenoss.HBase.utils import (
-    hbase_rest_url, hbase_headers, HBaseException, check_error
+    hbase_rest_url, hbase_headers, HBaseException, HostUnavailable,
+    check_error, ClusterStatus, ClusterStatusReader
 )
 from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource \
     import PythonDataSourcePlugin
 
 log = getLogger('zen.HBasePlugins')
 
+# Part of the datasource cycle time during which a cached REST gateway
+# response is considered fresh.
+SNAPSHOT_FRESHNESS = 0.5
+
+
+class SnapshotCache(object):
+    """
+    Cache of REST gateway responses shared by all the datasource plugins
+    which poll the same device within one collection cycle. Responses
+    older than the longest ttl asked for are dropped whenever a response
+    is received, so the ones of removed or reconfigured devices are not
+    kept.
+    """
+
+    def __init__(self):
+        # snapshot_key -> (timestamp, response)
+        self._snapshots = {}
+        # snapshot_key -> deferreds waiting for the response
+        self._pending = {}
+        # The longest ttl asked for.
+        self._max_ttl = 0
+
+    def get(self, key, ttl, fetch):
+        """
+        Return a deferred which fires with the cached response for the key
+        if it is not older than ttl seconds. Otherwise call fetch to get a
+        new one. Callers asking for a key which is being fetched share the
+        request in flight.
+
+        @param key: key returned by snapshot_key
+        @type key: tuple
+        @param ttl: freshness window in seconds
+        @type ttl: int
+        @param fetch: callable returning a deferred with the response
+        @type fetch: callable
+        @return: Deferred
+        """
+        self._max_ttl = max(self._max_ttl, ttl)
+        snapshot = self._snapshots.get(key)
+        if snapshot and time.time() - snapshot[0] < ttl:
+            return defer.succeed(snapshot[1])
+
+        d = defer.Deferred()
+        if key in self._pending:
+            self._pending[key].append(d)
+            return d
+
+        self._pending[key] = [d]
+        defer.maybeDeferred(fetch).addCallbacks(
+            self._on_result, self._on_failure,
+            callbackArgs=(key,), errbackArgs=(key,)
+        )
+        return d
+
+    def peek(self, key, ttl):
+        """
+        Return the cached response for the key if it is not older than
+        ttl seconds, without fetching a new one.
+        """
+        snapshot = self._snapshots.get(key)
+        if snapshot and time.time() - snapshot[0] < ttl:
+            return snapshot[1]
+
+    def invalidate(self, key):
+        """
+        Drop the cached response for the key.
+        """
+        self._snapshots.pop(key, None)
+
+    def _on_result(self, result, key):
+        now = time.time()
+        for old_key, (timestamp, _) in self._snapshots.items():
+            if now - timestamp >= self._max_ttl:
+                del self._snapshots[old_key]
+        self._snapshots[key] = (now, result)
+        for d in self._pending.pop(key, []):
+            d.callback(result)
+
+    def _on_failure(self, failure, key):
+        # Failures are not cached, the next caller will retry.
+        for d in self._pending.pop(key, []):
+            d.errback(failure)
+
+
+SNAPSHOT_CACHE = SnapshotCache()
+
+
+def snapshot_key(ds, endpoint):
+    """
+    Return the SNAPSHOT_CACHE key of the REST gateway endpoint polled with
+    the connection settings of the datasource. Datasources which differ in
+    any of the settings do not share their snapshots.
+
+    @param ds: device datasourse
+    @type ds: instance of PythonDataSourceConfig
+    @param endpoint: REST gateway endpoint
+    @type endpoint: str
+    @return: tuple
+    """
+    return (ds.zHBaseScheme, ds.manageIp, ds.zHBaseRestPort,
+            ds.zHBaseUsername, ds.zHBasePassword, endpoint)
+
+
+class CircuitBreaker(object):
+    """
+    Per host circuit breaker. A host which could not be reached is not
+    requested for a backoff period, which doubles with every consecutive
+    failure. When the period is over a single probe request is let
+    through, and its result either closes the breaker or opens it again.
+    HTTP error responses mean the host is reachable and do not count as
+    failures.
+    """
+
+    def __init__(self):
+        # (host, port) -> [consecutive failures, time of the next attempt,
+        # whether the probe request is in flight]
+        self._hosts = {}
+
+    def call(self, key, fetch, backoff, max_backoff):
+        """
+        Call fetch unless the breaker of the host is open.
+
+        @param key: (host, port) tuple
+        @type key: tuple
+        @param fetch: callable returning a deferred with the response
+        @type fetch: callable
+        @param backoff: seconds to wait after the first failure
+        @type backoff: int
+        @param max_backoff: the longest wait in seconds
+        @type max_backoff: int
+        @return: Deferred, failing with HostUnavailable if the breaker
+            is open
+        """
+        state = self._hosts.get(key)
+        if state:
+            if state[2] or time.time() < state[1]:
+                return defer.fail(HostUnavailable(
+                    'Backoff after {0} failed requests'.format(state[0])))
+            # Half-open, let a probe through.
+            state[2] = True
+        d = defer.maybeDeferred(fetch)
+        d.addCallbacks(
+            self._on_result, self._on_failure,
+            callbackArgs=(key,), errbackArgs=(key, backoff, max_backoff)
+        )
+        return d
+
+    def _on_result(self, result, key):
+        self._hosts.pop(key, None)
+        return result
+
+    def _on_failure(self, failure, key, backoff, max_backoff):
+        if failure.check(Error):
+            self._hosts.pop(key, None)
+            return failure
+        state = self._hosts.setdefault(key, [0, 0, False])
+        state[0] += 1
+        state[1] = time.time() + min(
+            backoff * 2 ** (state[0] - 1), max_backoff)
+        state[2] = False
+        log.debug(
+            'Host %s:%s failed %s times, next attempt in %d seconds',
+            key[0], key[1], state[0], state[1] - time.time())
+        return failure
+
+
+CIRCUIT_BREAKER = CircuitBreaker()
+
 
 class HBaseBasePlugin(PythonDataSourcePlugin):
     """
@@ -34,6 +206,9 @@ class HBaseBasePlugin(PythonDataSourcePlugin):
         'zHBaseUsername',
         'zHBasePassword',
         'zHBaseRestPort',
+        'zHBaseMaxConnectionsPerHost',
+        'zHBaseConnectionIdleTimeout',
+        'zHBaseRequestTimeout',
     )
 
     component = None
@@ -49,12 +224,33 @@ class HBaseBasePlugin(PythonDataSourcePlugin):
     eventClass = '/Status'
     port = 'zHBaseRestPort'
 
+    def reader(self):
+        """
+        Return the incremental parser the response is fed to while it is
+        received, or None to receive the whole response body.
+
+        @return: ClusterStatusReader
+        """
+        return ClusterStatusReader()
+
+    def parse(self, result):
+        """
+        Parses the data returned from fetch call once per response.
+        The parsed result is shared between all the plugins polling
+        the same endpoint.
+
+        @param result: the fields collected by the reader
+        @type result: dict
+        @return: ClusterStatus
+        """
+        return ClusterStatus(result)
+
     def process(self, result):
         """
         Parses resulting data into datapoints.
 
-        @param result: the data returned from getPage call
-        @type result: str
+        @param result: the parsed data returned from fetch call
+        @type result: ClusterStatus
         @return: dict of datapoints
         """
         return {}
@@ -63,8 +259,8 @@ class HBaseBasePlugin(PythonDataSourcePlugin):
         """
         Create Object/Relationship map for component remodeling.
 
-        @param res: the data returned from getPage call
-        @type res: str
+        @param res: the parsed data returned from fetch call
+        @type res: ClusterStatus
         @param datasource: device datasourse
         @type datasource: instance of PythonDataSourceConfig
         @return: ObjectMap|RelationshipMap
@@ -75,14 +271,71 @@ class HBaseBasePlugin(PythonDataSourcePlugin):
         """
         Form events for a particular component.
 
-        @param result: the data returned from getPage call
-        @type result: str
+        @param result: the parsed data returned from fetch call
+        @type result: ClusterStatus
         @param ds: device datasourse
         @type ds: instance of PythonDataSourceConfig
         @return: list of events
         """
         return []
 
+    def fetch(self, url, headers, ds, reader=None):
+        """
+        Request the url using the connection settings of the datasource.
+
+        @param url: the url to request
+        @type url: str
+        @param headers: request headers
+        @type headers: dict
+        @param ds: device datasourse
+        @type ds: instance of PythonDataSourceConfig
+        @param reader: incremental parser of the response
+        @type reader: ClusterStatusReader
+        @return: deferred firing with the response body or the result
+            of the reader
+        """
+        return client.fetch(
+            url, headers=headers,
+            max_connections=ds.zHBaseMaxConnectionsPerHost,
+            idle_timeout=ds.zHBaseConnectionIdleTimeout,
+            timeout=ds.zHBaseRequestTimeout,
+            reader=reader
+        )
+
+    def get_snapshot(self, ds, endpoint, reader, parse):
+        """
+        Return the parsed REST gateway response for the endpoint from
+        SNAPSHOT_CACHE, requesting it if there is no fresh one.
+
+        @param ds: device datasourse
+        @type ds: instance of PythonDataSourceConfig
+        @param endpoint: REST gateway endpoint
+        @type endpoint: str
+        @param reader: callable returning the incremental parser of the
+            response or None
+        @type reader: callable
+        @param parse: callable parsing the response
+        @type parse: callable
+        @return: Deferred
+        """
+        url = hbase_rest_url(
+            scheme=ds.zHBaseScheme,
+            port=ds.zHBaseRestPort,
+            host=ds.manageIp,
+            endpoint=endpoint
+        )
+        headers = hbase_headers(
+            accept='application/json',
+            username=ds.zHBaseUsername,
+            passwd=ds.zHBasePassword
+        )
+        return SNAPSHOT_CACHE.get(
+            snapshot_key(ds, endpoint),
+            ttl=ds.cycletime * SNAPSHOT_FRESHNESS,
+            fetch=lambda: self.fetch(
+                url, headers, ds, reader()).addCallback(parse)
+        )
+
     @defer.inlineCallbacks
     def collect(self, config):
         """
@@ -95,19 +348,9 @@ class HBaseBasePlugin(PythonDataSourcePlugin):
 
         ds0 = config.datasources[0]
         # Check the connection and collect data.
-        url = hbase_rest_url(
-            scheme=ds0.zHBaseScheme,
-            port=ds0.zHBaseRestPort,
-            host=ds0.manageIp,
-            endpoint=self.endpoint
-        )
-        headers = hbase_headers(
-            accept='application/json',
-            username=ds0.zHBaseUsername,
-            passwd=ds0.zHBasePassword
-        )
         try:
-            res = yield getPage(url, headers=headers)
+            res = yield self.get_snapshot(
+                ds0, self.endpoint, self.reader, self.parse)
             if not res:
                 raise HBaseException('No monitoring data')
         except (Exception, HBaseException), e:
@@ -160,6 +403,26 @@ class HBaseBasePlugin(PythonDataSourcePlugin):
 
 
 # Helper functions for datasource plugins.
+def run_concurrently(limit, func, items):
+    """
+    Call func for each of the items keeping at most limit calls in flight.
+
+    @param limit: maximum number of concurrent calls, values below 1
+        are taken as 1
+    @type limit: int
+    @param func: callable returning a deferred
+    @type func: callable
+    @param items: arguments to call func with
+    @type items: list
+    @return: DeferredList which fails on the first failed call
+    """
+    semaphore = defer.DeferredSemaphore(max(1, int(limit)))
+    return defer.DeferredList(
+        [semaphore.run(func, item) for item in items],
+        fireOnOneErrback=True, consumeErrors=True
+    )
+
+
 def sum_perf_metrics(res, region):
     """
     Util function for summing region metrics
@@ -18,7 +18,7 @@ from Products.ZenUtils.Utils import prepId
 from ZenPacks.zenoss.HBase import MODULE_NAME
 from ZenPacks.zenoss.HBase.dsplugins.base_plugin import HBaseBasePlugin
 from ZenPacks.zenoss.HBase.modeler.plugins.HBaseCollector import HBaseCollector
-from ZenPacks.zenoss.HBase.utils import dead_node_name, version_diff
+from ZenPacks.zenoss.HBase.utils import dead_node_name, region_digest
 
 log = getLogger('zen.HBasePlugins')
 
@@ -29,61 +29,95 @@ class HBaseMasterPlugin(HBaseBasePlugin):
     """
 
     proxy_attributes = HBaseBasePlugin.proxy_attributes + (
-        'regionserver_ids',
-        'region_ids'
+        'server_digests',
     )
-    # Containers for nodes to avoid a lot of parsing.
-    dead = None
-    live = None
 
     def process(self, result):
         """
         Parses resulting data into datapoints.
         """
-        data = json.loads(result)
-        self.dead = version_diff(data['DeadNodes'])
-        self.live = version_diff(data['LiveNodes'])
-
         # Calculate the percentage of dead servers.
-        overall_servers = len(self.dead) + len(self.live)
+        overall_servers = len(result.dead) + len(result.live)
         percent_dead_servers = 0.00
         if overall_servers:
-            percent_dead_servers = len(self.dead) * 100.00 / overall_servers
+            percent_dead_servers = len(result.dead) * 100.00 / overall_servers
 
         return {
-            'live_servers': (len(self.live), 'N'),
-            'dead_servers': (len(self.dead), 'N'),
-            'requests_per_second': (data['requests'], 'N'),
-            'regions': (data['regions'], 'N'),
-            'average_load': (data['averageLoad'], 'N'),
+            'live_servers': (len(result.live), 'N'),
+            'dead_servers': (len(result.dead), 'N'),
+            'requests_per_second': (result.requests, 'N'),
+            'regions': (result.regions, 'N'),
+            'average_load': (result.average_load, 'N'),
             'percent_dead_servers': (percent_dead_servers, 'N'),
         }
 
     def add_maps(self, res, ds):
         """
-        Check for added/removed regionservers and return a RelationshipMap if
-        any changes took place. Otherwise return ObjectMap which only cleares
-        the events of non-existiong components.
+        Compare the cluster status with the modeled region servers and
+        return the maps for the added, removed and changed region servers
+        only. Regions are remodeled only for the region servers whose set
+        of regions changed, and regions moved to another region server are
+        relocated. Events of non-existing components are cleared when
+        the components change or CLEAR_EVENTS_INTERVAL passes.
         """
-        # Check for removed/added region servers.
-        dead_nodes = [prepId(dead_node_name(node)[0]) for node in self.dead]
-        live_nodes = [prepId(node['name']) for node in self.live]
-        nodes = set(dead_nodes + live_nodes)
-        self.added = list(nodes.difference(set(ds.regionserver_ids)))
-        self.removed = list(set(ds.regionserver_ids).difference(nodes))
-
-        # Check for removed/added regions.
-        regions = set(region.get('name') for node in self.live
-                      for region in node.get('Region'))
-        change = regions.symmetric_difference(ds.region_ids)
-        # Remodel Regions and RegionServers only if some of them
-        # were added/removed.
-        if self.added or self.removed or change:
-            ds.id = ds.device
-            result = {'status': res, 'conf': None, 'tables': '{}'}
-            return HBaseCollector().process(ds, result, log)
-        # If nothing changed, just clear events.
-        return [ObjectMap({'getClearEvents': True})]
+        modeled = ds.server_digests
+        dead = dict((prepId(dead_node_name(node)[0]), node)
+                    for node in res.dead)
+        servers = set(dead).union(res.nodes)
+        self.added = sorted(servers.difference(modeled))
+        self.removed = sorted(set(modeled).difference(servers))
+
+        collector = HBaseCollector()
+        added = []
+        moved = {}
+        server_maps = []
+        region_maps = []
+        region_tables = {}
+        for server_id in sorted(servers):
+            node = res.nodes.get(server_id)
+            regions = node['Region'] if node else []
+            # The modeler reports a server both dead and live as dead.
+            if server_id in dead:
+                server = collector._node_attributes(dead[server_id], None)
+            else:
+                server = collector._node_attributes(node, None, True)
+            region_ids = [prepId(region['name']) for region in regions]
+            if modeled.get(server_id) == (
+                    server['is_alive'], region_digest(region_ids)):
+                continue
+            # The regions of a changed server may have been moved from
+            # another one, which only the device region index knows.
+            moved.update(dict.fromkeys(region_ids, server_id))
+            if server_id in modeled:
+                del server['id']
+                server_maps.append(ObjectMap(
+                    server,
+                    compname='hbase_servers/%s' % server_id,
+                    modname=MODULE_NAME['HBaseRegionServer']))
+            else:
+                added.append(server)
+            region_maps.append(RelationshipMap(
+                compname='hbase_servers/%s' % server_id,
+                relname='regions',
+                modname=MODULE_NAME['HBaseHRegion'],
+                objmaps=[collector._region_om(region, server_id, None)
+                         for region in regions]))
+            region_tables.update(collector._region_tables(regions))
+
+        maps = []
+        # Servers have to exist before their regions are mapped.
+        if added or moved or self.removed:
+            maps.append(ObjectMap({'setRegionServerChanges': {
+                'add': added, 'move': moved, 'remove': self.removed}}))
+        maps.extend(server_maps)
+        maps.extend(region_maps)
+        # Clear events of non-existing components, and relate the mapped
+        # regions to their tables once they are all mapped.
+        device_map = {'setClearEvents': res.fingerprint}
+        if region_tables:
+            device_map['setRegionTables'] = region_tables
+        maps.append(ObjectMap(device_map))
+        return maps
 
     def get_events(self, result, ds):
         """
@@ -91,7 +125,7 @@ class HBaseMasterPlugin(HBaseBasePlugin):
         removing a region server.
         """
         # No need to create events on first remodel.
-        if not ds.regionserver_ids:
+        if not ds.server_digests:
             return []
         events = []
         for server in self.added:
@@ -122,6 +156,18 @@ class HBaseMasterTablesPlugin(HBaseBasePlugin):
     )
     endpoint = '/'
 
+    def reader(self):
+        """
+        The table list is received as a whole.
+        """
+        return None
+
+    def parse(self, result):
+        """
+        The table list is parsed in add_maps.
+        """
+        return result
+
     def add_maps(self, res, ds):
         """
         Check for added/removed tables and return a RelationshipMap if
@@ -8,14 +8,13 @@
 #
 ######################################################################
 
-import json
-
 from logging import getLogger
 
-from Products.ZenUtils.Utils import prepId
-from ZenPacks.zenoss.HBase import NAME_SPLITTER
-from ZenPacks.zenoss.HBase.dsplugins.base_plugin import HBaseBasePlugin, sum_perf_metrics
-from ZenPacks.zenoss.HBase.utils import version_diff
+from Products.ZenEvents import ZenEventClasses
+from ZenPacks.zenoss.HBase import client
+from ZenPacks.zenoss.HBase.dsplugins.base_plugin import (
+    HBaseBasePlugin, sum_perf_metrics
+)
 
 log = getLogger('zen.HBasePlugins')
 
@@ -23,32 +22,65 @@ log = getLogger('zen.HBasePlugins')
 class HBaseHRegionPlugin(HBaseBasePlugin):
     """
     Datasource plugin for HBase Region component.
+
+    The values of all the regions of the device are taken from one
+    cluster status, which is shared with the device HBaseCluster
+    datasources when they poll the device in the same cycle, and is
+    requested otherwise.
+
+    zenhub builds one config per region, so only the attributes the
+    shared status is looked up with are proxied. The status is requested
+    with the default connection pool and timeout settings.
     """
 
+    proxy_attributes = (
+        'zHBaseScheme',
+        'zHBaseUsername',
+        'zHBasePassword',
+        'zHBaseRestPort',
+    )
+
     eventKey = 'hbase_region_monitoring_error'
 
+    def fetch(self, url, headers, ds, reader=None):
+        """
+        Request the url with the default connection settings, as they
+        are not proxied to the region configs.
+        """
+        return client.fetch(url, headers=headers, reader=reader)
+
+    def onSuccess(self, result, config):
+        """
+        Clear the device event only. The region datasources do not send
+        any component events, so clearing them for every region each
+        cycle is not needed.
+        """
+        if None in result['values']:
+            result['events'].append({
+                'component': None,
+                'summary': 'Monitoring ok',
+                'eventKey': self.eventKey,
+                'eventClass': self.eventClass,
+                'severity': ZenEventClasses.Clear,
+            })
+        return result
+
     def process(self, result):
         """
         Parses resulting data into datapoints.
         """
-        data = json.loads(result)
-        node_id, region_id = self.component.split(NAME_SPLITTER)
-        res = {}
-
-        for node in version_diff(data["LiveNodes"]):
-            if node_id == prepId(node['name']):
-                for region in node["Region"]:
-                    if region_id == prepId(region['name']):
-                        res = {
-                            'read_requests': (0, 'N'),
-                            'write_requests': (0, 'N'),
-                            'number_of_stores': (0, 'N'),
-                            'number_of_store_files': (0, 'N'),
-                            'store_file_size_mb': (0, 'N'),
-                            'store_file_index_size_mb': (0, 'N'),
-                            'memstore_size_mb': (0, 'N'),
-                            'current_compacted_kv': (0, 'N'),
-                            'total_compacting_kv': (0, 'N'),
-                        }
-                        return sum_perf_metrics(res, region)
-        return res
+        region = result.region_metrics.get(self.component)
+        if not region:
+            return {}
+        res = {
+            'read_requests': (0, 'N'),
+            'write_requests': (0, 'N'),
+            'number_of_stores': (0, 'N'),
+            'number_of_store_files': (0, 'N'),
+            'store_file_size_mb': (0, 'N'),
+            'store_file_index_size_mb': (0, 'N'),
+            'memstore_size_mb': (0, 'N'),
+            'current_compacted_kv': (0, 'N'),
+            'total_compacting_kv': (0, 'N'),
+        }
+        return sum_perf_metrics(res, region)
@@ -9,26 +9,57 @@
 ######################################################################
 
 import json
+import time
 
 from logging import getLogger
+from urllib import quote
 
-from twisted.web.client import getPage
 from twisted.internet import defer
 
 from Products.DataCollector.plugins.DataMaps import ObjectMap, RelationshipMap
 from Products.ZenEvents import ZenEventClasses
-from Products.ZenUtils.Utils import prepId, convToUnits
-from ZenPacks.zenoss.HBase import MODULE_NAME, NAME_SPLITTER
+from Products.ZenUtils.Utils import convToUnits
+from ZenPacks.zenoss.HBase import MODULE_NAME
 from ZenPacks.zenoss.HBase.dsplugins.base_plugin import (
-    HBaseBasePlugin, sum_perf_metrics
+    HBaseBasePlugin, sum_perf_metrics, run_concurrently, snapshot_key,
+    SNAPSHOT_CACHE, SNAPSHOT_FRESHNESS, CIRCUIT_BREAKER
 )
 from ZenPacks.zenoss.HBase.utils import (
-    hbase_rest_url, hbase_headers, dead_node_name, version_diff,
-    ConfWrapper, HBaseException, check_error
+    hbase_rest_url, hbase_headers, ConfWrapper, HBaseException,
+    HostUnavailable, check_error
 )
 
 log = getLogger('zen.HBasePlugins')
 
+# JMX bean queries for the region server statistics, the newest HBase
+# version first. The '/jmx' servlet takes a single bean name pattern, so
+# each bean of a version is requested on its own. The per region beans,
+# which make up most of the '/jmx' document, are never requested. None
+# stands for the unfiltered document.
+JMX_QUERIES = (
+    # 0.96 and later.
+    ('Hadoop:service=HBase,name=RegionServer,sub=Server',
+     'Hadoop:service=HBase,name=RegionServer,sub=IPC'),
+    # 0.94.
+    ('hadoop:service=RegionServer,name=RegionServerStatistics',
+     'hadoop:service=HBase,name=RPCStatistics-*'),
+    None,
+)
+
+# Seconds after which the bean queries are tried again for a server
+# which had to be asked for the unfiltered document.
+JMX_QUERY_RETRY_INTERVAL = 3600
+
+# Data point names used by HBase 0.96 and later.
+JMX_POINTS = {
+    'blockCacheEvictedCount': 'blockCacheEvictionCount',
+    'blockCacheHitCachingRatio': 'blockCacheExpressHitPercent',
+    'blockCacheHitRatio': 'blockCountHitPercent',
+    'callQueueLen': 'numCallsInGeneralQueue',
+    'compactionQueueSize': 'compactionQueueLength',
+    'flushQueueSize': 'flushQueueLength',
+}
+
 
 class HBaseRegionServerPlugin(HBaseBasePlugin):
     """
@@ -41,42 +72,36 @@ class HBaseRegionServerPlugin(HBaseBasePlugin):
         """
         Parses resulting data into datapoints.
         """
-        data = json.loads(result)
-
-        for node in version_diff(data["LiveNodes"]):
-            if self.component == prepId(node['name']):
-                res = {
-                    'requests_per_second': (node['requests'], 'N'),
-                    'used_heap_mb': (node['heapSizeMB'], 'N'),
-                    'max_heap_mb': (node['maxHeapSizeMB'], 'N'),
-                    'regions': (len(node['Region']), 'N'),
-                    'read_requests': (0, 'N'),
-                    'write_requests': (0, 'N'),
-                    'number_of_stores': (0, 'N'),
-                    'number_of_store_files': (0, 'N'),
-                    'store_file_size_mb': (0, 'N'),
-                    'store_file_index_size_mb': (0, 'N'),
-                    'memstore_size_mb': (0, 'N'),
-                    'current_compacted_kv': (0, 'N'),
-                    'total_compacting_kv': (0, 'N'),
-                }
-                for region in node["Region"]:
-                    res = sum_perf_metrics(res, region)
-                return res
-        return {}
+        node = result.nodes.get(self.component)
+        if not node:
+            return {}
+        res = {
+            'requests_per_second': (node['requests'], 'N'),
+            'used_heap_mb': (node['heapSizeMB'], 'N'),
+            'max_heap_mb': (node['maxHeapSizeMB'], 'N'),
+            'regions': (len(node['Region']), 'N'),
+            'read_requests': (0, 'N'),
+            'write_requests': (0, 'N'),
+            'number_of_stores': (0, 'N'),
+            'number_of_store_files': (0, 'N'),
+            'store_file_size_mb': (0, 'N'),
+            'store_file_index_size_mb': (0, 'N'),
+            'memstore_size_mb': (0, 'N'),
+            'current_compacted_kv': (0, 'N'),
+            'total_compacting_kv': (0, 'N'),
+        }
+        for region in node["Region"]:
+            res = sum_perf_metrics(res, region)
+        return res
 
     def get_events(self, result, ds):
         """
         Return a list of event dictionaries informing about the health
         of the region server.
         """
-        data = json.loads(result)
-        # Check for dead servers.
-        dead_nodes = [prepId(dead_node_name(node)[0]) for node
-                      in version_diff(data["DeadNodes"])]
         # Send error or clear event.
-        severity = ((self.component in dead_nodes) and ZenEventClasses.Error
-                    or ZenEventClasses.Clear)
+        severity = ((self.component in result.dead_ids)
+                    and ZenEventClasses.Error or ZenEventClasses.Clear)
         return [{
             'component': self.component,
             'summary': "Region server '{0}' is dead".format(
@@ -97,49 +122,99 @@ class HBaseRegionServerConfPlugin(HBaseBasePlugin):
         'region_ids',
         'title',
         'zHBaseRegionServerPort',
+        'zHBaseMaxConcurrentRequests',
+        'zHBaseConfRefreshInterval',
+        'zHBaseMaxBackoff',
         'check_zookeeper',
     )
 
+    eventKey = 'hbase_regionserver_conf_error'
+
+    # (device id, region server id) -> (fingerprint of the sent maps,
+    # time they were sent). Shared by the plugin instances.
+    _fingerprints = {}
+
+    # Fingerprints of the maps of this collection, saved once the
+    # results are sent.
+    _pending = None
+
     @defer.inlineCallbacks
     def collect(self, config):
         """
         This method overrides the HBaseBasePlugin.collect method.
         """
         results = self.new_data()
-        for ds in config.datasources:
-            self.component = ds.component
-            headers = hbase_headers(
-                accept='application/json',
-                username=ds.zHBaseUsername,
-                passwd=ds.zHBasePassword
-            )
-            url = hbase_rest_url(
-                scheme=ds.zHBaseScheme,
-                port=ds.zHBaseRegionServerPort,
-                host=get_host(ds),
-                endpoint='/dump'
-            )
-            try:
-                res = yield getPage(url, headers=headers)
-                if not res:
-                    raise HBaseException('No monitoring data')
-                results['maps'].extend(self.add_maps(res, ds))
-            except (Exception, HBaseException), e:
-                e = check_error(
-                    e, ds.device,
-                    'hbase_regionserver_monitoring_error',
-                    'zHBaseRegionServerPort'
-                ) or e
-                log.error("No access to page '{}': {}".format(url, e))
+        self._pending = {}
+        yield run_concurrently(
+            config.datasources[0].zHBaseMaxConcurrentRequests,
+            lambda ds: self.collect_server(ds, results),
+            config.datasources
+        )
         defer.returnValue(results)
 
+    @defer.inlineCallbacks
+    def collect_server(self, ds, results):
+        """
+        Collect the configuration of a single region server into the results.
+        """
+        headers = hbase_headers(
+            accept='application/json',
+            username=ds.zHBaseUsername,
+            passwd=ds.zHBasePassword
+        )
+        url = hbase_rest_url(
+            scheme=ds.zHBaseScheme,
+            port=ds.zHBaseRegionServerPort,
+            host=get_host(ds),
+            endpoint='/dump'
+        )
+        try:
+            res = yield fetch_server(self, url, headers, ds)
+            if not res:
+                raise HBaseException('No monitoring data')
+            self.component = ds.component
+            results['maps'].extend(self.add_maps(res, ds))
+            results['events'].append(server_event(
+                self, ds, 'Monitoring ok', ZenEventClasses.Clear))
+        except HostUnavailable, e:
+            log.debug("Skipping page '{}': {}".format(url, e))
+            results['events'].append(skipped_event(self, ds, url, e))
+        except (Exception, HBaseException), e:
+            e = check_error(
+                e, ds.device,
+                'hbase_regionserver_monitoring_error',
+                'zHBaseRegionServerPort'
+            ) or e
+            log.error("No access to page '{}': {}".format(url, e))
+
+    def onSuccess(self, result, config):
+        """
+        Remember the configuration of the region servers whose maps are
+        sent, so they are not sent again until it changes.
+        """
+        self._fingerprints.update(self._pending or {})
+        self._pending = None
+        return super(HBaseRegionServerConfPlugin, self).onSuccess(
+            result, config)
+
+    def onError(self, result, config):
+        """
+        Drop the fingerprints of the maps which were not sent, so they
+        are sent again next cycle.
+        """
+        self._pending = None
+        return super(HBaseRegionServerConfPlugin, self).onError(
+            result, config)
+
     def add_maps(self, result, ds):
         """
         Return a list of ObjectMaps with config properties updates
-        for this regionserver and all it's regions.
+        for this regionserver and all it's regions, if they changed.
         """
         oms = []
         conf = ConfWrapper(result)
+        if not self.conf_changed(conf, ds):
+            return oms
         oms.append(ObjectMap({
             "compname": "hbase_servers/{}".format(self.component),
             "modname": "Region Server conf",
@@ -153,14 +228,47 @@ class HBaseRegionServerConfPlugin(HBaseBasePlugin):
         # configuration as set in the region server's conf file.
         for region in ds.region_ids:
             oms.append(ObjectMap({
-                "compname": "hbase_servers/{}/regions/{}{}{}".format(
-                    ds.component, ds.component, NAME_SPLITTER, prepId(region)),
+                "compname": "hbase_servers/{}/regions/{}".format(
+                    ds.component, region),
                 "modname": "Region conf",
                 'memstore_flush_size': convToUnits(conf.memestore_flush_size),
                 'max_file_size': convToUnits(conf.max_file_size)
             }))
         return oms
 
+    def conf_changed(self, conf, ds):
+        """
+        Return True if the configuration properties of the region server
+        or the set of its regions changed since the maps were last sent,
+        or if they were sent more than zHBaseConfRefreshInterval seconds ago.
+        The new fingerprint is saved by onSuccess once the maps are sent.
+
+        @param conf: parsed region server configuration
+        @type conf: ConfWrapper
+        @param ds: device datasourse
+        @type ds: instance of PythonDataSourceConfig
+        @return: bool
+        """
+        key = (ds.device, ds.component)
+        fingerprint = hash((
+            conf.handler_count,
+            conf.memstore_upper_limit,
+            conf.memstore_lower_limit,
+            conf.logflush_interval,
+            conf.memestore_flush_size,
+            conf.max_file_size,
+            ds.check_zookeeper,
+            frozenset(ds.region_ids),
+        ))
+        now = time.time()
+        last = self._fingerprints.get(key)
+        if last and last[0] == fingerprint and \
+                now - last[1] < ds.zHBaseConfRefreshInterval:
+            return False
+        if self._pending is not None:
+            self._pending[key] = (fingerprint, now)
+        return True
+
 
 class RegionServerStatisticsJMXPlugin(HBaseBasePlugin):
     """
@@ -168,82 +276,187 @@ class RegionServerStatisticsJMXPlugin(HBaseBasePlugin):
     """
 
     proxy_attributes = HBaseBasePlugin.proxy_attributes + (
-        'region_ids',
         'title',
         'zHBaseRegionServerPort',
+        'zHBaseMaxConcurrentRequests',
+        'zHBaseMaxBackoff',
     )
 
     eventKey = 'hbase_regionserver_monitoring_error'
     eventClass = '/Net'
 
+    # (url, data points) -> (the bean queries which returned the data
+    # points, or None for the unfiltered document, time they were used)
+    _queries = {}
+
     @defer.inlineCallbacks
     def collect(self, config):
         """
         This method overrides the HBaseBasePlugin.collect method.
         """
         results = self.new_data()
-        for ds in config.datasources:
-            self.component = ds.component
-            headers = hbase_headers(
-                accept='application/json',
-                username=ds.zHBaseUsername,
-                passwd=ds.zHBasePassword
-            )
-            url = hbase_rest_url(
-                scheme=ds.zHBaseScheme,
-                port=ds.zHBaseRegionServerPort,
-                host=get_host(ds),
-                endpoint='/jmx'
-            )
-            try:
-                res = yield getPage(url, headers=headers)
+        yield run_concurrently(
+            config.datasources[0].zHBaseMaxConcurrentRequests,
+            lambda ds: self.collect_server(ds, results),
+            config.datasources
+        )
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def collect_server(self, ds, results):
+        """
+        Collect the statistics of a single region server into the results.
+        """
+        headers = hbase_headers(
+            accept='application/json',
+            username=ds.zHBaseUsername,
+            passwd=ds.zHBasePassword
+        )
+        url = hbase_rest_url(
+            scheme=ds.zHBaseScheme,
+            port=ds.zHBaseRegionServerPort,
+            host=get_host(ds),
+            endpoint='/jmx'
+        )
+        try:
+            results['values'][ds.component] = yield self.query_beans(
+                url, headers, ds)
+        except HostUnavailable, e:
+            log.debug("Skipping page '{}': {}".format(url, e))
+            results['events'].append(skipped_event(self, ds, url, e))
+        except (Exception, HBaseException), e:
+            e = check_error(
+                e, ds.device, self.eventKey,
+                'zHBaseRegionServerPort'
+            ) or e
+            msg = "No access to page '{}': {}".format(url, e)
+            results['events'].append({
+                'component': ds.component,
+                'summary': str(e),
+                'eventKey': self.eventKey,
+                'eventClass': self.eventClass,
+                'severity': ZenEventClasses.Error,
+            })
+            log.error(msg)
+
+    @defer.inlineCallbacks
+    def query_beans(self, url, headers, ds):
+        """
+        Request only the beans holding the statistics. Bean names differ
+        between HBase versions, so the queries are tried in turn, starting
+        from the ones which last worked for the server, until some of them
+        return the data points. The unfiltered document is the last resort.
+        It is requested at once for JMX_QUERY_RETRY_INTERVAL seconds, after
+        which the bean queries are tried again.
+        """
+        key = (url, tuple(sorted(p.id for p in ds.points)))
+        known, used = self._queries.get(key, (JMX_QUERIES[0], None))
+        if known is None and \
+                time.time() - used >= JMX_QUERY_RETRY_INTERVAL:
+            known = JMX_QUERIES[0]
+        for queries in (known,) + tuple(
+                q for q in JMX_QUERIES if q != known):
+            responses = []
+            for qry in queries or (None,):
+                res = yield fetch_server(self, jmx_url(url, qry), headers, ds)
                 if not res:
                     raise HBaseException('No monitoring data.')
-                results['values'][ds.component] = self.form_values(res, ds)
-            except (Exception, HBaseException), e:
-                e = check_error(
-                    e, ds.device, self.eventKey,
-                    'zHBaseRegionServerPort'
-                ) or e
-                msg = "No access to page '{}': {}".format(url, e)
-                results['events'].append({
-                    'component': self.component,
-                    'summary': str(e),
-                    'eventKey': self.eventKey,
-                    'eventClass': self.eventClass,
-                    'severity': ZenEventClasses.Error,
-                })
-                log.error(msg)
-        defer.returnValue(results)
+                responses.append(res)
+            values = self.form_values(responses, ds)
+            if values or queries is None:
+                self._queries[key] = (queries, time.time())
+                defer.returnValue(values)
 
-    def form_values(self, result, ds):
+    def form_values(self, results, ds):
         """
         Parse the results of the HBase datasource.
+
+        @param results: '/jmx' responses
+        @type results: list of str
+        @return: dict of datapoints
         """
-        # data points for different versions of HBase
-        points = {
-            'blockCacheEvictedCount': 'blockCacheEvictionCount',
-            'blockCacheHitCachingRatio': 'blockCacheExpressHitPercent',
-            'blockCacheHitRatio': 'blockCountHitPercent',
-            'callQueueLen': 'numCallsInGeneralQueue',
-            'compactionQueueSize': 'compactionQueueLength',
-            'flushQueueSize': 'flushQueueLength',
-        }
-        try:
-            data = json.loads(result)
-        except Exception:
-            raise HBaseException('Error parsing collected data.')
+        # attribute -> value over all the returned beans
+        index = {}
+        for result in results:
+            try:
+                data = json.loads(result)
+            except Exception:
+                raise HBaseException('Error parsing collected data.')
+            for bean in data.get('beans') or ():
+                index.update(
+                    (k, v) for k, v in bean.iteritems() if v is not None
+                )
 
         result = {}
         for point in ds.points:
-            for value in data.get('beans'):
-                if value.get(point.id) is not None:
-                    result[point.id] = (value[point.id], 'N')
-                elif value.get(points.get(point.id)) is not None:
-                    result[point.id] = (value[points[point.id]], 'N')
+            value = index.get(point.id)
+            if value is None:
+                value = index.get(JMX_POINTS.get(point.id))
+            if value is not None:
+                result[point.id] = (value, 'N')
         return result
 
 
+def jmx_url(url, qry):
+    """
+    Return the '/jmx' url restricted to the beans matching the query.
+    """
+    if qry is None:
+        return url
+    return '{}?qry={}'.format(url, quote(qry, safe=':,=*'))
+
+
+def fetch_server(plugin, url, headers, ds):
+    """
+    Request a region server page unless the server is reported dead in
+    the recent cluster status or its circuit breaker is open.
+
+    @return: Deferred, failing with HostUnavailable if the server
+        is skipped
+    """
+    status = SNAPSHOT_CACHE.peek(
+        snapshot_key(ds, HBaseBasePlugin.endpoint),
+        ttl=ds.cycletime * SNAPSHOT_FRESHNESS * 2
+    )
+    # A restarted server is both in the dead and live nodes.
+    if status and ds.component in status.dead_ids \
+            and ds.component not in status.nodes:
+        return defer.fail(HostUnavailable('Region server is dead'))
+    return CIRCUIT_BREAKER.call(
+        (get_host(ds), ds.zHBaseRegionServerPort),
+        lambda: plugin.fetch(url, headers, ds),
+        backoff=ds.cycletime,
+        max_backoff=ds.zHBaseMaxBackoff
+    )
+
+
+def server_event(plugin, ds, summary, severity):
+    """
+    Return an event of the plugin for the region server of the datasource.
+    """
+    return {
+        'component': ds.component,
+        'summary': summary,
+        'eventKey': plugin.eventKey,
+        'eventClass': plugin.eventClass,
+        'severity': severity,
+    }
+
+
+def skipped_event(plugin, ds, url, error):
+    """
+    Return the event of a region server skipped by fetch_server, which
+    replaces the event of the last request to the server and states why
+    it was not requested, i.e. the server is dead or backed off.
+
+    @param error: the reason the server was skipped
+    @type error: HostUnavailable
+    """
+    return server_event(
+        plugin, ds, "Skipped page '{}': {}".format(url, error),
+        ZenEventClasses.Warning)
+
+
 def get_host(ds):
     '''
     Check if component title contains 'localhost', if so,
@@ -9,22 +9,99 @@
 ######################################################################
 
 import json
+import time
 
 from logging import getLogger
 
-from twisted.web.client import getPage
 from twisted.internet import defer
 
 from Products.DataCollector.plugins.DataMaps import ObjectMap, RelationshipMap
 from Products.ZenEvents import ZenEventClasses
-from Products.ZenUtils.Utils import convToUnits
-from ZenPacks.zenoss.HBase.dsplugins.base_plugin import HBaseBasePlugin
+from Products.ZenUtils.Utils import convToUnits, prepId
+from ZenPacks.zenoss.HBase.dsplugins.base_plugin import (
+    HBaseBasePlugin, run_concurrently
+)
 from ZenPacks.zenoss.HBase.utils import (
-    hbase_rest_url, hbase_headers, matcher, HBaseException, check_error
+    hbase_rest_url, hbase_headers, HBaseException, check_error,
+    ClusterStatus, ClusterStatusReader, TableStateReader
 )
 
 log = getLogger('zen.HBasePlugins')
 
+# zHBaseTableStateMode values. The state read from table.jsp is the one
+# reported by HBase, the bulk mode only approximates it.
+BULK_MODE = 'bulk'
+TABLE_JSP_MODE = 'table.jsp'
+
+
+class SchemaCache(object):
+    """
+    Cache of the table schemas. A schema is reused for zHBaseSchemaCacheTTL
+    seconds unless the table state changes in the meantime.
+    """
+
+    def __init__(self):
+        # (device id, table) -> (timestamp, table state, schema)
+        self._schemas = {}
+        # device id -> [hits, misses]
+        self._stats = {}
+
+    def get(self, key, state, ttl):
+        """
+        Return the cached schema of the table or None if it is expired
+        or the table state has changed.
+
+        @param key: (device id, table) tuple
+        @type key: tuple
+        @param state: current table state
+        @type state: dict
+        @param ttl: seconds the schema is cached for
+        @type ttl: int
+        @return: str or None
+        """
+        stats = self._stats.setdefault(key[0], [0, 0])
+        entry = self._schemas.get(key)
+        if entry and entry[1] == state and time.time() - entry[0] < ttl:
+            stats[0] += 1
+            return entry[2]
+        stats[1] += 1
+        self._schemas.pop(key, None)
+
+    def cached(self, key, ttl):
+        """
+        Return True if a schema of the table is cached and not expired,
+        whatever the state it was cached in.
+
+        @param key: (device id, table) tuple
+        @type key: tuple
+        @param ttl: seconds the schema is cached for
+        @type ttl: int
+        @return: bool
+        """
+        entry = self._schemas.get(key)
+        return bool(entry and time.time() - entry[0] < ttl)
+
+    def set(self, key, state, schema):
+        """
+        Cache the schema of the table in the state.
+        """
+        self._schemas[key] = (time.time(), dict(state), schema)
+
+    def invalidate(self, key):
+        """
+        Drop the cached schema of the table.
+        """
+        self._schemas.pop(key, None)
+
+    def stats(self, device):
+        """
+        Return (hits, misses) counters of the device.
+        """
+        return tuple(self._stats.get(device, (0, 0)))
+
+
+SCHEMA_CACHE = SchemaCache()
+
 
 class HBaseTablePlugin(HBaseBasePlugin):
     """
@@ -32,7 +109,12 @@ class HBaseTablePlugin(HBaseBasePlugin):
     """
     endpoint = '/table.jsp?name={0}'
 
-    proxy_attributes = HBaseBasePlugin.proxy_attributes + ('zHBaseMasterPort',)
+    proxy_attributes = HBaseBasePlugin.proxy_attributes + (
+        'zHBaseMasterPort',
+        'zHBaseMaxConcurrentRequests',
+        'zHBaseTableStateMode',
+        'zHBaseSchemaCacheTTL',
+    )
 
     global_error = None
 
@@ -42,60 +124,183 @@ class HBaseTablePlugin(HBaseBasePlugin):
         This method overrides the HBaseBasePlugin.collect method.
         """
         results = self.new_data()
-        for ds in config.datasources:
-            self.component = ds.component
-            headers = hbase_headers(
-                accept='application/json',
-                username=ds.zHBaseUsername,
-                passwd=ds.zHBasePassword
-            )
-            # Get compaction and state of the table.
-            url = hbase_rest_url(
-                scheme=ds.zHBaseScheme,
-                port=ds.zHBaseMasterPort,
-                host=ds.manageIp,
-                endpoint=self.endpoint.format(self.component)
-            )
-            # Get column family information.
-            schema_url = hbase_rest_url(
-                scheme=ds.zHBaseScheme,
-                port=ds.zHBaseRestPort,
-                host=ds.manageIp,
-                endpoint='/{}/schema'.format(self.component)
+        self.global_error = None
+        ds0 = config.datasources[0]
+        if ds0.zHBaseTableStateMode == BULK_MODE:
+            yield self.collect_bulk(config, results)
+        else:
+            yield run_concurrently(
+                ds0.zHBaseMaxConcurrentRequests,
+                lambda ds: self.collect_table(ds, results),
+                config.datasources
             )
-            try:
-                # Check connection and collect data.
-                port = 'zHBaseMasterPort'
-                res = yield getPage(url, headers=headers)
-                port = 'zHBaseRestPort'
-                schema = yield getPage(schema_url, headers=headers)
-                if not res:
-                    raise HBaseException('No monitoring data.')
-                # Process data if was returned.
-                results['maps'].extend(self.add_maps(res, schema, ds))
-                results['events'].extend(self.get_events(res, ds))
-            except (Exception, HBaseException), e:
-                eventKey = 'hbase_table_monitoring_error'
-                if any(code in str(e) for code in ('404', '500')):
-                    summary = "The table '{0}' is broken or does not " \
-                        "exist".format(ds.component)
-                    component = ds.component
-                else:
-                    summary = str(check_error(e, ds.device, eventKey, port) or e)
-                    component = None
-                    self.global_error = True
-
-                results['events'].append({
-                    'component': component,
-                    'summary': summary,
-                    'eventKey': eventKey,
-                    'eventClass': '/Status',
-                    'severity': ZenEventClasses.Error,
-                })
-                if self.global_error:
-                    break
+        log.debug(
+            'Table schema cache of %s: %s hits, %s misses',
+            ds0.device, *SCHEMA_CACHE.stats(ds0.device))
         defer.returnValue(results)
 
+    @defer.inlineCallbacks
+    def collect_bulk(self, config, results):
+        """
+        Collect the state of all the tables from the REST gateway table
+        list and cluster status, which are shared with the device
+        datasources, and the schema of every table. The state is only
+        approximated, see table_states.
+        """
+        ds0 = config.datasources[0]
+        try:
+            (_, status), (_, tables) = yield defer.DeferredList([
+                self.get_snapshot(
+                    ds0, '/status/cluster', ClusterStatusReader,
+                    ClusterStatus),
+                self.get_snapshot(ds0, '/', lambda: None, lambda r: r),
+            ], fireOnOneErrback=True, consumeErrors=True)
+            if not status or not tables:
+                raise HBaseException('No monitoring data.')
+            states = table_states(status, json.loads(tables))
+        except (Exception, HBaseException), e:
+            if isinstance(e, defer.FirstError):
+                e = e.subFailure.value
+            self.table_error(e, ds0, results, 'zHBaseRestPort')
+            return
+        yield run_concurrently(
+            ds0.zHBaseMaxConcurrentRequests,
+            lambda ds: self.collect_schema(ds, states, results),
+            config.datasources
+        )
+
+    @defer.inlineCallbacks
+    def collect_schema(self, ds, states, results):
+        """
+        Collect the schema of a single table and add its state from
+        the states into the results.
+        """
+        if self.global_error:
+            return
+        try:
+            state = states.get(ds.component, {})
+            schema = yield self.get_schema(ds, state)
+            self.component = ds.component
+            results['maps'].extend(self.add_maps(state, schema, ds))
+            results['events'].extend(self.get_events(state, ds))
+        except (Exception, HBaseException), e:
+            self.table_error(e, ds, results, 'zHBaseRestPort')
+
+    @defer.inlineCallbacks
+    def collect_table(self, ds, results):
+        """
+        Collect the data of a single table into the results.
+        """
+        # Do not query the rest of the tables after a connection error.
+        if self.global_error:
+            return
+        headers = hbase_headers(
+            accept='application/json',
+            username=ds.zHBaseUsername,
+            passwd=ds.zHBasePassword
+        )
+        # Get compaction and state of the table.
+        url = hbase_rest_url(
+            scheme=ds.zHBaseScheme,
+            port=ds.zHBaseMasterPort,
+            host=ds.manageIp,
+            endpoint=self.endpoint.format(ds.component)
+        )
+        port = 'zHBaseMasterPort'
+        # The schema is requested along with the state, unless a cached
+        # one is likely to be used. It is requested after the state only
+        # if the state of a table with a cached schema changed.
+        pending = None
+        if not SCHEMA_CACHE.cached(
+                (ds.device, ds.component), ds.zHBaseSchemaCacheTTL):
+            pending = self.fetch_schema(ds)
+        try:
+            # Check connection and collect data.
+            res = yield self.fetch(url, headers, ds, TableStateReader())
+            port = 'zHBaseRestPort'
+            schema = yield self.get_schema(ds, res, pending)
+            pending = None
+            # Process data if was returned.
+            self.component = ds.component
+            results['maps'].extend(self.add_maps(res, schema, ds))
+            results['events'].extend(self.get_events(res, ds))
+        except (Exception, HBaseException), e:
+            if pending is not None:
+                # Only the error of the state request is reported.
+                pending.addErrback(lambda failure: None)
+            self.table_error(e, ds, results, port)
+
+    @defer.inlineCallbacks
+    def get_schema(self, ds, state, pending=None):
+        """
+        Return the column family information of the table from
+        SCHEMA_CACHE, requesting it from the REST gateway if the cached
+        one is expired or the table state changed.
+
+        @param ds: table datasource
+        @type ds: instance of PythonDataSourceConfig
+        @param state: current table state
+        @type state: dict
+        @param pending: deferred of the schema request already sent
+        @type pending: Deferred
+        @return: Deferred
+        """
+        key = (ds.device, ds.component)
+        schema = SCHEMA_CACHE.get(key, state, ds.zHBaseSchemaCacheTTL)
+        if schema is None:
+            schema = yield pending or self.fetch_schema(ds)
+            SCHEMA_CACHE.set(key, state, schema)
+        defer.returnValue(schema)
+
+    def fetch_schema(self, ds):
+        """
+        Request the column family information of the table from the
+        REST gateway.
+
+        @param ds: table datasource
+        @type ds: instance of PythonDataSourceConfig
+        @return: Deferred
+        """
+        headers = hbase_headers(
+            accept='application/json',
+            username=ds.zHBaseUsername,
+            passwd=ds.zHBasePassword
+        )
+        schema_url = hbase_rest_url(
+            scheme=ds.zHBaseScheme,
+            port=ds.zHBaseRestPort,
+            host=ds.manageIp,
+            endpoint='/{}/schema'.format(ds.component)
+        )
+        return self.fetch(schema_url, headers, ds)
+
+    def table_error(self, e, ds, results, port):
+        """
+        Add the event for the failed request of the table data. Only the
+        first connection error is reported, for the device.
+        """
+        eventKey = 'hbase_table_monitoring_error'
+        if any(code in str(e) for code in ('404', '500')):
+            SCHEMA_CACHE.invalidate((ds.device, ds.component))
+            summary = "The table '{0}' is broken or does not " \
+                "exist".format(ds.component)
+            component = ds.component
+        elif self.global_error:
+            # The error is already reported for the device.
+            return
+        else:
+            summary = str(check_error(e, ds.device, eventKey, port) or e)
+            component = None
+            self.global_error = True
+
+        results['events'].append({
+            'component': component,
+            'summary': summary,
+            'eventKey': eventKey,
+            'eventClass': '/Status',
+            'severity': ZenEventClasses.Error,
+        })
+
     def onSuccess(self, result, config):
         """
         Return data structure with events, values and maps.
@@ -118,13 +323,16 @@ class HBaseTablePlugin(HBaseBasePlugin):
     def add_maps(self, result, schema, ds):
         """
         Return a list of ObjectMaps with properties updates for each table.
+
+        @param result: table state from TableStateReader or table_states
+        @type result: dict
         """
         schema = json.loads(schema)
         return [ObjectMap({
             "compname": "hbase_tables/%s" % self.component,
             "modname": "HBase table state",
-            "enabled": matcher(result, r'.+<td>Enabled</td><td>(\w+)</td>'),
-            "compaction": matcher(result, r'.+<td>Compaction</td><td>(\w+)</td>'),
+            "enabled": result.get('enabled', ''),
+            "compaction": result.get('compaction', ''),
             "number_of_col_families": len(schema.get('ColumnSchema')),
             "col_family_block_size": _block_size(schema.get('ColumnSchema')),
         })]
@@ -133,8 +341,11 @@ class HBaseTablePlugin(HBaseBasePlugin):
         """
         Return a list of event dictionaries informing about the health
         of the table.
+
+        @param result: table state from TableStateReader or table_states
+        @type result: dict
         """
-        enabled = matcher(result, r'.+<td>Enabled</td><td>(\w+)</td>')
+        enabled = result.get('enabled', '')
         summary = 'Monitoring ok'
         if enabled != 'true':
             summary = "The table '{0}' is disabled".format(self.component)
@@ -152,6 +363,37 @@ class HBaseTablePlugin(HBaseBasePlugin):
         }]
 
 
+def table_states(status, tables):
+    """
+    Return the approximate state of all the tables in the REST gateway
+    table list. A table is taken as enabled if any of its regions is
+    online, so an enabled table whose regions are all in transition or
+    on dead region servers is reported as disabled. A table is taken as
+    compacting if any of its regions has fewer KVs compacted than there
+    are to compact, and its compaction is either 'COMPACTING' or 'NONE'
+    rather than the values of table.jsp.
+
+    @param status: cluster status
+    @type status: ClusterStatus
+    @param tables: decoded REST gateway table list
+    @type tables: dict
+    @return: dict of table component id -> dict with 'enabled' and
+        'compaction'
+    """
+    states = dict(
+        (prepId(table['name']), {'enabled': 'false', 'compaction': 'NONE'})
+        for table in tables.get('table') or ()
+    )
+    for region in status.region_metrics.itervalues():
+        table = prepId(region['name'].decode('base64').split(',')[0])
+        if table not in states:
+            continue
+        states[table]['enabled'] = 'true'
+        if region['totalCompactingKVs'] > region['currentCompactedKVs']:
+            states[table]['compaction'] = 'COMPACTING'
+    return states
+
+
 def _block_size(column_families):
     """
     Return the value for column family block size property.
@@ -8,12 +8,11 @@
 #
 ######################################################################
 
+import collections
 
 from zope.component import adapts
 from zope.interface import implements
 
-from Products.ZenRelations.ToManyRelationship import ToManyRelationshipBase
-from Products.ZenRelations.ToOneRelationship import ToOneRelationship
 from Products.ZenUtils.guid.interfaces import IGlobalIdentifier
 
 from ZenPacks.zenoss.Impact.impactd import Trigger
@@ -26,6 +25,14 @@ PERCENT = 'policyPercentageTrigger'
 THRESHOLD = 'policyThresholdTrigger'
 RP = 'ZenPacks.zenoss.HBase'
 
+# Number of devices the impact edges are cached for.
+CACHED_DEVICES = 100
+
+# Device guid -> (last change of the device, component guid -> list of
+# (source guid, impacted guid) edges of the component), least recently
+# used first.
+_device_edges = collections.OrderedDict()
+
 
 def guid(obj):
     return IGlobalIdentifier(obj).getGUID()
@@ -35,6 +42,57 @@ def edge(source, target):
     return ImpactEdge(source, target, RP)
 
 
+def device_edges(device):
+    """
+    Return the impact edges of all the HBase components of the device.
+    They are computed in one traversal of the device, getting the guid
+    of every component once, and are cached until the device changes.
+    Modeling, the region moves and the table relation updates all set
+    the last change of the device. Only the CACHED_DEVICES devices used
+    last are kept.
+
+    @param device: device hosting HBase
+    @type device: Device
+    @return: dict of component guids to lists of (source guid, impacted
+        guid) edges
+    """
+    key = guid(device)
+    last_change = device.getLastChange()
+    cached = _device_edges.pop(key, None)
+    if cached and cached[0] == last_change:
+        _device_edges[key] = cached
+        return cached[1]
+
+    edges = collections.defaultdict(list)
+    # Region servers are impacted by ZooKeepers, if there are any on the
+    # device, instead of the device itself.
+    hosts = [device]
+    if hasattr(device, 'zookeepers') and device.zookeepers():
+        hosts = device.zookeepers()
+    host_guids = [guid(host) for host in hosts]
+    table_guids = dict(
+        (table.id, guid(table)) for table in device.hbase_tables())
+
+    for server in device.hbase_servers():
+        server_guid = guid(server)
+        for host_guid in host_guids:
+            edges[server_guid].append((host_guid, server_guid))
+        for region in server.regions():
+            region_guid = guid(region)
+            edges[server_guid].append((server_guid, region_guid))
+            edges[region_guid].append((server_guid, region_guid))
+            table_guid = table_guids.get(region.getTableId())
+            if table_guid:
+                edges[region_guid].append((region_guid, table_guid))
+                edges[table_guid].append((region_guid, table_guid))
+
+    edges = dict(edges)
+    _device_edges[key] = (last_change, edges)
+    while len(_device_edges) > CACHED_DEVICES:
+        _device_edges.popitem(last=False)
+    return edges
+
+
 def getRedundancyTriggers(guid, format, **kwargs):
     """Return a general redundancy set of triggers."""
 
@@ -74,8 +132,6 @@ class BaseRelationsProvider(object):
     implements(IRelationshipDataProvider)
 
     relationship_provider = RP
-    impact_relationships = None
-    impacted_by_relationships = None
 
     def __init__(self, adapted):
         self._object = adapted
@@ -89,47 +145,14 @@ class BaseRelationsProvider(object):
 
         return self._guid
 
-    def impact(self, relname):
-        relationship = getattr(self._object, relname, None)
-        if relationship:
-            if isinstance(relationship, ToOneRelationship):
-                obj = relationship()
-                if obj:
-                    yield edge(self.guid(), guid(obj))
-
-            elif isinstance(relationship, ToManyRelationshipBase):
-                for obj in relationship():
-                    yield edge(self.guid(), guid(obj))
-
-    def impacted_by(self, relname):
-        relationship = getattr(self._object, relname, None)
-        if relationship:
-            if isinstance(relationship, ToOneRelationship):
-                obj = relationship()
-                if obj:
-                    yield edge(guid(obj), self.guid())
-
-            elif isinstance(relationship, ToManyRelationshipBase):
-                for obj in relationship():
-                    yield edge(guid(obj), self.guid())
-
     def getEdges(self):
-        device = self._object.device()
-        if self.impact_relationships is not None:
-            for impact_relationship in self.impact_relationships:
-                for impact in self.impact(impact_relationship):
-                    yield impact
-
-        if self.impacted_by_relationships is not None:
-            for impacted_by_relationship in self.impacted_by_relationships:
-                # Check if zookeeper component is on device and
-                # use it instead 'hbase host'
-                if impacted_by_relationship == 'hbase_host' and\
-                        hasattr(device, 'zookeepers') and\
-                        getattr(device, 'zookeepers')():
-                    impacted_by_relationship = 'zookeepers'
-                for impacted_by in self.impacted_by(impacted_by_relationship):
-                    yield impacted_by
+        """
+        Return the edges of the component from the edges of all the
+        HBase components of its device.
+        """
+        edges = device_edges(self._object.device())
+        for source, impacted in edges.get(self.guid(), ()):
+            yield edge(source, impacted)
 
 
 class BaseTriggers(object):
@@ -143,35 +166,19 @@ class BaseTriggers(object):
 # Impact relationships
 
 class HBaseRegionServerRelationsProvider(BaseRelationsProvider):
-    impacted_by_relationships = ['hbase_host']
-    impact_relationships = ['regions']
+    """
+    Region servers are impacted by the hosting device or its ZooKeepers
+    and impact their regions.
+    """
 
 
 class HBaseHRegionRelationsProvider(BaseRelationsProvider):
-    impacted_by_relationships = ['server']
-
-    def getEdges(self):
-        for impact in super(HBaseHRegionRelationsProvider, self).getEdges():
-            yield impact
-        component = self._object
-        # Add impact 'table' relation for region
-        for hbt in component.hbase_tables():
-            if hbt.id == component.table:
-                yield edge(self.guid(), guid(hbt))
+    """
+    Regions are impacted by their region servers and impact their tables.
+    """
 
 
 class HBaseTableRelationsProvider(BaseRelationsProvider):
-
-    def getEdges(self):
-        for impact in super(HBaseTableRelationsProvider, self).getEdges():
-            yield impact
-
-        component = self._object
-        # Get all regions from all region servers
-        regions = [
-            r for s in component.device().hbase_servers() for r in s.regions()
-        ]
-        # Add impacted by 'region' relation for tables
-        for hbr in regions:
-            if hbr.table == component.id:
-                yield edge(guid(hbr), self.guid())
+    """
+    Tables are impacted by their regions.
+    """
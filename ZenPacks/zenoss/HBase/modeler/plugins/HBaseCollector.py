@@ -15,16 +15,16 @@ import zope.component
 
 from itertools import chain
 from twisted.internet import defer
-from twisted.web.client import getPage
 
 from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
 from Products.DataCollector.plugins.DataMaps import ObjectMap, RelationshipMap
 from Products.ZenCollector.interfaces import IEventService
 from Products.ZenUtils.Utils import prepId, convToUnits
-from ZenPacks.zenoss.HBase import MODULE_NAME, NAME_SPLITTER
+from ZenPacks.zenoss.HBase import MODULE_NAME
+from ZenPacks.zenoss.HBase.client import fetch
 from ZenPacks.zenoss.HBase.utils import (
     hbase_rest_url, hbase_headers, dead_node_name,
-    ConfWrapper, version_diff, check_error
+    ConfWrapper, ClusterStatus, ClusterStatusReader, check_error
 )
 
 
@@ -42,7 +42,10 @@ class HBaseCollector(PythonPlugin):
         'zHBaseUsername',
         'zHBasePassword',
         'zHBaseRestPort',
-        'zHBaseMasterPort'
+        'zHBaseMasterPort',
+        'zHBaseMaxConnectionsPerHost',
+        'zHBaseConnectionIdleTimeout',
+        'zHBaseModelingTimeout',
     )
 
     @defer.inlineCallbacks
@@ -73,20 +76,48 @@ class HBaseCollector(PythonPlugin):
             username=device.zHBaseUsername,
             passwd=device.zHBasePassword
         )
-        try:
-            result['status'] = yield getPage(status_url, headers=headers)
-            result['conf'] = yield getPage(conf_url, headers=headers)
-            result['tables'] = yield getPage(table_url, headers=headers)
-        except Exception, f:
-            self.on_error(log, device, f)
+        # The whole cluster status, configuration and table list take
+        # much longer to receive from a large cluster than the responses
+        # polled by the datasources, hence a separate timeout.
+        settings = dict(
+            headers=headers,
+            max_connections=device.zHBaseMaxConnectionsPerHost,
+            idle_timeout=device.zHBaseConnectionIdleTimeout,
+            timeout=device.zHBaseModelingTimeout
+        )
+        responses = yield defer.DeferredList([
+            fetch(status_url, reader=ClusterStatusReader(), **settings),
+            fetch(conf_url, **settings),
+            fetch(table_url, **settings),
+        ], consumeErrors=True)
 
-        self.on_success(log, device)
+        # Model whatever was collected if some of the requests failed.
+        failures = []
+        for key, (success, response) in zip(
+                ('status', 'conf', 'tables'), responses):
+            result[key] = response if success else None
+            if not success:
+                failures.append(response)
+        if len(failures) == len(responses):
+            self.on_error(log, device, failures[0])
+        elif failures:
+            self.on_partial_success(log, device, failures)
+        else:
+            self.on_success(log, device)
         defer.returnValue(result)
 
     def on_success(self, log, device):
         log.debug('Successfull modeling')
         self._send_event("Successfull modeling", device.id, 0)
 
+    def on_partial_success(self, log, device, failures):
+        errors = '; '.join(
+            str(check_error(f.value, device.id) or f.value) for f in failures
+        )
+        log.warn('Partial modeling: %s', errors)
+        self._send_event(
+            'Partial modeling: {}'.format(errors), device.id, 3)
+
     def on_error(self, log, device, failure):
         try:
             e = failure.value
@@ -103,6 +134,7 @@ class HBaseCollector(PythonPlugin):
         )
 
         maps = collections.OrderedDict([
+            ('changes', []),
             ('hbase_servers', []),
             ('hbase_tables', []),
             ('regions', []),
@@ -110,26 +142,39 @@ class HBaseCollector(PythonPlugin):
         ])
 
         # If results.conf is None, it means that the methos is called from
-        # monitoring plugin and the conf properties do not need to be updated.
+        # monitoring plugin or the conf request failed, and the conf
+        # properties do not need to be updated.
         try:
             conf = ConfWrapper(results['conf']) if results['conf'] else None
-            data = json.loads(results['status'])
-            tables = json.loads(results['tables'])
+            # The monitoring plugin passes already parsed status.
+            data = results['status']
+            if not isinstance(data, ClusterStatus):
+                data = ClusterStatus(data)
+            tables = json.loads(results['tables']) \
+                if results['tables'] else None
         except ValueError:
             log.error('HBaseCollector: Error parsing collected data')
             return
 
         # List of servers
         server_oms = []
+        live_servers = []
+        moved = {}
+        region_tables = {}
         if data:
-            for node in version_diff(data["LiveNodes"]):
+            for node in data.live:
                 node_id = prepId(node['name'])
                 server_oms.append(self._node_om(node, conf, True))
+                live_servers.append(self._node_attributes(node, conf, True))
+                moved.update(
+                    (prepId(region['name']), node_id)
+                    for region in node["Region"])
 
                 # List of regions
                 region_oms = []
                 for region in node["Region"]:
                     region_oms.append(self._region_om(region, node_id, conf))
+                region_tables.update(self._region_tables(node["Region"]))
 
                 maps['regions'].append(RelationshipMap(
                     compname='hbase_servers/%s' % node_id,
@@ -137,9 +182,20 @@ class HBaseCollector(PythonPlugin):
                     modname=MODULE_NAME['HBaseHRegion'],
                     objmaps=region_oms))
 
-            for node in version_diff(data["DeadNodes"]):
+            for node in data.dead:
                 server_oms.append(self._node_om(node, conf))
 
+            # Move the regions modeled on another region server before
+            # the region server maps are applied, so that they keep
+            # their identity rather than being deleted with their old
+            # region server and created again.
+            maps['changes'].append(ObjectMap({
+                'setRegionServerChanges': {
+                    'add': live_servers,
+                    'move': moved,
+                },
+            }))
+
             maps['hbase_servers'].append(RelationshipMap(
                 relname='hbase_servers',
                 modname=MODULE_NAME['HBaseRegionServer'],
@@ -156,10 +212,16 @@ class HBaseCollector(PythonPlugin):
                 modname=MODULE_NAME['HBaseTable'],
                 objmaps=tables_oms))
 
-        # Clear non-existing component events.
-        maps['device'].append(ObjectMap({
-            'getClearEvents': True
-        }))
+        # Relate the regions to their tables at once, clear non-existing
+        # component events and bind the HBaseCluster monitoring template
+        # if it is not bound yet. Not done if the status request failed,
+        # as the components are not known then.
+        if data:
+            maps['device'].append(ObjectMap({
+                'setRegionTables': region_tables,
+                'setClearEvents': data.fingerprint,
+                'setHBaseClusterTemplate': True,
+            }))
 
         log.info(
             'Modeler %s finished processing data for device %s',
@@ -169,6 +231,10 @@ class HBaseCollector(PythonPlugin):
 
     def _node_om(self, node, conf, is_alive=False):
         """Builds HBase Region Server object map"""
+        return ObjectMap(self._node_attributes(node, conf, is_alive))
+
+    def _node_attributes(self, node, conf, is_alive=False):
+        """Builds HBase Region Server attributes"""
         if is_alive:
             title, start_code = (node['name'], node['startCode'])
         else:
@@ -188,18 +254,20 @@ class HBaseCollector(PythonPlugin):
                 'memstore_lower_limit': conf.memstore_lower_limit,
                 'logflush_interval': conf.logflush_interval
             })
-        return ObjectMap(object_map)
+        return object_map
 
     def _region_om(self, region, node_id, conf):
         """Builds HBase Region object map"""
         table, start_key, r_id = region['name'].decode('base64').split(',')
         object_map = {
-            'id': node_id + NAME_SPLITTER + prepId(region['name']),
+            # Region ids do not depend on the region server, so the
+            # components survive the region moves.
+            'id': prepId(region['name']),
             'title': region['name'].decode('base64'),
             'table': table,
             'start_key': start_key.encode('string-escape'),
             'region_id': r_id,
-            'region_hash': region['name']
+            'region_hash': region['name'],
         }
         # If called not from monitoring plugin.
         if conf:
@@ -209,6 +277,14 @@ class HBaseCollector(PythonPlugin):
             })
         return ObjectMap(object_map)
 
+    def _region_tables(self, regions):
+        """Returns ids of the tables of the regions by the region ids"""
+        return dict(
+            (prepId(region['name']),
+             prepId(region['name'].decode('base64').split(',')[0]))
+            for region in regions
+        )
+
     def _table_om(self, table):
         """Builds HBase Region Server object map"""
 
@@ -0,0 +1,178 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2014, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+import logging
+log = logging.getLogger('zen.HBaseTest')
+
+import gzip
+import time
+import zlib
+
+from StringIO import StringIO
+
+from mock import patch
+
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.error import Error
+from twisted.web.http_headers import Headers
+
+from Products.ZenTestCase.BaseTestCase import BaseTestCase
+
+from ZenPacks.zenoss.HBase import client
+from ZenPacks.zenoss.HBase.utils import ClusterStatusReader, TableStateReader
+
+
+class FakeTransport(object):
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class FakeResponse(object):
+    """
+    Response delivering the body in the given chunks.
+    """
+    def __init__(self, code, phrase, chunks, encoding=None):
+        self.code = code
+        self.phrase = phrase
+        self.chunks = chunks
+        self.headers = Headers()
+        if encoding:
+            self.headers.setRawHeaders('Content-Encoding', [encoding])
+
+    def deliverBody(self, protocol):
+        self.transport = FakeTransport()
+        protocol.makeConnection(self.transport)
+        for chunk in self.chunks:
+            if self.transport.stopped:
+                break
+            protocol.dataReceived(chunk)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+def split(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def gzipped(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+class TestClient(BaseTestCase):
+
+    def test_read_body(self):
+        results = []
+        response = FakeResponse(200, 'OK', ['{"regions": ', '2}'])
+        client.read_body(response).addCallback(results.append)
+        self.assertEquals(results, ['{"regions": 2}'])
+
+    def test_read_body_reader(self):
+        results = []
+        response = FakeResponse(200, 'OK', ['{"regions": ', '2, "a": 1}'])
+        client.read_body(response, ClusterStatusReader()).addCallback(
+            results.append)
+        self.assertEquals(results, [{'regions': 2}])
+
+    def test_read_body_reader_error(self):
+        errors = []
+        response = FakeResponse(200, 'OK', ['{"regions": ', '2, "a": '])
+        client.read_body(response, ClusterStatusReader()).addErrback(
+            errors.append)
+        self.assertTrue(errors[0].check(ValueError))
+
+    def test_read_body_reader_done(self):
+        client.counters['since'] = time.time()
+        decoded = client.counters['decoded_bytes']
+        results = []
+        response = FakeResponse(200, 'OK', [
+            '<h2>Table Attributes</h2><table>',
+            '<tr><td>Enabled</td><td>true</td></tr></table>',
+            '<h2>Table Regions</h2>',
+        ])
+        client.read_body(response, TableStateReader()).addCallback(
+            results.append)
+        self.assertEquals(results, [{'enabled': 'true', 'compaction': ''}])
+        # The rest of the body is drained, keeping the connection open.
+        self.assertFalse(response.transport.stopped)
+        self.assertEquals(
+            client.counters['decoded_bytes'] - decoded,
+            sum(len(chunk) for chunk in response.chunks[:2]))
+
+    def test_read_body_error(self):
+        errors = []
+        response = FakeResponse(404, 'Not Found', ['missing'])
+        client.read_body(response).addErrback(errors.append)
+        self.assertTrue(errors[0].check(Error))
+        self.assertEquals(str(errors[0].value), '404 Not Found')
+
+    def test_read_body_gzip(self):
+        body = '{"regions": 2, "requests": 0}' * 100
+        for encoding in ('gzip', 'x-gzip'):
+            data = gzipped(body)
+            # The counters are not reset by a report during the test.
+            client.counters['since'] = time.time()
+            results = []
+            received = client.counters['received_bytes']
+            decoded = client.counters['decoded_bytes']
+            response = FakeResponse(200, 'OK', split(data, 7), encoding)
+            client.read_body(response).addCallback(results.append)
+            self.assertEquals(results, [body])
+            self.assertEquals(
+                client.counters['received_bytes'] - received, len(data))
+            self.assertEquals(
+                client.counters['decoded_bytes'] - decoded, len(body))
+
+    def test_report_counters(self):
+        client.counters.update(
+            received_bytes=250, decoded_bytes=1000, since=time.time())
+        with patch('ZenPacks.zenoss.HBase.client.log') as client_log:
+            client.report_counters()
+            self.assertFalse(client_log.debug.called)
+            client.counters['since'] -= client.REPORT_INTERVAL
+            client.report_counters()
+        received, seconds, decoded, saved = client_log.debug.call_args[0][1:]
+        self.assertEquals((received, decoded, saved), (250, 1000, 75.0))
+        self.assertTrue(seconds >= client.REPORT_INTERVAL)
+        self.assertEquals(client.counters['received_bytes'], 0)
+        self.assertEquals(client.counters['decoded_bytes'], 0)
+
+    def test_read_body_gzip_reader(self):
+        data = gzipped('{"regions": 2, "a": 1}')
+        results = []
+        response = FakeResponse(200, 'OK', split(data, 3), 'gzip')
+        client.read_body(response, ClusterStatusReader()).addCallback(
+            results.append)
+        self.assertEquals(results, [{'regions': 2}])
+
+    def test_read_body_gzip_error(self):
+        errors = []
+        response = FakeResponse(200, 'OK', ['not compressed'], 'gzip')
+        client.read_body(response).addErrback(errors.append)
+        self.assertTrue(errors[0].check(zlib.error))
+
+    def test_get_pool(self):
+        pool = client.get_pool(2, 60)
+        self.assertEquals(pool.maxPersistentPerHost, 2)
+        self.assertEquals(pool.cachedConnectionTimeout, 60)
+        self.assertTrue(pool.persistent)
+        self.assertTrue(pool is client.get_pool(2, 60))
+        self.assertFalse(pool is client.get_pool(4, 60))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestClient))
+    return suite
@@ -10,13 +10,31 @@
 import logging
 log = logging.getLogger('zen.HBaseTest')
 
+import cPickle
+import json
+import time
+
 from mock import Mock, patch, sentinel
 
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web.error import Error
+
+from Products.ZenEvents import ZenEventClasses
 from Products.ZenTestCase.BaseTestCase import BaseTestCase
 from Products.ZenUtils.Utils import prepId
+import ZenPacks.zenoss.HBase as zenpack
 import ZenPacks.zenoss.HBase.dsplugins as dsplugins
-from ZenPacks.zenoss.HBase import NAME_SPLITTER
 from ZenPacks.zenoss.HBase.tests.utils import test_device, load_data
+from ZenPacks.zenoss.HBase.utils import (
+    ClusterStatus, HostUnavailable, TableStateReader, region_digest
+)
+
+
+def read_page(page):
+    reader = TableStateReader()
+    reader.feed(page)
+    return reader.close()
 
 
 class TestHBaseMasterPlugin(BaseTestCase):
@@ -28,12 +46,11 @@ class TestHBaseMasterPlugin(BaseTestCase):
         self.plugin = dsplugins.HBaseMasterPlugin()
 
     def test_get_events(self):
-        data = load_data('HBaseCollector.json')
+        data = ClusterStatus(load_data('HBaseCollector.json'))
         self.plugin.component = 'localhost_11111'
         ds = Mock()
         ds.component = sentinel.component
-        ds.regionserver_ids = ['test']
-        ds.region_ids = ['test']
+        ds.server_digests = {'test': ('Up', region_digest([]))}
         self.plugin.process(data)
         self.plugin.add_maps(data, ds)
         result = self.plugin.get_events(data, ds)
@@ -44,7 +61,10 @@ class TestHBaseMasterPlugin(BaseTestCase):
             'summary': "Region server 'localhost:44451' is added"
         }, result)
         # Check event for removed server.
-        ds.regionserver_ids = ['localhost_11111', 'test']
+        ds.server_digests = {
+            'localhost_11111': ('Down', region_digest([])),
+            'test': ('Up', region_digest([])),
+        }
         self.plugin.add_maps(data, ds)
         self.assertIn({
             'eventClass': '/Status',
@@ -52,8 +72,72 @@ class TestHBaseMasterPlugin(BaseTestCase):
             'summary': "Region server 'test' is removed"
         }, self.plugin.get_events(data, ds))
 
+    def test_add_maps(self):
+        data = ClusterStatus(load_data('HBaseCollector.json'))
+        ds = Mock()
+        ds.server_digests = {
+            'localhost_11111': ('Down', region_digest([])),
+            'localhost_44451': ('Up', region_digest(['LVJPT1QtLCww'])),
+        }
+        # Nothing changed, only clear events.
+        maps = self.plugin.add_maps(data, ds)
+        self.assertEquals(len(maps), 1)
+        self.assertEquals(maps[0].setClearEvents, data.fingerprint)
+
+        # Remodel regions of the changed server only.
+        ds.server_digests['localhost_44451'] = ('Up', region_digest(['test']))
+        ds.server_digests['test'] = ('Up', region_digest(['test']))
+        maps = self.plugin.add_maps(data, ds)
+        self.assertEquals(maps[0].setRegionServerChanges, {
+            'add': [],
+            'move': {'LVJPT1QtLCww': 'localhost_44451'},
+            'remove': ['test'],
+        })
+        self.assertEquals(maps[1].compname, 'hbase_servers/localhost_44451')
+        self.assertEquals(maps[1].is_alive, 'Up')
+        self.assertFalse(hasattr(maps[1], 'id'))
+        self.assertEquals(maps[2].compname, 'hbase_servers/localhost_44451')
+        self.assertEquals(maps[2].relname, 'regions')
+        self.assertEquals(
+            [om.region_hash for om in maps[2].maps], ['LVJPT1QtLCww'])
+        self.assertEquals(
+            maps[3].setRegionTables, {'LVJPT1QtLCww': prepId('-ROOT-')})
+        self.assertEquals(len(maps), 4)
+
+        # Add the new server before mapping its regions.
+        del ds.server_digests['localhost_44451']
+        maps = self.plugin.add_maps(data, ds)
+        added = maps[0].setRegionServerChanges['add']
+        self.assertEquals([s['id'] for s in added], ['localhost_44451'])
+        self.assertEquals(added[0]['is_alive'], 'Up')
+        self.assertEquals(maps[1].compname, 'hbase_servers/localhost_44451')
+        self.assertEquals(maps[1].relname, 'regions')
+        self.assertEquals(self.plugin.added, ['localhost_44451'])
+        self.assertEquals(self.plugin.removed, ['test'])
+
+    def test_add_maps_moved_region(self):
+        data = ClusterStatus(load_data('HBaseCollector.json'))
+        ds = Mock()
+        ds.server_digests = {
+            'localhost_11111': ('Down', region_digest([])),
+            'localhost_44451': ('Up', region_digest([])),
+            'test': ('Up', region_digest(['LVJPT1QtLCww'])),
+        }
+        maps = self.plugin.add_maps(data, ds)
+        # The region is moved before its old server is removed, and
+        # is updated in place on the new one.
+        self.assertEquals(maps[0].setRegionServerChanges, {
+            'add': [],
+            'move': {'LVJPT1QtLCww': 'localhost_44451'},
+            'remove': ['test'],
+        })
+        region_map = maps[2]
+        self.assertEquals(region_map.compname, 'hbase_servers/localhost_44451')
+        self.assertEquals(
+            [om.id for om in region_map.maps], ['LVJPT1QtLCww'])
+
     def test_process(self):
-        data = load_data('HBaseCollector.json')
+        data = ClusterStatus(load_data('HBaseCollector.json'))
         result = self.plugin.process(data)
         self.assertEquals(result.get('average_load'), (2.0, 'N'))
         self.assertEquals(result.get('live_servers'), (1, 'N'))
@@ -101,7 +185,7 @@ class TestHBaseRegionServerPlugin(BaseTestCase):
         self.plugin = dsplugins.HBaseRegionServerPlugin()
 
     def test_process(self):
-        data = load_data('HBaseCollector.json')
+        data = ClusterStatus(load_data('HBaseCollector.json'))
         self.plugin.component = 'localhost_44451'
         result = self.plugin.process(data)
         self.assertEquals(result.get('max_heap_mb'), (997, 'N'))
@@ -117,7 +201,7 @@ class TestHBaseRegionServerPlugin(BaseTestCase):
         self.assertEquals(result.get('write_requests'), (1, 'N'))
 
     def test_get_events(self):
-        data = load_data('HBaseCollector.json')
+        data = ClusterStatus(load_data('HBaseCollector.json'))
         self.plugin.component = 'localhost_11111'
         ds = Mock()
         ds.component = sentinel.component
@@ -142,11 +226,342 @@ class TestHBaseRegionServerPlugin(BaseTestCase):
         }, self.plugin.get_events(data, ds))
 
     def test_add_maps(self):
-        data = load_data('HBaseCollector.json')
+        data = ClusterStatus(load_data('HBaseCollector.json'))
         result = self.plugin.add_maps(data, sentinel.ds)
         self.assertEquals(result, [])
 
 
+class TestHBaseRegionServerConfPlugin(BaseTestCase):
+
+    def afterSetUp(self):
+        super(TestHBaseRegionServerConfPlugin, self).afterSetUp()
+        self.plugin = dsplugins.HBaseRegionServerConfPlugin()
+        self.plugin._fingerprints.clear()
+        self.ds = Mock()
+        self.ds.device = 'hbase.testDevice'
+        self.ds.component = self.plugin.component = 'localhost_44451'
+        self.ds.region_ids = ['LVJPT1QtLCww']
+        self.ds.check_zookeeper = None
+        self.ds.zHBaseConfRefreshInterval = 3600
+
+    def test_add_maps(self):
+        data = load_data('HBaseRegionServerDump.txt')
+        result = self.plugin.add_maps(data, self.ds)
+        self.assertEquals(len(result), 2)
+        self.assertEquals(result[0].handler_count, '10')
+        self.assertEquals(result[1].max_file_size, '10.0GB')
+
+    def send_maps(self, data, sent=True):
+        """
+        Return the maps of a collection, which are sent or failed.
+        """
+        self.plugin._pending = {}
+        maps = self.plugin.add_maps(data, self.ds)
+        if sent:
+            self.plugin.onSuccess(self.plugin.new_data(), sentinel.config)
+        else:
+            self.plugin.onError('test', sentinel.config)
+        return maps
+
+    def test_add_maps_unchanged(self):
+        data = load_data('HBaseRegionServerDump.txt')
+        self.assertTrue(self.send_maps(data))
+        # Nothing changed.
+        self.assertEquals(self.send_maps(data), [])
+        # Region added.
+        self.ds.region_ids = ['LVJPT1QtLCww', 'test']
+        self.assertEquals(len(self.send_maps(data)), 3)
+        # Configuration changed.
+        data = data.replace('<value>10</value>', '<value>20</value>')
+        self.assertEquals(len(self.send_maps(data)), 3)
+        # Forced refresh.
+        self.ds.zHBaseConfRefreshInterval = 0
+        self.assertEquals(len(self.send_maps(data)), 3)
+
+    def test_add_maps_not_sent(self):
+        data = load_data('HBaseRegionServerDump.txt')
+        self.assertTrue(self.send_maps(data, sent=False))
+        # The maps are sent again after a failed collection.
+        self.assertTrue(self.send_maps(data))
+        self.assertEquals(self.send_maps(data), [])
+
+
+class TestRegionServerStatisticsJMXPlugin(BaseTestCase):
+
+    def afterSetUp(self):
+        super(TestRegionServerStatisticsJMXPlugin, self).afterSetUp()
+        self.plugin = dsplugins.RegionServerStatisticsJMXPlugin()
+        self.plugin._queries = {}
+        patcher = patch(
+            'ZenPacks.zenoss.HBase.dsplugins.regionserver_plugins.'
+            'CIRCUIT_BREAKER', dsplugins.base_plugin.CircuitBreaker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_collect(self):
+        point = Mock()
+        point.id = 'compactionQueueSize'
+        config = Mock()
+        config.datasources = []
+        for server in ('server1', 'server2', 'server3'):
+            ds = Mock()
+            ds.component = ds.title = server
+            ds.points = [point]
+            ds.zHBaseMaxConcurrentRequests = 2
+            ds.cycletime = 300
+            ds.zHBaseMaxBackoff = 1800
+            config.datasources.append(ds)
+
+        requests = {}
+
+        def fetch(url, headers, ds):
+            requests[ds.component] = defer.Deferred()
+            return requests[ds.component]
+
+        self.plugin.fetch = fetch
+        results = []
+        self.plugin.collect(config).addCallback(results.append)
+        # Only two servers are queried at the same time.
+        self.assertEquals(sorted(requests), ['server1', 'server2'])
+
+        # Results are merged as they arrive.
+        requests['server2'].callback('{"beans": [{"compactionQueueSize": 3}]}')
+        requests['server3'].callback('{"beans": [{"compactionQueueSize": 1}]}')
+        requests['server1'].errback(Failure(Exception('timeout')))
+        self.assertEquals(results[0]['values'], {
+            'server2': {'compactionQueueSize': (3, 'N')},
+            'server3': {'compactionQueueSize': (1, 'N')},
+        })
+        self.assertEquals(
+            [e['component'] for e in results[0]['events']], ['server1'])
+
+    def test_skipped_event(self):
+        point = Mock()
+        point.id = 'compactionQueueSize'
+        ds = Mock()
+        ds.component = ds.title = 'server1'
+        ds.points = [point]
+        ds.zHBaseMaxConcurrentRequests = 2
+        ds.cycletime = 300
+        ds.zHBaseMaxBackoff = 1800
+        config = Mock()
+        config.datasources = [ds]
+        self.plugin.fetch = Mock(
+            return_value=defer.fail(Failure(Exception('timeout'))))
+
+        results = []
+        self.plugin.collect(config).addCallback(results.append)
+        self.assertEquals(
+            results[0]['events'][0]['severity'], ZenEventClasses.Error)
+
+        # The backed off server is not requested, its event says why.
+        self.plugin.collect(config).addCallback(results.append)
+        self.assertEquals(self.plugin.fetch.call_count, 1)
+        event = results[1]['events'][0]
+        self.assertEquals(event['component'], 'server1')
+        self.assertEquals(event['eventKey'], self.plugin.eventKey)
+        self.assertEquals(event['severity'], ZenEventClasses.Warning)
+        self.assertIn('Backoff after 1 failed requests', event['summary'])
+
+        # A dead server is not requested either.
+        status = Mock(dead_ids=set(['server1']), nodes={})
+        with patch('ZenPacks.zenoss.HBase.dsplugins.regionserver_plugins.'
+                   'SNAPSHOT_CACHE', Mock(peek=Mock(return_value=status))):
+            self.plugin.collect(config).addCallback(results.append)
+        self.assertIn(
+            'Region server is dead', results[2]['events'][0]['summary'])
+
+    def test_collect_queries(self):
+        points = []
+        for point_id in ('compactionQueueSize', 'callQueueLen'):
+            point = Mock()
+            point.id = point_id
+            points.append(point)
+        ds = Mock()
+        ds.component = ds.title = 'server1'
+        ds.zHBaseScheme = 'http'
+        ds.zHBaseRegionServerPort = 60030
+        ds.zHBaseMaxConcurrentRequests = 10
+        ds.cycletime = 300
+        ds.zHBaseMaxBackoff = 1800
+        ds.points = points
+        config = Mock()
+        config.datasources = [ds]
+
+        # HBase 0.94 has no beans matching the 0.96 queries.
+        url = 'http://server1:60030/jmx'
+        hbase94 = [
+            url + '?qry=hadoop:service=RegionServer,'
+            'name=RegionServerStatistics',
+            url + '?qry=hadoop:service=HBase,name=RPCStatistics-*',
+        ]
+        pages = {
+            url + '?qry=Hadoop:service=HBase,name=RegionServer,sub=Server':
+                '{"beans": []}',
+            url + '?qry=Hadoop:service=HBase,name=RegionServer,sub=IPC':
+                '{"beans": []}',
+            hbase94[0]: json.dumps({'beans': [
+                {'name': 'hadoop:service=RegionServer,'
+                         'name=RegionServerStatistics',
+                 'compactionQueueSize': 2},
+            ]}),
+            hbase94[1]: json.dumps({'beans': [
+                {'name': 'hadoop:service=HBase,name=RPCStatistics-60020',
+                 'callQueueLen': 5},
+            ]}),
+            url: json.dumps({'beans': [{'compactionQueueSize': 7}]}),
+        }
+        urls = []
+
+        def fetch(url, headers, ds):
+            urls.append(url)
+            return defer.succeed(pages[url])
+
+        self.plugin.fetch = fetch
+        results = []
+        self.plugin.collect(config).addCallback(results.append)
+        self.assertEquals(results[0]['values'], {'server1': {
+            'compactionQueueSize': (2, 'N'),
+            'callQueueLen': (5, 'N'),
+        }})
+        self.assertEquals(len(urls), 4)
+        # The whole '/jmx' document is not requested.
+        self.assertNotIn(url, urls)
+
+        # The queries which worked are used first next time.
+        del urls[:]
+        self.plugin.collect(config)
+        self.assertEquals(urls, hbase94)
+
+        # The unfiltered document is requested at once until the retry
+        # interval passes.
+        pages[hbase94[0]] = pages[hbase94[1]] = '{"beans": []}'
+        del urls[:]
+        results = []
+        self.plugin.collect(config).addCallback(results.append)
+        self.assertEquals(urls[-1], url)
+        self.assertEquals(results[0]['values'], {'server1': {
+            'compactionQueueSize': (7, 'N'),
+        }})
+        del urls[:]
+        self.plugin.collect(config)
+        self.assertEquals(urls, [url])
+
+        key = self.plugin._queries.keys()[0]
+        interval = dsplugins.regionserver_plugins.JMX_QUERY_RETRY_INTERVAL
+        self.plugin._queries[key] = (None, time.time() - interval)
+        del urls[:]
+        self.plugin.collect(config)
+        self.assertEquals(len(urls), 5)
+        self.assertTrue(urls[0].endswith('sub=Server'))
+
+    def test_form_values(self):
+        points = []
+        for point_id in ('blockCacheHitRatio', 'callQueueLen', 'missing'):
+            point = Mock()
+            point.id = point_id
+            points.append(point)
+        ds = Mock()
+        ds.points = points
+        result = json.dumps({'beans': [
+            {'name': 'Hadoop:service=HBase,name=RegionServer,sub=Server',
+             'blockCountHitPercent': 97.5},
+            {'name': 'Hadoop:service=HBase,name=RegionServer,sub=IPC',
+             'numCallsInGeneralQueue': 0},
+        ]})
+        self.assertEquals(self.plugin.form_values([result], ds), {
+            'blockCacheHitRatio': (97.5, 'N'),
+            'callQueueLen': (0, 'N'),
+        })
+
+    def test_collect_dead_server(self):
+        ds = Mock()
+        ds.component = ds.title = 'localhost_11111'
+        ds.points = []
+        ds.manageIp = 'localhost'
+        ds.zHBaseScheme = 'http'
+        ds.zHBaseRestPort = '8080'
+        ds.zHBaseUsername = ds.zHBasePassword = ''
+        ds.zHBaseMaxConcurrentRequests = 10
+        ds.cycletime = 300
+        config = Mock()
+        config.datasources = [ds]
+        self.plugin.fetch = Mock()
+        cache = dsplugins.base_plugin.SnapshotCache()
+        cache.get(
+            dsplugins.base_plugin.snapshot_key(ds, '/status/cluster'), 150,
+            lambda: defer.succeed(
+                ClusterStatus(load_data('HBaseCollector.json'))))
+
+        results = []
+        with patch('ZenPacks.zenoss.HBase.dsplugins.regionserver_plugins.'
+                   'SNAPSHOT_CACHE', cache):
+            self.plugin.collect(config).addCallback(results.append)
+        # The server reported dead is not requested and has no events.
+        self.assertFalse(self.plugin.fetch.called)
+        self.assertEquals(results[0]['values'], {})
+        self.assertEquals(results[0]['events'], [])
+
+
+class Context(object):
+    """
+    Component with the zProperties acquired from its parents.
+    """
+    def __init__(self, parent=None, **properties):
+        self.parent = parent
+        self.__dict__.update(properties)
+
+    def __getattr__(self, name):
+        if self.parent is None:
+            raise AttributeError(name)
+        return getattr(self.parent, name)
+
+
+class DataSourceConfig(object):
+    pass
+
+
+def build_configs(plugin, regions):
+    """
+    Build the datasource configs of the regions the way zenhub does.
+    """
+    device = Context(
+        id='hbase.testDevice', manageIp='10.0.0.1', zHBaseScheme='https',
+        zHBaseUsername='monitoring', zHBasePassword='secret',
+        zHBaseRestPort='8080', zHBaseMaxConnectionsPerHost=4,
+        zHBaseConnectionIdleTimeout=360, zHBaseRequestTimeout=30)
+    servers = [Context(device, id='node{0}_60020'.format(i))
+               for i in range(50)]
+    points = ('read_requests', 'write_requests', 'number_of_stores',
+              'number_of_store_files', 'store_file_size_mb',
+              'store_file_index_size_mb', 'memstore_size_mb',
+              'current_compacted_kv', 'total_compacting_kv')
+    configs = []
+    for i in xrange(regions):
+        server = servers[i % len(servers)]
+        region = Context(server, id='region{0}'.format(i))
+        ds = DataSourceConfig()
+        ds.device = device.id
+        ds.manageIp = device.manageIp
+        ds.component = region.id
+        ds.template = 'HBaseHRegion'
+        ds.datasource = 'HBaseHRegion'
+        ds.cycletime = 300
+        ds.config_key = (device.id, 300, 'HBaseHRegion', 'HBaseHRegion')
+        ds.params = {}
+        for attr in plugin.proxy_attributes:
+            setattr(ds, attr, getattr(region, attr))
+        ds.points = [{
+            'id': point,
+            'component': region.id,
+            'rrdPath': 'Devices/{0}/hbase_regions/{1}/HBaseHRegion_{2}'.format(
+                device.id, region.id, point),
+            'rrdType': 'GAUGE',
+        } for point in points]
+        configs.append(ds)
+    return configs
+
+
 class TestHBaseHRegionPlugin(BaseTestCase):
 
     def afterSetUp(self):
@@ -156,9 +571,8 @@ class TestHBaseHRegionPlugin(BaseTestCase):
         self.plugin = dsplugins.HBaseHRegionPlugin()
 
     def test_process(self):
-        data = load_data('HBaseCollector.json')
-        self.plugin.component = '{0}{1}{2}'.format(
-            'localhost_44451', NAME_SPLITTER, 'LVJPT1QtLCww')
+        data = ClusterStatus(load_data('HBaseCollector.json'))
+        self.plugin.component = 'LVJPT1QtLCww'
         result = self.plugin.process(data)
         self.assertEquals(result.get('memstore_size_mb'), (0, 'N'))
         self.assertEquals(result.get('number_of_store_files'), (1, 'N'))
@@ -170,6 +584,87 @@ class TestHBaseHRegionPlugin(BaseTestCase):
         self.assertEquals(result.get('store_file_size_mb'), (0, 'N'))
         self.assertEquals(result.get('write_requests'), (1, 'N'))
 
+    def test_collect(self):
+        config = Mock()
+        config.datasources = []
+        for component in ('LVJPT1QtLCww', 'removed'):
+            ds = Mock()
+            ds.component = component
+            ds.manageIp = 'localhost'
+            ds.zHBaseScheme = 'http'
+            ds.zHBaseRestPort = '8080'
+            ds.zHBaseUsername = ds.zHBasePassword = ''
+            ds.cycletime = 300
+            config.datasources.append(ds)
+        cache = dsplugins.base_plugin.SnapshotCache()
+        self.plugin.fetch = Mock(return_value=defer.succeed(
+            load_data('HBaseCollector.json')))
+
+        results = []
+        with patch('ZenPacks.zenoss.HBase.dsplugins.base_plugin.'
+                   'SNAPSHOT_CACHE', cache):
+            # The status is requested if no other datasource got it.
+            self.plugin.collect(config).addCallback(results.append)
+            self.assertEquals(self.plugin.fetch.call_count, 1)
+            # And shared with the datasources polling the device next.
+            self.plugin.collect(config).addCallback(results.append)
+            self.assertEquals(self.plugin.fetch.call_count, 1)
+
+        for result in results:
+            values = result['values']
+            self.assertEquals(values['removed'], {})
+            self.assertEquals(
+                values['LVJPT1QtLCww']['read_requests'], (9, 'N'))
+        # Only the device event is cleared.
+        self.assertEquals(
+            [e['component'] for e in self.plugin.onSuccess(
+                results[1], config)['events']], [None])
+
+    def test_collect_error(self):
+        ds = Mock()
+        ds.component = 'LVJPT1QtLCww'
+        ds.cycletime = 300
+        config = Mock()
+        config.datasources = [ds]
+        self.plugin.fetch = Mock(
+            return_value=defer.fail(Failure(Exception('timeout'))))
+
+        results = []
+        with patch('ZenPacks.zenoss.HBase.dsplugins.base_plugin.'
+                   'SNAPSHOT_CACHE', dsplugins.base_plugin.SnapshotCache()):
+            self.plugin.collect(config).addCallback(results.append)
+        # A failed request is reported.
+        self.assertEquals(results[0]['events'], [{
+            'component': None,
+            'summary': 'timeout',
+            'eventKey': 'hbase_region_monitoring_error',
+            'eventClass': '/Status',
+            'severity': 4,
+        }])
+
+    def test_fetch(self):
+        ds = Mock()
+        with patch('ZenPacks.zenoss.HBase.client.fetch') as fetch:
+            self.plugin.fetch('http://localhost:8080', {}, ds)
+        # The connection settings are not proxied to the region configs.
+        fetch.assert_called_once_with(
+            'http://localhost:8080', headers={}, reader=None)
+
+    def test_config_size(self):
+        old_plugin = dsplugins.HBaseBasePlugin
+        sizes = {}
+        for plugin in (old_plugin, self.plugin):
+            start = time.time()
+            configs = build_configs(plugin, 10000)
+            build_time = time.time() - start
+            payload = len(cPickle.dumps(configs, 2))
+            sizes[plugin] = payload
+            log.info(
+                'Configs of 10000 regions with %s proxy attributes: '
+                'built in %.3fs, %s bytes', len(plugin.proxy_attributes),
+                build_time, payload)
+        self.assertTrue(sizes[self.plugin] < sizes[old_plugin])
+
 
 class TestHBaseTablePlugin(BaseTestCase):
 
@@ -178,6 +673,12 @@ class TestHBaseTablePlugin(BaseTestCase):
         dc = self.dmd.Devices.createOrganizer('/Server')
         self.d = dc.createInstance('hbase.testDevice')
         self.plugin = dsplugins.HBaseTablePlugin()
+        self.cache = dsplugins.table_plugins.SchemaCache()
+        patcher = patch(
+            'ZenPacks.zenoss.HBase.dsplugins.table_plugins.SCHEMA_CACHE',
+            self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_onSuccess(self):
         data = self.plugin.new_data()
@@ -200,7 +701,7 @@ class TestHBaseTablePlugin(BaseTestCase):
         }, self.plugin.onSuccess(data, config).get('events'))
 
     def test_get_events(self):
-        data = load_data('HBaseTableStatus.txt')
+        data = read_page(load_data('HBaseTableStatus.txt'))
         self.plugin.component = sentinel.component
         result = self.plugin.get_events(data, sentinel.ds)
         self.assertIn({
@@ -212,7 +713,7 @@ class TestHBaseTablePlugin(BaseTestCase):
         }, result)
 
     def test_get_events_clear(self):
-        data = load_data('HBaseTableEnabledStatus.txt')
+        data = read_page(load_data('HBaseTableEnabledStatus.txt'))
         self.plugin.component = sentinel.component
         result = self.plugin.get_events(data, sentinel.ds)
         self.assertIn({
@@ -224,7 +725,7 @@ class TestHBaseTablePlugin(BaseTestCase):
         }, result)
 
     def test_add_maps(self):
-        data = load_data('HBaseTableStatus.txt')
+        data = read_page(load_data('HBaseTableStatus.txt'))
         schema = load_data('HBaseTableColumnFamily.json')
         self.plugin.component = sentinel.component
         result = self.plugin.add_maps(data, schema, sentinel.ds)
@@ -237,12 +738,516 @@ class TestHBaseTablePlugin(BaseTestCase):
         self.assertEquals(
             om.col_family_block_size, 'colfam1: 640.0KB; colfam2: 612.0B')
 
+    def _config(self, tables, mode=dsplugins.table_plugins.TABLE_JSP_MODE):
+        config = Mock()
+        config.datasources = []
+        for table in tables:
+            ds = Mock()
+            ds.device = 'hbase.testDevice'
+            ds.component = table
+            ds.zHBaseMaxConcurrentRequests = 2
+            ds.zHBaseSchemaCacheTTL = 3600
+            ds.zHBaseTableStateMode = mode
+            ds.manageIp = 'localhost'
+            ds.zHBaseRestPort = '8080'
+            ds.cycletime = 300
+            config.datasources.append(ds)
+        return config
+
+    def _status(self):
+        region = lambda name, compacting: {
+            'name': name.encode('base64').strip(),
+            'currentCompactedKVs': 10,
+            'totalCompactingKVs': 10 + compacting,
+        }
+        return json.dumps({'LiveNodes': [{
+            'name': 'localhost:44451',
+            'Region': [
+                region('table1,,1.a.', 0),
+                region('table1,b,2.b.', 5),
+                region('table2,,3.c.', 0),
+                region('ns:table3,,4.d.', 0),
+            ],
+        }]})
+
+    def test_table_states(self):
+        tables = {'table': [{'name': 'table1'}, {'name': 'table2'},
+                            {'name': 'ns:table3'}, {'name': 'disabled'}]}
+        self.assertEquals(
+            dsplugins.table_plugins.table_states(
+                ClusterStatus(self._status()), tables), {
+                'table1': {'enabled': 'true', 'compaction': 'COMPACTING'},
+                'table2': {'enabled': 'true', 'compaction': 'NONE'},
+                # Keyed by the component ids.
+                prepId('ns:table3'): {'enabled': 'true', 'compaction': 'NONE'},
+                'disabled': {'enabled': 'false', 'compaction': 'NONE'},
+            })
+
+    def test_table_states_no_online_regions(self):
+        # The regions of an enabled table in transition or on dead region
+        # servers are not in the cluster status, so the bulk mode can not
+        # tell the table from a disabled one.
+        tables = {'table': [{'name': 'in_transition'}]}
+        self.assertEquals(
+            dsplugins.table_plugins.table_states(
+                ClusterStatus(self._status()), tables), {
+                'in_transition': {'enabled': 'false', 'compaction': 'NONE'},
+            })
+
+    def test_collect_bulk(self):
+        schema = load_data('HBaseTableColumnFamily.json')
+        pages = {
+            '/status/cluster': self._status(),
+            '/': json.dumps({'table': [{'name': 'table1'},
+                                       {'name': 'disabled'}]}),
+            '/table1/schema': schema,
+            '/disabled/schema': schema,
+        }
+        urls = []
+
+        def fetch(url, headers, ds, reader=None):
+            urls.append(url)
+            path = url.split('8080', 1)[1]
+            if path not in pages:
+                return defer.fail(Failure(Exception('404 Not Found')))
+            return defer.succeed(pages[path])
+
+        self.plugin.fetch = fetch
+        results = []
+        with patch('ZenPacks.zenoss.HBase.dsplugins.base_plugin.'
+                   'SNAPSHOT_CACHE', dsplugins.base_plugin.SnapshotCache()):
+            self.plugin.collect(self._config(
+                ['table1', 'disabled', 'dropped'],
+                dsplugins.table_plugins.BULK_MODE)
+            ).addCallback(results.append)
+
+        # No table.jsp requests, one schema request per table.
+        self.assertEquals(len(urls), 5)
+        self.assertFalse([url for url in urls if 'table.jsp' in url])
+        maps = dict((om.compname, om) for om in results[0]['maps'])
+        self.assertEquals(
+            sorted(maps), ['hbase_tables/disabled', 'hbase_tables/table1'])
+        self.assertEquals(maps['hbase_tables/table1'].enabled, 'true')
+        self.assertEquals(
+            maps['hbase_tables/table1'].compaction, 'COMPACTING')
+        self.assertEquals(maps['hbase_tables/table1'].number_of_col_families, 2)
+        self.assertEquals(maps['hbase_tables/disabled'].enabled, 'false')
+        events = dict(
+            ((e['component'], e['eventKey']), e['summary'])
+            for e in results[0]['events'])
+        self.assertEquals(
+            events[('disabled', 'hbase_monitoring_error')],
+            "The table 'disabled' is disabled")
+        self.assertEquals(
+            events[('dropped', 'hbase_table_monitoring_error')],
+            "The table 'dropped' is broken or does not exist")
+
+    def test_collect_schema_cache(self):
+        pages = {
+            'enabled': load_data('HBaseTableEnabledStatus.txt'),
+            'disabled': load_data('HBaseTableStatus.txt'),
+        }
+        schema = load_data('HBaseTableColumnFamily.json')
+        state = {'table1': 'enabled', 'table2': 'enabled'}
+        urls = []
+
+        def fetch(url, headers, ds, reader=None):
+            urls.append(url)
+            if url.endswith('/schema'):
+                return defer.succeed(schema)
+            reader.feed(pages[state[ds.component]])
+            return defer.succeed(reader.close())
+
+        self.plugin.fetch = fetch
+        config = self._config(['table1', 'table2'])
+        self.plugin.collect(config)
+        self.assertEquals(len(urls), 4)
+        self.assertEquals(self.cache.stats('hbase.testDevice'), (0, 2))
+
+        # The schemas are cached.
+        del urls[:]
+        results = []
+        self.plugin.collect(config).addCallback(results.append)
+        self.assertFalse([url for url in urls if url.endswith('/schema')])
+        self.assertEquals(self.cache.stats('hbase.testDevice'), (2, 2))
+        self.assertEquals(len(results[0]['maps']), 2)
+        self.assertEquals(results[0]['maps'][0].number_of_col_families, 2)
+
+        # The schema of a table which changed state is requested again.
+        del urls[:]
+        state['table2'] = 'disabled'
+        self.plugin.collect(config)
+        schema_urls = [url for url in urls if url.endswith('/schema')]
+        self.assertEquals(len(schema_urls), 1)
+        self.assertTrue(schema_urls[0].endswith('/table2/schema'))
+        self.assertEquals(self.cache.stats('hbase.testDevice'), (3, 3))
+
+    def test_collect_concurrent_schema(self):
+        requests = {}
+
+        def fetch(url, headers, ds, reader=None):
+            requests[url.rsplit('/', 1)[-1]] = defer.Deferred(), reader
+            return requests[url.rsplit('/', 1)[-1]][0]
+
+        self.plugin.fetch = fetch
+        results = []
+        self.plugin.collect(
+            self._config(['table1'])).addCallback(results.append)
+        # The schema is requested without waiting for the state.
+        self.assertEquals(
+            sorted(requests), ['schema', 'table.jsp?name=table1'])
+
+        requests['schema'][0].callback(
+            load_data('HBaseTableColumnFamily.json'))
+        d, reader = requests['table.jsp?name=table1']
+        reader.feed(load_data('HBaseTableEnabledStatus.txt'))
+        d.callback(reader.close())
+        self.assertEquals(results[0]['maps'][0].number_of_col_families, 2)
+
+    def test_collect(self):
+        status = load_data('HBaseTableEnabledStatus.txt')
+        schema = load_data('HBaseTableColumnFamily.json')
+
+        def fetch(url, headers, ds, reader=None):
+            if ds.component == 'broken':
+                return defer.fail(Failure(Exception('404 Not Found')))
+            if url.endswith('/schema'):
+                return defer.succeed(schema)
+            reader.feed(status)
+            return defer.succeed(reader.close())
+
+        self.plugin.fetch = fetch
+        results = []
+        self.plugin.collect(
+            self._config(['table1', 'broken', 'table2'])
+        ).addCallback(results.append)
+
+        result = results[0]
+        self.assertEquals(
+            sorted(om.compname for om in result['maps']),
+            ['hbase_tables/table1', 'hbase_tables/table2'])
+        self.assertIn({
+            'severity': 4,
+            'eventClass': '/Status',
+            'component': 'broken',
+            'eventKey': 'hbase_table_monitoring_error',
+            'summary': "The table 'broken' is broken or does not exist"
+        }, result['events'])
+        self.assertFalse(self.plugin.global_error)
+
+    def test_collect_global_error(self):
+        fetch = Mock(return_value=defer.fail(Failure(Exception('timeout'))))
+        self.plugin.fetch = fetch
+        results = []
+        self.plugin.collect(
+            self._config(['table%s' % i for i in range(10)])
+        ).addCallback(results.append)
+
+        # The rest of the tables are not queried after the first error,
+        # which is the only one reported.
+        self.assertEquals(fetch.call_count, 2)
+        self.assertTrue(self.plugin.global_error)
+        self.assertEquals(results[0]['events'], [{
+            'component': None,
+            'summary': 'timeout',
+            'eventKey': 'hbase_table_monitoring_error',
+            'eventClass': '/Status',
+            'severity': 4,
+        }])
+
+
+class TestSnapshotCache(BaseTestCase):
+
+    def afterSetUp(self):
+        super(TestSnapshotCache, self).afterSetUp()
+        self.cache = dsplugins.base_plugin.SnapshotCache()
+        self.key = ('localhost', '8080', '/status/cluster')
+
+    def test_shared_request(self):
+        request = defer.Deferred()
+        fetch = Mock(return_value=request)
+        first = self.cache.get(self.key, 150, fetch)
+        second = self.cache.get(self.key, 150, fetch)
+        self.assertEquals(fetch.call_count, 1)
+
+        results = []
+        first.addCallback(results.append)
+        second.addCallback(results.append)
+        request.callback('status')
+        self.assertEquals(results, ['status', 'status'])
+
+    def test_fresh_snapshot(self):
+        fetch = Mock(return_value=defer.succeed('status'))
+        self.cache.get(self.key, 150, fetch)
+        results = []
+        self.cache.get(self.key, 150, fetch).addCallback(results.append)
+        self.assertEquals(fetch.call_count, 1)
+        self.assertEquals(results, ['status'])
+
+        # Expired snapshot is fetched again.
+        self.cache.get(self.key, 0, fetch)
+        self.assertEquals(fetch.call_count, 2)
+
+    def test_snapshot_key(self):
+        ds = Mock()
+        ds.manageIp = 'localhost'
+        ds.zHBaseScheme = 'http'
+        ds.zHBaseRestPort = '8080'
+        ds.zHBaseUsername = 'monitoring'
+        ds.zHBasePassword = 'secret'
+        key = dsplugins.base_plugin.snapshot_key(ds, '/status/cluster')
+        # Snapshots are not shared between different connection settings.
+        for name, value in (('zHBaseScheme', 'https'),
+                            ('zHBaseUsername', 'other'),
+                            ('zHBasePassword', 'other')):
+            other = Mock(**dict(
+                (attr, getattr(ds, attr)) for attr in (
+                    'manageIp', 'zHBaseScheme', 'zHBaseRestPort',
+                    'zHBaseUsername', 'zHBasePassword')))
+            setattr(other, name, value)
+            self.assertNotEquals(
+                dsplugins.base_plugin.snapshot_key(other, '/status/cluster'),
+                key)
+
+    def test_expired_dropped(self):
+        fetch = Mock(return_value=defer.succeed('status'))
+        self.cache.get(self.key, 150, fetch)
+        # A device which is not polled any more.
+        self.cache._snapshots['removed'] = (time.time() - 150, 'old status')
+        self.cache.get(('other', '8080', '/status/cluster'), 150, fetch)
+        self.assertEquals(
+            sorted(self.cache._snapshots),
+            [self.key, ('other', '8080', '/status/cluster')])
+
+    def test_failure_not_cached(self):
+        fetch = Mock(return_value=defer.fail(Failure(ValueError('test'))))
+        errors = []
+        self.cache.get(self.key, 150, fetch).addErrback(errors.append)
+        self.assertEquals(len(errors), 1)
+
+        fetch.return_value = defer.succeed('status')
+        self.cache.get(self.key, 150, fetch)
+        self.assertEquals(fetch.call_count, 2)
+
+
+class TestSchemaCache(BaseTestCase):
+
+    def afterSetUp(self):
+        super(TestSchemaCache, self).afterSetUp()
+        self.cache = dsplugins.table_plugins.SchemaCache()
+        self.key = ('hbase.testDevice', 'table')
+        self.state = {'enabled': 'true', 'compaction': 'NONE'}
+
+    def test_ttl(self):
+        self.assertEquals(self.cache.get(self.key, self.state, 60), None)
+        self.cache.set(self.key, self.state, 'schema')
+        self.assertEquals(
+            self.cache.get(self.key, self.state, 60), 'schema')
+        self.assertEquals(self.cache.get(self.key, self.state, 0), None)
+        # Expired schema is dropped.
+        self.assertEquals(self.cache.get(self.key, self.state, 60), None)
+        self.assertEquals(self.cache.stats('hbase.testDevice'), (1, 3))
+        self.assertEquals(self.cache.stats('other'), (0, 0))
+
+    def test_cached(self):
+        self.assertFalse(self.cache.cached(self.key, 60))
+        self.cache.set(self.key, self.state, 'schema')
+        self.assertTrue(self.cache.cached(self.key, 60))
+        self.assertFalse(self.cache.cached(self.key, 0))
+        # Whatever the state.
+        self.state['enabled'] = 'false'
+        self.assertTrue(self.cache.cached(self.key, 60))
+
+    def test_state_change(self):
+        self.cache.set(self.key, self.state, 'schema')
+        self.state['compaction'] = 'MAJOR'
+        self.assertEquals(self.cache.get(self.key, self.state, 60), None)
+
+    def test_invalidate(self):
+        self.cache.set(self.key, self.state, 'schema')
+        self.cache.invalidate(self.key)
+        self.assertEquals(self.cache.get(self.key, self.state, 60), None)
+
+
+class TestCircuitBreaker(BaseTestCase):
+
+    def afterSetUp(self):
+        super(TestCircuitBreaker, self).afterSetUp()
+        self.breaker = dsplugins.base_plugin.CircuitBreaker()
+        self.key = ('localhost', '60030')
+        self.now = 1000
+        patcher = patch(
+            'ZenPacks.zenoss.HBase.dsplugins.base_plugin.time.time',
+            lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def call(self, fetch):
+        fetch = Mock(side_effect=fetch)
+        results = []
+        self.breaker.call(self.key, fetch, 300, 1000).addBoth(results.append)
+        return fetch.called, results[0]
+
+    def test_backoff(self):
+        down = lambda: defer.fail(Failure(Exception('refused')))
+        up = lambda: defer.succeed('ok')
+        self.assertEquals(self.call(down)[0], True)
+        # Open for the backoff period.
+        called, result = self.call(down)
+        self.assertFalse(called)
+        self.assertTrue(result.check(HostUnavailable))
+
+        # Failed probe doubles the period.
+        self.now += 300
+        self.assertEquals(self.call(down)[0], True)
+        self.now += 599
+        self.assertEquals(self.call(down)[0], False)
+        self.now += 1
+        self.assertEquals(self.call(down)[0], True)
+        # Limited by max_backoff.
+        self.now += 1000
+        self.assertEquals(self.call(up), (True, 'ok'))
+        # Closed after a successful probe.
+        self.assertEquals(self.call(down)[0], True)
+
+    def test_half_open(self):
+        self.call(lambda: defer.fail(Failure(Exception('refused'))))
+        self.now += 300
+        probe = defer.Deferred()
+        self.breaker.call(self.key, lambda: probe, 300, 1000)
+        # Only one probe at a time.
+        called, result = self.call(lambda: defer.succeed('ok'))
+        self.assertFalse(called)
+        result.trap(HostUnavailable)
+        probe.callback('ok')
+        self.assertEquals(self.call(lambda: defer.succeed('ok'))[0], True)
+
+    def test_http_error(self):
+        error = lambda: defer.fail(Failure(Error('404', 'Not Found')))
+        self.call(error)
+        # The host responded.
+        self.assertEquals(self.call(error)[0], True)
+
+
+class TestRunConcurrently(BaseTestCase):
+
+    def test_limit(self):
+        for limit in (0, -1, '0'):
+            requests = []
+
+            def func(item):
+                requests.append(defer.Deferred())
+                return requests[-1]
+
+            results = []
+            dsplugins.base_plugin.run_concurrently(
+                limit, func, ['a', 'b']).addCallback(results.append)
+            # Taken as 1, the calls are made one after the other.
+            self.assertEquals(len(requests), 1)
+            requests[0].callback('a')
+            self.assertEquals(len(requests), 2)
+            requests[1].callback('b')
+            self.assertEquals(len(results), 1)
+
+
+class TestClearEvents(BaseTestCase):
+
+    def afterSetUp(self):
+        super(TestClearEvents, self).afterSetUp()
+        zenpack._clear_events_checks.clear()
+        self.brains = []
+        for component_id in ('localhost_44451', 'LVJPT1QtLCww'):
+            brain = Mock()
+            brain.id = component_id
+            self.brains.append(brain)
+        self.device = Mock()
+        self.device.id = 'hbase.testDevice'
+        self.device.componentSearch.side_effect = lambda: self.brains
+        self.device.getClearEvents.side_effect = \
+            lambda: zenpack.getClearEvents(self.device)
+        self.zep = Mock()
+        self.zep.getEventSummariesGenerator.return_value = [
+            {'uuid': uuid, 'occurrence': [{'actor': actor}]}
+            for uuid, actor in (
+                ('1', {'element_sub_identifier': 'localhost_44451'}),
+                ('2', {'element_sub_identifier': 'removed_1'}),
+                ('3', {'element_sub_identifier': 'removed_2'}),
+                ('4', {}),
+            )
+        ]
+        self.hooks = []
+
+    def clear_events(self, fingerprint=1):
+        txn = Mock()
+        txn.get().addAfterCommitHook.side_effect = \
+            lambda hook, args: self.hooks.append((hook, args))
+        with patch('ZenPacks.zenoss.HBase.transaction', txn):
+            zenpack.clear_events(self.device, fingerprint)
+
+    def commit(self, status=True):
+        with patch('ZenPacks.zenoss.HBase.getFacade',
+                   Mock(return_value=self.zep)):
+            hook, args = self.hooks[-1]
+            hook(status, *args)
+
+    def test_clear_events(self):
+        self.clear_events()
+        # ZEP is not called until the transaction is committed.
+        self.assertFalse(self.zep.method_calls)
+        self.commit()
+        self.zep.createEventFilter.assert_called_with(uuid=['2', '3'])
+        self.assertEquals(self.zep.closeEventSummaries.call_count, 1)
+
+    def test_rate_limit(self):
+        self.clear_events()
+        self.commit()
+        self.assertEquals(zenpack.getClearEvents(self.device), 1)
+        self.clear_events()
+        self.assertEquals(len(self.hooks), 1)
+        # The components are not looked up until the check is due.
+        self.assertEquals(self.device.componentSearch.call_count, 1)
+        # Checked again as soon as the modeled components change.
+        self.clear_events(2)
+        self.assertEquals(len(self.hooks), 2)
+
+    def test_interval(self):
+        self.clear_events()
+        self.commit()
+        checked, fingerprint = zenpack._clear_events_checks[self.device.id]
+        zenpack._clear_events_checks[self.device.id] = (
+            checked - zenpack.CLEAR_EVENTS_INTERVAL, fingerprint)
+        self.assertEquals(zenpack.getClearEvents(self.device), None)
+        self.clear_events()
+        self.assertEquals(len(self.hooks), 2)
+
+    def test_evict(self):
+        zenpack._clear_events_checks['deleted'] = (
+            time.time() - zenpack.CLEAR_EVENTS_INTERVAL, 1)
+        self.clear_events()
+        self.commit()
+        self.assertEquals(
+            zenpack._clear_events_checks.keys(), [self.device.id])
+
+    def test_not_committed(self):
+        self.clear_events()
+        self.commit(False)
+        self.assertFalse(self.zep.method_calls)
+        self.clear_events()
+        self.assertEquals(len(self.hooks), 2)
+
 
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(TestHBaseMasterPlugin))
     suite.addTest(makeSuite(TestHBaseRegionServerPlugin))
+    suite.addTest(makeSuite(TestHBaseRegionServerConfPlugin))
+    suite.addTest(makeSuite(TestRegionServerStatisticsJMXPlugin))
     suite.addTest(makeSuite(TestHBaseHRegionPlugin))
     suite.addTest(makeSuite(TestHBaseTablePlugin))
+    suite.addTest(makeSuite(TestSnapshotCache))
+    suite.addTest(makeSuite(TestSchemaCache))
+    suite.addTest(makeSuite(TestCircuitBreaker))
+    suite.addTest(makeSuite(TestRunConcurrently))
+    suite.addTest(makeSuite(TestClearEvents))
     return suite
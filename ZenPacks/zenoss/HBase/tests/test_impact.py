@@ -7,7 +7,13 @@
 #
 ##############################################################################
 
+import logging
+log = logging.getLogger('zen.HBaseTest')
+
 import functools
+import time
+
+import transaction
 
 from zope.component import subscribers
 
@@ -107,17 +113,86 @@ class TestImpact(BaseTestCase):
     def test_HBaseHRegionImpacts(self):
         region = self.device().getObjByPath(
             'hbase_servers/region_server0/regions/region0-0')
+        region.setTableId('table0')
         impacts, impacted_by = impacts_for(region)
 
         self.assertTrue('region_server0' in impacted_by)
+        self.assertTrue('table0' in impacts)
 
     @require_impact
     def test_HBaseTableImpacts(self):
         region = self.device().getObjByPath(
             'hbase_servers/region_server0/regions/region0-0')
-        region.table = 'table0'
+        region.setTableId('table0')
         table = self.device().getObjByPath(
             'hbase_tables/table0')
         impacts, impacted_by = impacts_for(table)
 
         self.assertTrue('region0-0' in impacted_by)
+
+    @require_impact
+    def test_HBaseTableImpacts_scale(self):
+        # 100 region servers with 100 regions each.
+        device = test_device(self.dmd, factor=100)
+        for server in device.hbase_servers():
+            for i, region in enumerate(server.regions()):
+                region.setTableId('table%s' % (i % 10))
+        table = device.getObjByPath('hbase_tables/table0')
+
+        start = time.time()
+        impacts, impacted_by = impacts_for(table)
+        log.info('Impact edges of a table of 10000 regions: %.3fs',
+                 time.time() - start)
+        self.assertEquals(len(impacted_by), 1000)
+
+        region = device.getObjByPath(
+            'hbase_servers/region_server0/regions/region0-10')
+        self.assertEquals(region.getTableId(), 'table0')
+        impacts, impacted_by = impacts_for(region)
+        self.assertEquals(impacts, ['table0'])
+
+    @require_impact
+    def test_HBaseTableImpacts_cached(self):
+        region = self.device().getObjByPath(
+            'hbase_servers/region_server0/regions/region0-0')
+        region.setTableId('table0')
+        table = self.device().getObjByPath('hbase_tables/table0')
+        impacts, impacted_by = impacts_for(table)
+        self.assertTrue('region0-0' in impacted_by)
+
+        # Edges are cached until the device is changed.
+        region.hbase_table.removeRelation()
+        impacts, impacted_by = impacts_for(table)
+        self.assertTrue('region0-0' in impacted_by)
+
+        # Relating the region to a table changes the device.
+        region.setTableId('table1')
+        impacts, impacted_by = impacts_for(table)
+        self.assertFalse('region0-0' in impacted_by)
+
+    @require_impact
+    def test_HBaseRegionServerImpacts_moved(self):
+        device = self.device()
+        device.setRegionServerChanges(
+            {'add': [{'id': 'region_server1', 'is_alive': 'Up'}]})
+        transaction.savepoint(optimistic=True)
+        server = device.getObjByPath('hbase_servers/region_server0')
+        impacts, impacted_by = impacts_for(server)
+        self.assertTrue('region0-0' in impacts)
+
+        device.setRegionServerChanges(
+            {'move': {'region0-0': 'region_server1'}})
+        impacts, impacted_by = impacts_for(server)
+        self.assertFalse('region0-0' in impacts)
+
+    @require_impact
+    def test_cache_size(self):
+        from ZenPacks.zenoss.HBase import impact
+
+        impact._device_edges.clear()
+        for i in range(impact.CACHED_DEVICES + 1):
+            impact._device_edges[i] = (None, {})
+        impacts_for(self.device().getObjByPath('hbase_tables/table0'))
+        self.assertEquals(
+            len(impact._device_edges), impact.CACHED_DEVICES)
+        self.assertFalse(0 in impact._device_edges)
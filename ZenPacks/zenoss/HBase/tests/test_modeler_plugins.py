@@ -11,13 +11,25 @@
 import logging
 log = logging.getLogger('zen.HBaseTest')
 
+from mock import Mock, patch
+
+from Acquisition import aq_base
+
+import transaction
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
 from Products.DataCollector.ApplyDataMap import ApplyDataMap
 from Products.ZenTestCase.BaseTestCase import BaseTestCase
+from Products.ZenUtils.guid.interfaces import IGlobalIdentifier
 
-from ZenPacks.zenoss.HBase import NAME_SPLITTER
+import ZenPacks.zenoss.HBase as zenpack
 from ZenPacks.zenoss.HBase.modeler.plugins.HBaseCollector import \
     HBaseCollector
-from ZenPacks.zenoss.HBase.tests.utils import load_data
+from ZenPacks.zenoss.HBase.HBaseHRegion import HBaseHRegion
+from ZenPacks.zenoss.HBase.tests.utils import add_obj, load_data
+from ZenPacks.zenoss.HBase.utils import region_digest
 
 
 class MockJar(object):
@@ -75,9 +87,7 @@ class HBaseModelerPluginsTestCase(BaseTestCase):
     def test_HBaseHRegion(self):
         self._loadZenossData()
         region_server = self.d.hbase_servers._getOb('localhost_44451')
-        region = region_server.regions._getOb(
-            '%s%s%s' % ('localhost_44451', NAME_SPLITTER, 'LVJPT1QtLCww')
-        )
+        region = region_server.regions._getOb('LVJPT1QtLCww')
 
         self.assertEquals(region.device().id, 'hbase.testDevice')
         self.assertEquals(region.server().id, 'localhost_44451')
@@ -87,6 +97,148 @@ class HBaseModelerPluginsTestCase(BaseTestCase):
         self.assertEquals(region.region_id, '0')
         self.assertEquals(region.region_hash, 'LVJPT1QtLCww')
 
+    def test_region_tables(self):
+        self._loadZenossData()
+        region = self.d.hbase_servers._getOb('localhost_44451').regions \
+            ._getOb('LVJPT1QtLCww')
+        table = self.d.hbase_tables._getOb('test_table')
+
+        self.d.setRegionTables(
+            {'LVJPT1QtLCww': 'test_table', 'removed': 'test_table'})
+        self.assertEquals(region.getTableId(), 'test_table')
+        self.assertEquals([r.id for r in table.regions()], ['LVJPT1QtLCww'])
+
+        # The region is unrelated from a table which is not modeled.
+        self.d.setRegionTables({'LVJPT1QtLCww': 'missing'})
+        self.assertEquals(region.getTableId(), None)
+        self.assertEquals(table.regions(), [])
+
+    def test_region_index(self):
+        self._loadZenossData()
+        region_server = self.d.hbase_servers._getOb('localhost_44451')
+
+        self.assertEquals(
+            dict(self.d.hbase_region_index.items()),
+            {'LVJPT1QtLCww': 'localhost_44451'})
+        self.assertEquals(
+            self.d.server_digests['localhost_44451'],
+            ('Up', region_digest(['LVJPT1QtLCww'])))
+
+        region_server.regions._delObject('LVJPT1QtLCww')
+        self.assertEquals(list(self.d.hbase_region_index.keys()), [])
+        self.assertEquals(region_server.region_digest, 0)
+
+    def test_region_index_read(self):
+        self._loadZenossData()
+        region_server = self.d.hbase_servers._getOb('localhost_44451')
+        del self.d._hbase_region_index
+        region_server._region_digest = None
+
+        self.assertEquals(
+            dict(self.d.hbase_region_index.items()),
+            {'LVJPT1QtLCww': 'localhost_44451'})
+        self.assertEquals(
+            region_server.region_digest, region_digest(['LVJPT1QtLCww']))
+        # Nothing is stored on read.
+        self.assertFalse(hasattr(aq_base(self.d), '_hbase_region_index'))
+        self.assertEquals(region_server._region_digest, None)
+
+        self.d.build_region_index()
+        region_server.build_region_digest()
+        self.assertTrue(hasattr(aq_base(self.d), '_hbase_region_index'))
+        self.assertEquals(
+            region_server._region_digest, region_digest(['LVJPT1QtLCww']))
+
+    def test_region_index_not_stored(self):
+        self._loadZenossData()
+        region_server = self.d.hbase_servers._getOb('localhost_44451')
+        del self.d._hbase_region_index
+
+        # The index is not built to update it.
+        add_obj(region_server.regions, HBaseHRegion('dGVzdCwsMQ'))
+        region_server.regions._delObject('LVJPT1QtLCww')
+        self.assertFalse(hasattr(aq_base(self.d), '_hbase_region_index'))
+        self.assertEquals(
+            region_server.region_digest, region_digest(['dGVzdCwsMQ']))
+
+        # The regions deleted with their region server are dropped
+        # from the stored index at once.
+        self.d.build_region_index()
+        self.d.hbase_servers._delObject('localhost_44451')
+        self.assertEquals(list(self.d._hbase_region_index.keys()), [])
+
+    def test_move_region(self):
+        self._loadZenossData()
+        self.d.setRegionServerChanges(
+            {'add': [{'id': 'localhost_2', 'is_alive': 'Up'}]})
+        transaction.savepoint(optimistic=True)
+        region = self.d.hbase_servers._getOb('localhost_44451').regions \
+            ._getOb('LVJPT1QtLCww')
+        guid = IGlobalIdentifier(region).getGUID()
+
+        self.d.setRegionServerChanges(
+            {'move': {'LVJPT1QtLCww': 'localhost_2'}})
+        region = self.d.hbase_servers._getOb('localhost_2').regions \
+            ._getOb('LVJPT1QtLCww')
+
+        self.assertEquals(IGlobalIdentifier(region).getGUID(), guid)
+        self.assertEquals(
+            self.d.hbase_region_index['LVJPT1QtLCww'], 'localhost_2')
+        self.assertEquals(
+            self.d.hbase_servers._getOb('localhost_44451').region_ids, [])
+
+    def test_remodel_moved_region(self):
+        self._loadZenossData()
+        transaction.savepoint(optimistic=True)
+        region = self.d.hbase_servers._getOb('localhost_44451').regions \
+            ._getOb('LVJPT1QtLCww')
+        guid = IGlobalIdentifier(region).getGUID()
+
+        # The region server is restarted on another port.
+        modeler_results = dict(
+            status=load_data('HBaseCollector.json').replace(
+                'localhost:44451', 'localhost:44452'),
+            conf=None,
+            tables=load_data('HBaseTableCollector.json')
+        )
+        for data_map in HBaseCollector().process(
+                self.d, modeler_results, log):
+            self.applyDataMap(self.d, data_map)
+
+        self.assertFalse('localhost_44451' in self.d.hbase_servers.objectIds())
+        region = self.d.hbase_servers._getOb('localhost_44452').regions \
+            ._getOb('LVJPT1QtLCww')
+        # The region is moved rather than created again.
+        self.assertEquals(IGlobalIdentifier(region).getGUID(), guid)
+        self.assertEquals(
+            self.d.hbase_region_index['LVJPT1QtLCww'], 'localhost_44452')
+
+    def test_rename_region(self):
+        self._loadZenossData()
+        regions = self.d.hbase_servers._getOb('localhost_44451').regions
+        add_obj(regions, HBaseHRegion('localhost_44451(.)LVJPT1QtLCww'))
+        region = add_obj(regions, HBaseHRegion('localhost_44451(.)dGVzdCwsMQ'))
+        transaction.savepoint(optimistic=True)
+        guid = IGlobalIdentifier(region).getGUID()
+        pack = zenpack.ZenPack('ZenPacks.zenoss.HBase')
+
+        pack._renameRegion(regions._getOb('localhost_44451(.)LVJPT1QtLCww'))
+        pack._renameRegion(regions._getOb('localhost_44451(.)dGVzdCwsMQ'))
+        region = regions._getOb('dGVzdCwsMQ')
+
+        self.assertEquals(
+            sorted(regions.objectIds()), ['LVJPT1QtLCww', 'dGVzdCwsMQ'])
+        self.assertEquals(IGlobalIdentifier(region).getGUID(), guid)
+        # The index is stored once and kept up to date by the renames.
+        self.assertEquals(
+            dict(self.d._hbase_region_index.items()),
+            {'LVJPT1QtLCww': 'localhost_44451',
+             'dGVzdCwsMQ': 'localhost_44451'})
+        self.assertEquals(
+            region.rrdPath(),
+            'Devices/hbase.testDevice/hbase_servers/localhost_44451/'
+            'regions/localhost_44451(.)dGVzdCwsMQ')
+
     def test_HBaseTable(self):
         self._loadZenossData()
         table = self.d.hbase_tables._getOb('test_table')
@@ -95,9 +247,107 @@ class HBaseModelerPluginsTestCase(BaseTestCase):
         self.assertEquals(table.enabled, None)
         self.assertEquals(table.compaction, None)
 
+    def test_collect_partial(self):
+        responses = {
+            '/status/cluster': defer.succeed(load_data('HBaseCollector.json')),
+            '/dump': defer.fail(Failure(Exception('timeout'))),
+            '/': defer.succeed(load_data('HBaseTableCollector.json')),
+        }
+        timeouts = []
+
+        def fetch(url, **kwargs):
+            timeouts.append(kwargs['timeout'])
+            return responses[url.split('1234', 1)[1]]
+
+        modeler = HBaseCollector()
+        modeler._send_event = Mock()
+        device = Mock()
+        device.manageIp = 'localhost'
+        device.zHBaseRestPort = device.zHBaseMasterPort = '1234'
+        device.zHBaseRequestTimeout = 30
+        device.zHBaseModelingTimeout = 300
+
+        results = []
+        with patch(
+                'ZenPacks.zenoss.HBase.modeler.plugins.HBaseCollector.fetch',
+                fetch):
+            modeler.collect(device, log).addCallback(results.append)
+
+        # Failed request does not prevent modeling of the rest.
+        self.assertEquals(results[0]['conf'], None)
+        self.assertTrue(results[0]['status'])
+        self.assertTrue(results[0]['tables'])
+        self.assertEquals(modeler._send_event.call_args[0][2], 3)
+        # Modeling requests are not limited by zHBaseRequestTimeout.
+        self.assertEquals(timeouts, [300, 300, 300])
+
+        modeler_results = dict(
+            status=load_data('HBaseCollector.json'),
+            conf=None,
+            tables=None
+        )
+        maps = modeler.process(self.d, modeler_results, log)
+        self.assertEquals(
+            [getattr(m, 'relname', None) for m in maps],
+            [None, 'hbase_servers', 'regions', None])
+
+    def test_process_failed_status(self):
+        modeler_results = dict(
+            status=None,
+            conf=None,
+            tables=load_data('HBaseTableCollector.json')
+        )
+        maps = HBaseCollector().process(self.d, modeler_results, log)
+        # Only the tables are mapped, events are not cleared and the
+        # template is not bound without the components.
+        self.assertEquals(
+            [getattr(m, 'relname', None) for m in maps], ['hbase_tables'])
+
+
+class TestClusterTemplate(BaseTestCase):
+
+    def afterSetUp(self):
+        super(TestClusterTemplate, self).afterSetUp()
+        self.properties = {
+            'zCollectorPlugins': ['HBaseCollector'],
+            'zDeviceTemplates': ['Device'],
+        }
+        self.device = Mock()
+        self.device.id = 'hbase.testDevice'
+        self.device.getProperty.side_effect = self.properties.get
+        self.device.getHBaseClusterTemplate.side_effect = \
+            lambda: zenpack.getHBaseClusterTemplate(self.device)
+        self.template = Mock()
+        self.template.id = 'HBaseCluster'
+        self.device.getRRDTemplateByName.return_value = self.template
+
+    def get_templates(self):
+        original = Mock(return_value=[])
+        with patch('ZenPacks.zenoss.HBase.original', original, create=True):
+            return zenpack.getRRDTemplates(self.device)
+
+    def test_getRRDTemplates(self):
+        self.assertEquals(self.get_templates(), [self.template])
+        # Nothing is bound until the device is modeled.
+        self.assertFalse(self.device.bindTemplates.called)
+
+        self.properties['zCollectorPlugins'] = []
+        self.assertEquals(self.get_templates(), [])
+
+    def test_bind_on_model(self):
+        self.assertFalse(zenpack.getHBaseClusterTemplate(self.device))
+        zenpack.setHBaseClusterTemplate(self.device, True)
+        self.device.bindTemplates.assert_called_with(
+            ['Device', 'HBaseCluster'])
+
+        self.properties['zDeviceTemplates'] = ['Device', 'HBaseCluster']
+        self.assertTrue(zenpack.getHBaseClusterTemplate(self.device))
+        self.assertEquals(self.get_templates(), [])
+
 
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(HBaseModelerPluginsTestCase))
+    suite.addTest(makeSuite(TestClusterTemplate))
     return suite
@@ -0,0 +1,432 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2014, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+import logging
+log = logging.getLogger('zen.HBaseTest')
+
+import json
+import sys
+import time
+
+from mock import Mock, patch
+
+from Products.ZenTestCase.BaseTestCase import BaseTestCase
+
+from ZenPacks.zenoss.HBase.tests.utils import load_data
+from ZenPacks.zenoss.HBase.utils import (
+    ClusterStatus, ClusterStatusReader, ConfWrapper, TableStateReader, matcher,
+    region_digest, RelationshipBatch
+)
+
+
+def legacy_conf(dump, names):
+    """
+    Regex based property matching used by ConfWrapper before the single
+    pass parser.
+    """
+    conf = matcher(dump, r'.+<configuration>(.+)</configuration>')
+    return dict((name, matcher(
+        conf, r'.+<name>{}</name><value>(.+?)</value>'.format(name)
+    )) for name in names)
+
+
+def large_dump(properties=1000, threads=5000):
+    """
+    Return a '/dump' page with the size of a busy region server's one.
+    """
+    dump = load_data('HBaseRegionServerDump.txt')
+    stacks = ''.join(
+        'Thread {0} (IPC Server handler {0} on 60020):\n'
+        '  State: WAITING\n'
+        '  Stack:\n'
+        '    sun.misc.Unsafe.park(Native Method)\n'
+        '    java.util.concurrent.locks.LockSupport.park(LockSupport.java:186)'
+        '\n'.format(i) for i in range(threads))
+    conf = ''.join(
+        '<property><name>test.property.{0}</name><value>{0}</value>'
+        '<source>hbase-site.xml</source></property>\n'.format(i)
+        for i in range(properties))
+    dump = dump.replace('Process Thread Dump: \n', 'Process Thread Dump: \n' + stacks)
+    return dump.replace('<configuration>\n', '<configuration>\n' + conf)
+
+
+class TestClusterStatus(BaseTestCase):
+
+    def test_indexes(self):
+        status = ClusterStatus(load_data('HBaseCollector.json'))
+        self.assertTrue(status)
+        self.assertEquals(status.requests, 0)
+        self.assertEquals(status.regions, 2)
+        self.assertEquals(status.average_load, 2.0)
+        self.assertEquals(status.nodes.keys(), ['localhost_44451'])
+        self.assertEquals(status.dead_ids, set(['localhost_11111']))
+        region = status.region_metrics['LVJPT1QtLCww']
+        self.assertEquals(region['readRequestsCount'], 9)
+
+    def test_empty(self):
+        status = ClusterStatus('{}')
+        self.assertFalse(status)
+        self.assertEquals(status.nodes, {})
+        self.assertEquals(status.dead_ids, set())
+
+
+def read_status(status, size):
+    """
+    Feed the status to ClusterStatusReader in chunks of the size and
+    return the result and the largest buffered part of the response.
+    """
+    reader = ClusterStatusReader()
+    buffered = 0
+    for i in xrange(0, len(status), size):
+        reader.feed(status[i:i + size])
+        buffered = max(buffered, len(reader._buffer))
+    return reader.close(), buffered
+
+
+def large_status(nodes=50, regions=400):
+    """
+    Return '/status/cluster' output of a cluster with the number of
+    region servers and regions per server.
+    """
+    region = {
+        'stores': 1, 'storefiles': 3, 'storefileSizeMB': 1024,
+        'storefileIndexSizeMB': 1, 'memstoreSizeMB': 64,
+        'readRequestsCount': 123456, 'writeRequestsCount': 654321,
+        'currentCompactedKVs': 100, 'totalCompactingKVs': 200,
+        'rootIndexSizeKB': 120, 'totalStaticIndexSizeKB': 1500,
+        'totalStaticBloomSizeKB': 700,
+    }
+    live = []
+    for n in xrange(nodes):
+        live.append({
+            'name': 'node{0}.example.com:60020'.format(n),
+            'startCode': 1394099998589, 'requests': 10,
+            'heapSizeMB': 2048, 'maxHeapSizeMB': 8192,
+            'Region': [dict(region, name='dGFibGUsa2V5{0:04d},{1}'.format(
+                r, n).encode('base64').strip()) for r in xrange(regions)],
+        })
+    return json.dumps({
+        'regions': nodes * regions, 'requests': 10, 'averageLoad': regions,
+        'DeadNodes': ['dead.example.com,60020,1394099998589'],
+        'LiveNodes': live,
+    })
+
+
+def deep_size(obj, seen=None):
+    """
+    Return the memory taken by the object and the objects it contains.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+class TestClusterStatusReader(BaseTestCase):
+
+    def test_chunks(self):
+        raw = load_data('HBaseCollector.json')
+        expected = ClusterStatus(raw)
+        for size in (1, 2, 3, 7, 64, len(raw)):
+            status = ClusterStatus(read_status(raw, size)[0])
+            self.assertEquals(status.requests, expected.requests)
+            self.assertEquals(status.regions, expected.regions)
+            self.assertEquals(status.average_load, expected.average_load)
+            self.assertEquals(status.dead_ids, expected.dead_ids)
+            self.assertEquals(
+                sorted(status.region_metrics), sorted(expected.region_metrics))
+            self.assertEquals(
+                status.nodes['localhost_44451']['heapSizeMB'], 26)
+            region = status.region_metrics.values()[0]
+            # Fields not used by the plugins are dropped.
+            self.assertEquals(region['readRequestsCount'], 9)
+            self.assertFalse('rootIndexSizeKB' in region)
+
+    def test_node_version(self):
+        # Live nodes 0.94.6 version.
+        raw = json.dumps({'LiveNodes': [{'Node': {
+            'name': 'localhost:44451', 'startCode': 1111, 'extra': [1, {}],
+            'Region': [{'name': 'a"{[}]\\', 'stores': 1, 'extra': 'x'}],
+        }}], 'DeadNodes': [], 'unused': {'a': [{'b': 'c'}]}})
+        result = read_status(raw, 5)[0]
+        self.assertEquals(result, {'LiveNodes': [{'Node': {
+            'name': 'localhost:44451', 'startCode': 1111,
+            'Region': [{'name': 'a"{[}]\\', 'stores': 1}],
+        }}], 'DeadNodes': []})
+        self.assertEquals(
+            ClusterStatus(result).nodes['localhost_44451']['startCode'], 1111)
+
+    def test_incomplete(self):
+        raw = load_data('HBaseCollector.json')
+        reader = ClusterStatusReader()
+        reader.feed(raw[:-10])
+        self.assertRaises(ValueError, reader.close)
+
+    def test_memory(self):
+        raw = large_status()
+        old = len(raw) + deep_size(json.loads(raw))
+        result, buffered = read_status(raw, 65536)
+        new = buffered + deep_size(result)
+        log.info(
+            'Peak memory for %s bytes status: json.loads %s bytes, '
+            'ClusterStatusReader %s bytes', len(raw), old, new)
+        self.assertEquals(
+            ClusterStatus(result).region_metrics.keys(),
+            ClusterStatus(raw).region_metrics.keys())
+        self.assertTrue(buffered < 2 * 65536)
+        self.assertTrue(new < old / 2)
+
+
+def table_page(regions=10000, compaction='MAJOR'):
+    """
+    Return a table.jsp page of a table with the number of regions.
+    """
+    page = load_data('HBaseTableEnabledStatus.txt')
+    rows = ''.join(
+        '<tr>\n  <td>test,key{0:08d},1394099998589.{0:032x}.</td>\n'
+        '  <td><a href="http://node{1}.example.com:60030/">'
+        'node{1}.example.com:60030</a></td>\n'
+        '  <td>key{0:08d}</td>\n  <td>key{2:08d}</td>\n'
+        '  <td>{0}</td>\n</tr>\n'.format(i, i % 50, i + 1)
+        for i in xrange(regions))
+    return page.replace(
+        '<td>Compaction</td>\n      <td>\n',
+        '<td>Compaction</td>\n      <td>{0}</td>\n'
+        '      <td>Is the table compacting</td>\n  </tr>\n</table>\n'
+        '<h2>Table Regions</h2>\n<table>\n'
+        '<tr><th>Name</th><th>Region Server</th><th>Start Key</th>'
+        '<th>End Key</th><th>Requests</th></tr>\n{1}</table>\n'.format(
+            compaction, rows))
+
+
+def read_page(page, size):
+    """
+    Feed the page to TableStateReader in chunks of the size until it is
+    done and return the result and the number of bytes read.
+    """
+    reader = TableStateReader()
+    read = 0
+    while read < len(page) and not reader.done:
+        reader.feed(page[read:read + size])
+        read += size
+    return reader.close(), min(read, len(page))
+
+
+class TestTableStateReader(BaseTestCase):
+
+    def test_pages(self):
+        for name, enabled in (('HBaseTableEnabledStatus.txt', 'true'),
+                              ('HBaseTableStatus.txt', 'false')):
+            page = load_data(name)
+            for size in (1, 5, 16, len(page)):
+                self.assertEquals(read_page(page, size)[0], {
+                    'enabled': enabled,
+                    'compaction': '',
+                })
+
+    def test_done(self):
+        page = table_page(regions=100)
+        state, read = read_page(page, 1024)
+        self.assertEquals(state, {'enabled': 'true', 'compaction': 'MAJOR'})
+        self.assertTrue(read < 4096)
+
+    def test_no_attributes(self):
+        reader = TableStateReader()
+        reader.feed('<html><body>Table not found</body></html>')
+        self.assertFalse(reader.done)
+        self.assertEquals(
+            reader.close(), {'enabled': '', 'compaction': ''})
+
+    def test_benchmark(self):
+        page = table_page()
+        # add_maps and get_events used to match the whole page three times.
+        start = time.time()
+        expected = {
+            'enabled': matcher(page, r'.+<td>Enabled</td><td>(\w+)</td>'),
+            'compaction': matcher(
+                page, r'.+<td>Compaction</td><td>(\w+)</td>'),
+        }
+        matcher(page, r'.+<td>Enabled</td><td>(\w+)</td>')
+        matcher_time = time.time() - start
+
+        start = time.time()
+        state, read = read_page(page, 65536)
+        reader_time = time.time() - start
+
+        # Timings depend on the machine load and are only logged.
+        log.info(
+            'Parsing %s bytes table.jsp page: matcher %.4fs, '
+            'TableStateReader %.4fs reading %s bytes',
+            len(page), matcher_time, reader_time, read)
+        self.assertEquals(state, expected)
+        # Only the first chunk of the page is parsed.
+        self.assertTrue(len(page) > 65536)
+        self.assertEquals(read, 65536)
+
+
+class TestRegionDigest(BaseTestCase):
+
+    def test_digest(self):
+        region_ids = ['region{0}'.format(i) for i in range(100)]
+        digest = region_digest(region_ids)
+        self.assertEquals(digest, region_digest(reversed(region_ids)))
+        self.assertEquals(region_digest([]), 0)
+        self.assertNotEquals(digest, region_digest(region_ids[1:]))
+        # Updated one region at a time.
+        self.assertEquals(
+            digest ^ region_digest(['region0']), region_digest(region_ids[1:]))
+        self.assertEquals(
+            region_digest(region_ids[1:]) ^ region_digest(['region0']), digest)
+
+
+def related_object(id_):
+    obj = Mock()
+    obj.id = id_
+    obj.primaryAq.return_value = obj
+    obj.getPrimaryId.return_value = '/zport/dmd/' + id_
+    return obj
+
+
+class TestRelationshipBatch(BaseTestCase):
+
+    def afterSetUp(self):
+        super(TestRelationshipBatch, self).afterSetUp()
+        self.objects = dict(
+            (id_, related_object(id_)) for id_ in ('a', 'b', 'c', 'd'))
+        self.catalog = Mock()
+        self.catalog.search.side_effect = lambda types, query: [
+            Mock(id=id_, getObject=Mock(return_value=self.objects[id_]))
+            for id_ in sorted(query.a[1]) if id_ in self.objects]
+
+    def apply(self, batch):
+        with patch('ZenPacks.zenoss.HBase.utils.ICatalogTool',
+                   Mock(return_value=self.catalog)), \
+                patch('ZenPacks.zenoss.HBase.utils.notify') as notify, \
+                patch('ZenPacks.zenoss.HBase.utils.transaction') as txn:
+            count = batch.apply()
+        return count, notify, txn
+
+    def test_apply(self):
+        to_many = [Mock(), Mock()]
+        to_many[0].objectValuesGen.return_value = [self.objects['a']]
+        to_many[1].objectValuesGen.return_value = []
+        to_one = Mock(return_value=self.objects['c'])
+        batch = RelationshipBatch(Mock(), 'HBaseTable', savepoint_size=2)
+        batch.to_many(to_many[0], ['b'])
+        batch.to_many(to_many[1], ['a', 'b', 'missing'])
+        batch.to_one(to_one, 'd')
+        # Already related.
+        batch.to_one(Mock(return_value=self.objects['c']), 'c')
+        count, notify, txn = self.apply(batch)
+
+        # A single catalog query for all the relationships.
+        self.assertEquals(self.catalog.search.call_count, 1)
+        to_many[0].removeRelation.assert_called_once_with(self.objects['a'])
+        to_many[0].addRelation.assert_called_once_with(self.objects['b'])
+        self.assertEquals(
+            sorted(c[0][0].id for c in to_many[1].addRelation.call_args_list),
+            ['a', 'b'])
+        to_one.removeRelation.assert_called_once_with()
+        to_one.addRelation.assert_called_once_with(self.objects['d'])
+        self.assertEquals(count, 6)
+        self.assertEquals(txn.savepoint.call_count, 3)
+        # Every changed object is indexed once.
+        self.assertEquals(notify.call_count, 4)
+        for obj in self.objects.values():
+            self.assertEquals(obj.index_object.call_count, 1)
+
+    def test_prepare(self):
+        prepare = Mock()
+        to_one = Mock(return_value=self.objects['c'])
+        batch = RelationshipBatch(Mock(), 'HBaseTable', prepare=prepare)
+        batch.to_one(to_one, 'd')
+        self.apply(batch)
+
+        # Only the objects whose relations are changed are prepared.
+        self.assertEquals(
+            [c[0][0] for c in prepare.call_args_list],
+            [self.objects['c'], self.objects['d']])
+
+    def test_nothing_to_do(self):
+        relationship = Mock()
+        relationship.objectValuesGen.return_value = [self.objects['a']]
+        batch = RelationshipBatch(Mock(), 'HBaseTable')
+        batch.to_many(relationship, ['a'])
+        batch.to_one(Mock(return_value=None), None)
+        count, notify, txn = self.apply(batch)
+        self.assertEquals(count, 0)
+        self.assertFalse(self.catalog.search.called)
+        self.assertFalse(notify.called)
+
+
+class TestConfWrapper(BaseTestCase):
+
+    def test_properties(self):
+        conf = ConfWrapper(load_data('HBaseRegionServerDump.txt'))
+        self.assertEquals(conf.handler_count, '10')
+        self.assertEquals(conf.memstore_upper_limit, '0.4')
+        self.assertEquals(conf.memstore_lower_limit, '0.35')
+        self.assertEquals(conf.memestore_flush_size, '134217728')
+        self.assertEquals(conf.max_file_size, '10737418240')
+        self.assertEquals(conf.get('hbase.zookeeper.quorum'), 'localhost')
+        self.assertEquals(conf.get('missing', 'default'), 'default')
+
+    def test_no_configuration(self):
+        conf = ConfWrapper('')
+        self.assertEquals(conf.handler_count, '')
+        self.assertEquals(conf.properties, {})
+
+    def test_benchmark(self):
+        dump = large_dump()
+        names = (
+            'hbase.regionserver.handler.count',
+            'hbase.regionserver.global.memstore.upperLimit',
+            'hbase.regionserver.global.memstore.lowerLimit',
+            'hbase.regionserver.optionallogflushinterval',
+            'hbase.hregion.memstore.flush.size',
+            'hbase.hregion.max.filesize',
+        )
+        start = time.time()
+        expected = legacy_conf(dump, names)
+        legacy_time = time.time() - start
+
+        start = time.time()
+        conf = ConfWrapper(dump)
+        parser_time = time.time() - start
+
+        # Timings depend on the machine load and are only logged.
+        log.info(
+            'Parsing %s bytes dump: regex %.4fs, single pass %.4fs',
+            len(dump), legacy_time, parser_time)
+        for name in names:
+            self.assertEquals(conf.get(name), expected[name])
+        self.assertEquals(conf.get('test.property.999'), '999')
+        # All the added properties are parsed.
+        base = ConfWrapper(load_data('HBaseRegionServerDump.txt'))
+        self.assertEquals(
+            len(conf.properties), len(base.properties) + 1000)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestClusterStatus))
+    suite.addTest(makeSuite(TestClusterStatusReader))
+    suite.addTest(makeSuite(TestTableStateReader))
+    suite.addTest(makeSuite(TestRegionDigest))
+    suite.addTest(makeSuite(TestRelationshipBatch))
+    suite.addTest(makeSuite(TestConfWrapper))
+    return suite
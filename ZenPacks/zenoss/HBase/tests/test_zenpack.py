@@ -0,0 +1,159 @@
+##############################################################################
+#
+# Copyright (C) Zenoss, Inc. 2014, all rights reserved.
+#
+# This content is made available according to terms specified in
+# License.zenoss under the directory where your Zenoss product is installed.
+#
+##############################################################################
+
+import logging
+log = logging.getLogger('zen.HBaseTest')
+
+from mock import Mock, patch
+
+from Acquisition import aq_base
+
+import transaction
+
+from Products.ZenModel.Device import Device
+from Products.ZenModel.ZenPack import ZenPackBase
+from Products.ZenTestCase.BaseTestCase import BaseTestCase
+
+import ZenPacks.zenoss.HBase as zenpack
+from ZenPacks.zenoss.HBase.HBaseHRegion import HBaseHRegion
+from ZenPacks.zenoss.HBase.HBaseRegionServer import HBaseRegionServer
+from ZenPacks.zenoss.HBase.HBaseTable import HBaseTable
+from ZenPacks.zenoss.HBase.tests.utils import add_obj
+
+
+class TestZenPack(BaseTestCase):
+
+    def afterSetUp(self):
+        super(TestZenPack, self).afterSetUp()
+        dc = self.dmd.Devices.createOrganizer('/Server')
+
+        # Device modeled with the region ids prefixed by the region
+        # server ids. Region r4 is already renamed and has a stale copy.
+        self.d = dc.createInstance('hbase.testDevice')
+        for server_id, region_ids in (
+                ('s0', ('s0(.)r1', 's0(.)r2', 's0(.)r4')),
+                ('s1', ('s1(.)r3', 'r4'))):
+            server = add_obj(
+                self.d.hbase_servers, HBaseRegionServer(server_id))
+            for region_id in region_ids:
+                add_obj(server.regions, HBaseHRegion(region_id))
+        for table_id in ('t0', 't1'):
+            add_obj(self.d.hbase_tables, HBaseTable(table_id))
+
+        # Device added before the ZenPack was installed.
+        relations = Device._relations
+        self.other = dc.createInstance('hbase.otherDevice')
+        with patch.object(Device, '_relations', tuple(
+                x for x in relations
+                if x[0] not in dict(zenpack.NEW_DEVICE_RELATIONS))):
+            self.other.buildRelations()
+
+        transaction.savepoint(optimistic=True)
+        self.pack = zenpack.ZenPack('ZenPacks.zenoss.HBase').__of__(self.dmd)
+
+    def run_step(self, step, *args, **kwargs):
+        """
+        Run the install or remove step with chunks of two changes, and
+        return the number of commits.
+        """
+        commit = kwargs.pop('commit', None) or Mock()
+        with patch('ZenPacks.zenoss.HBase.CHUNK_SIZE', 2), \
+                patch('ZenPacks.zenoss.HBase.transaction.commit', commit), \
+                patch.object(ZenPackBase, 'install'), \
+                patch.object(ZenPackBase, 'remove'), \
+                patch.object(Device, '_relations', Device._relations):
+            step(*args)
+        return commit.call_count
+
+    def regions(self):
+        return dict(
+            (server.id, sorted(server.regions.objectIds()))
+            for server in self.d.hbase_servers())
+
+    def test_install(self):
+        # Relations of one device, 4 renamed regions and 2 indexed
+        # region servers, in chunks of 2.
+        self.assertEquals(self.run_step(self.pack.install, self.app), 6)
+
+        self.assertTrue(hasattr(aq_base(self.other), 'hbase_servers'))
+        self.assertEquals(
+            self.regions(), {'s0': ['r1', 'r2'], 's1': ['r3', 'r4']})
+        self.assertEquals(
+            dict(self.d._hbase_region_index.items()),
+            {'r1': 's0', 'r2': 's0', 'r3': 's1', 'r4': 's1'})
+        # The performance data is not found on this host.
+        self.assertEquals(
+            self.d.hbase_servers._getOb('s0').regions._getOb('r1').rrdPath(),
+            'Devices/hbase.testDevice/hbase_servers/s0/regions/s0(.)r1')
+
+    def test_install_interrupted(self):
+        # Interrupted after the first chunk of renamed regions.
+        commit = Mock(side_effect=[None, Exception('interrupted')])
+        self.assertRaises(
+            Exception, self.run_step, self.pack.install, self.app,
+            commit=commit)
+
+        # Only the rest of the regions are renamed.
+        with patch.object(
+                zenpack.ZenPack, '_renameRegion',
+                wraps=self.pack._renameRegion) as rename:
+            self.run_step(self.pack.install, self.app)
+        self.assertEquals(rename.call_count, 2)
+        self.assertEquals(
+            self.regions(), {'s0': ['r1', 'r2'], 's1': ['r3', 'r4']})
+
+        # Nothing is left to do.
+        with patch.object(zenpack.ZenPack, '_renameRegion') as rename, \
+                patch.object(Device, 'buildRelations') as build:
+            self.run_step(self.pack.install, self.app)
+        self.assertFalse(rename.called)
+        self.assertFalse(build.called)
+
+    def test_remove(self):
+        self.run_step(self.pack.install, self.app)
+        self.d.setRegionTables({'r1': 't0', 'r3': 't0', 'r4': 't1'})
+
+        # The regions of each region server are removed in chunks before
+        # the region server, then the tables, then the relations of the
+        # devices.
+        self.assertEquals(self.run_step(self.pack.remove, self.app), 7)
+
+        self.assertFalse(hasattr(aq_base(self.d), 'hbase_servers'))
+        self.assertFalse(hasattr(aq_base(self.d), 'hbase_tables'))
+        self.assertFalse(hasattr(aq_base(self.d), '_hbase_region_index'))
+        self.assertFalse(hasattr(aq_base(self.other), 'hbase_servers'))
+
+        # Nothing is left to remove.
+        with patch.object(Device, 'buildRelations') as build:
+            self.assertEquals(self.run_step(self.pack.remove, self.app), 2)
+        self.assertFalse(build.called)
+
+    def test_remove_components(self):
+        self.run_step(self.pack.install, self.app)
+        server = self.d.hbase_servers._getOb('s0')
+        indexed = []
+        commit = Mock(side_effect=lambda: indexed.append(
+            hasattr(aq_base(self.d), '_hbase_region_index')))
+
+        # 4 regions, 2 region servers and 2 tables in chunks of 2.
+        self.assertEquals(self.run_step(
+            self.pack._removeComponents, self.app, commit=commit), 5)
+        # The region index is dropped rather than updated for every
+        # removed region.
+        self.assertEquals(indexed, [False] * 5)
+        self.assertEquals(server._region_digest, None)
+        self.assertEquals(self.d.hbase_servers(), [])
+        self.assertEquals(self.d.hbase_tables(), [])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestZenPack))
+    return suite
@@ -7,15 +7,19 @@
 #
 ##############################################################################
 
+import hashlib
 import json
 import os
 import re
 
+import transaction
+
 from base64 import encodestring
+from xml.sax.saxutils import unescape
 from OpenSSL.SSL import Error as SSLError
 from zope.event import notify
 
-from Products.AdvancedQuery import Eq, Or
+from Products.AdvancedQuery import In
 from Products.ZenUtils.Utils import prepId, readable_time
 from Products.Zuul.interfaces import ICatalogTool
 from Products.Zuul.catalog.events import IndexingEvent
@@ -30,6 +34,13 @@ class HBaseException(Exception):
     pass
 
 
+class HostUnavailable(HBaseException):
+    """
+    Raised instead of requesting a host which is known to be down.
+    """
+    pass
+
+
 def here(dir, base=os.path.dirname(__file__)):
     return os.path.join(base, dir)
 
@@ -47,42 +58,142 @@ def add_local_lib_path():
 add_local_lib_path()
 
 
-def updateToMany(relationship, root, type_, ids):
-    '''
-    Update ToMany relationship given search root, type and ids.
-
-    This is a general-purpose function for efficiently building
-    non-containing ToMany relationships.
-    '''
-    root = root.primaryAq()
+class RelationshipBatch(object):
+    """
+    Batch of updates of non-containing relationships to objects of one
+    type. All the objects to add or remove are found with a single
+    catalog query, a savepoint is made after every savepoint_size
+    changes, and each changed object is indexed once at the end.
+    """
 
-    new_ids = set(map(prepId, ids))
-    current_ids = set(o.id for o in relationship.objectValuesGen())
-    changed_ids = new_ids.symmetric_difference(current_ids)
+    def __init__(self, root, type_, savepoint_size=1000, prepare=None):
+        """
+        @param root: search root
+        @type root: ZenModelRM
+        @param type_: class of the related objects
+        @type type_: str
+        @param savepoint_size: number of changes between savepoints
+        @type savepoint_size: int
+        @param prepare: callable called with each related object before
+            its relationship is changed
+        @type prepare: callable
+        """
+        self.root = root
+        self.type_ = type_
+        self.savepoint_size = savepoint_size
+        self.prepare = prepare
+        # (relationship, ids to add, objects to remove)
+        self._to_many = []
+        # (relationship, id to add or None, object to remove or None)
+        self._to_one = []
+
+    def to_many(self, relationship, ids):
+        """
+        Queue the update of a ToMany relationship to the objects with
+        the given ids.
+        """
+        new_ids = set(map(prepId, ids))
+        current = dict((o.id, o) for o in relationship.objectValuesGen())
+        self._to_many.append((
+            relationship,
+            new_ids.difference(current),
+            [o for id_, o in current.items() if id_ not in new_ids],
+        ))
+
+    def to_one(self, relationship, id_):
+        """
+        Queue the update of a ToOne relationship to the object with the
+        given id, or its removal if the id is empty.
+        """
+        old_obj = relationship()
+        # No action if the relationship is already correct.
+        if (old_obj and old_obj.id == id_) or (not old_obj and not id_):
+            return
+        self._to_one.append((relationship, id_ or None, old_obj))
 
-    query = Or(*(Eq('id', x) for x in changed_ids))
+    def apply(self):
+        """
+        Apply the queued updates.
 
-    obj_map = {}
-    for result in ICatalogTool(root).search(types=[type_], query=query):
-        obj_map[result.id] = result.getObject()
+        @return: number of changed relations
+        @rtype: int
+        """
+        ids = set()
+        for relationship, add_ids, remove in self._to_many:
+            ids.update(add_ids)
+        for relationship, id_, old_obj in self._to_one:
+            if id_:
+                ids.add(id_)
+
+        obj_map = {}
+        if ids:
+            results = ICatalogTool(self.root.primaryAq()).search(
+                types=[self.type_], query=In('id', list(ids)))
+            for result in results:
+                obj_map[result.id] = result.getObject()
+
+        # Primary path -> changed remote object.
+        changed = {}
+        count = 0
+        for relationship, add_ids, remove in self._to_many:
+            for obj in remove:
+                self._prepare(obj)
+                relationship.removeRelation(obj)
+                count = self._changed(changed, obj, count)
+            for id_ in add_ids:
+                obj = obj_map.get(id_)
+                if obj:
+                    self._prepare(obj)
+                    relationship.addRelation(obj)
+                    count = self._changed(changed, obj, count)
+        for relationship, id_, old_obj in self._to_one:
+            if old_obj:
+                self._prepare(old_obj)
+                relationship.removeRelation()
+                count = self._changed(changed, old_obj, count)
+            obj = obj_map.get(id_)
+            if obj:
+                self._prepare(obj)
+                relationship.addRelation(obj)
+                count = self._changed(changed, obj, count)
+
+        for obj in changed.itervalues():
+            # Index remote object. It might have a custom path reporter.
+            notify(IndexingEvent(obj, 'path', False))
+
+            # For componentSearch. Would be nice if we could target
+            # idxs=['getAllPaths'], but there's a chance that it won't
+            # exist yet.
+            obj.index_object()
+
+        self._to_many = []
+        self._to_one = []
+        return count
+
+    def _prepare(self, obj):
+        if self.prepare is not None:
+            self.prepare(obj)
+
+    def _changed(self, changed, obj, count):
+        obj = obj.primaryAq()
+        changed[obj.getPrimaryId()] = obj
+        count += 1
+        if count % self.savepoint_size == 0:
+            transaction.savepoint(optimistic=True)
+        return count
 
-    for id_ in new_ids.symmetric_difference(current_ids):
-        obj = obj_map.get(id_)
-        if not obj:
-            continue
 
-        if id_ in new_ids:
-            relationship.addRelation(obj)
-        else:
-            relationship.removeRelation(obj)
-
-        # Index remote object. It might have a custom path reporter.
-        notify(IndexingEvent(obj, 'path', False))
+def updateToMany(relationship, root, type_, ids):
+    '''
+    Update ToMany relationship given search root, type and ids.
 
-        # For componentSearch. Would be nice if we could target
-        # idxs=['getAllPaths'], but there's a chance that it won't exist
-        # yet.
-        obj.index_object()
+    This is a general-purpose function for efficiently building
+    non-containing ToMany relationships. Use RelationshipBatch to
+    update many relationships at once.
+    '''
+    batch = RelationshipBatch(root, type_)
+    batch.to_many(relationship, ids)
+    batch.apply()
 
 
 def updateToOne(relationship, root, type_, id_):
@@ -90,41 +201,12 @@ def updateToOne(relationship, root, type_, id_):
     Update ToOne relationship given search root, type and ids.
 
     This is a general-purpose function for efficiently building
-    non-containing ToOne relationships.
+    non-containing ToOne relationships. Use RelationshipBatch to
+    update many relationships at once.
     '''
-    old_obj = relationship()
-
-    # Return with no action if the relationship is already correct.
-    if (old_obj and old_obj.id == id_) or (not old_obj and not id_):
-        return
-    # Remove current object from relationship.
-    if old_obj:
-        relationship.removeRelation()
-
-        # Index old object. It might have a custom path reporter.
-        notify(IndexingEvent(old_obj.primaryAq(), 'path', False))
-
-    # No need to find new object if id_ is empty.
-    if not id_:
-        return
-
-    # Find and add new object to relationship.
-    root = root.primaryAq()
-    query = Eq('id', id_)
-
-    for result in ICatalogTool(root).search(types=[type_], query=query):
-        new_obj = result.getObject()
-        relationship.addRelation(new_obj)
-
-        # Index remote object. It might have a custom path reporter.
-        notify(IndexingEvent(new_obj.primaryAq(), 'path', False))
-
-        # For componentSearch. Would be nice if we could target
-        # idxs=['getAllPaths'], but there's a chance that it won't exist
-        # yet.
-        new_obj.index_object()
-
-    return
+    batch = RelationshipBatch(root, type_)
+    batch.to_one(relationship, id_)
+    batch.apply()
 
 # HBase default ports.
 MASTER_INFO_PORT = '60010'
@@ -183,6 +265,22 @@ def version_diff(nodes):
     return common_nodes
 
 
+def region_digest(region_ids):
+    """
+    Return the digest of a set of region ids. It is the XOR of the md5
+    digests of the ids, so it does not depend on their order and can be
+    updated one region at a time.
+
+    @param region_ids: region component ids
+    @type region_ids: iterable
+    @return: long
+    """
+    digest = 0
+    for region_id in region_ids:
+        digest ^= long(hashlib.md5(region_id).hexdigest(), 16)
+    return digest
+
+
 def dead_node_name(node):
     """
     Parses the dead server name in format of 'domain,port,startcode'
@@ -231,7 +329,7 @@ def matcher(res, rule, default=''):
     """
     Return the value in the first group or empty string if no match found.
 
-    @param res: result of getPage query
+    @param res: result of fetch query
     @type res: str
     @param rule: regular expression for value matching
     @type rule: str
@@ -244,6 +342,90 @@ def matcher(res, rule, default=''):
     return default
 
 
+# Name and value of a property in the Hadoop configuration XML.
+PROPERTY_RULE = re.compile(
+    r'<name>\s*([^<]*?)\s*</name>\s*<value>\s*([^<]*?)\s*</value>'
+)
+
+
+def parse_configuration(dump):
+    """
+    Return a dictionary of the properties in the <configuration> block
+    of the region server or master '/dump' page. The page is scanned
+    once and the last value wins if a property is repeated.
+
+    @param dump: result of fetch query
+    @type dump: str
+    @return: dict of property name to value
+    """
+    start = dump.find('<configuration>')
+    if start == -1:
+        return {}
+    end = dump.find('</configuration>', start)
+    if end == -1:
+        end = len(dump)
+    return dict(
+        (name, unescape(value))
+        for name, value in PROPERTY_RULE.findall(dump, start, end)
+    )
+
+
+TABLE_ATTRIBUTES = 'Table Attributes'
+TABLE_ATTRIBUTE = re.compile(
+    r'<td>\s*(Enabled|Compaction)\s*</td>\s*<td>\s*(\w+)\s*</td>')
+
+
+class TableStateReader(object):
+    """
+    Incremental parser of the master's table.jsp page. The table
+    attributes section comes before the list of the table regions, so
+    the reader is done as soon as the section is received, and the rest
+    of the page does not need to be parsed.
+    """
+
+    def __init__(self):
+        self.done = False
+        self._buffer = ''
+        # Position of the table attributes section in the buffer.
+        self._start = -1
+
+    def feed(self, data):
+        """
+        Add the next chunk of the page.
+
+        @param data: a chunk of the page
+        @type data: str
+        """
+        if self.done:
+            return
+        searched = len(self._buffer)
+        self._buffer += data
+        if self._start < 0:
+            self._start = self._buffer.find(
+                TABLE_ATTRIBUTES, max(0, searched - len(TABLE_ATTRIBUTES)))
+            if self._start < 0:
+                return
+            searched = self._start
+        self.done = self._buffer.find(
+            '</table>', max(self._start, searched - len('</table>'))) >= 0
+
+    def close(self):
+        """
+        Return the table state, with empty values for the attributes
+        not found in the page.
+
+        @return: dict with 'enabled' and 'compaction'
+        """
+        buf, self._buffer = self._buffer, ''
+        if self._start >= 0:
+            end = buf.find('</table>', self._start)
+            buf = buf[self._start:end if end >= 0 else len(buf)]
+        state = {'enabled': '', 'compaction': ''}
+        for name, value in TABLE_ATTRIBUTE.findall(buf):
+            state[name.lower()] = value
+        return state
+
+
 class ConfWrapper(object):
     """
     Wrapper for region server configuration properties.
@@ -252,44 +434,272 @@ class ConfWrapper(object):
         """
         Match the needed properties to their values.
 
-        @param dump: result of getPage query
+        @param dump: result of fetch query
         @type dump: str
         """
-        self.conf = matcher(dump, r'.+<configuration>(.+)</configuration>')
-        self.handler_count = matcher(self.conf, self.rule(
+        self.properties = parse_configuration(dump)
+        self.handler_count = self.get(
             'hbase.regionserver.handler.count'
-        ))  # Defaults to 10.
-        self.memstore_upper_limit = matcher(self.conf, self.rule(
+        )  # Defaults to 10.
+        self.memstore_upper_limit = self.get(
             'hbase.regionserver.global.memstore.upperLimit'
-        ))  # Defaults to 0.4.
-        self.memstore_lower_limit = matcher(self.conf, self.rule(
+        )  # Defaults to 0.4.
+        self.memstore_lower_limit = self.get(
             'hbase.regionserver.global.memstore.lowerLimit'
-        ))  # Defaults to 0.35.
+        )  # Defaults to 0.35.
         self.logflush_interval = self.logflush_interval()  # Defaults to 10000.
-        self.memestore_flush_size = matcher(self.conf, self.rule(
+        self.memestore_flush_size = self.get(
             'hbase.hregion.memstore.flush.size'
-        ))  # Defaults to 134217728.
-        self.max_file_size = matcher(self.conf, self.rule(
+        )  # Defaults to 134217728.
+        self.max_file_size = self.get(
             'hbase.hregion.max.filesize'
-        ))  # Defaults to 10737418240.
+        )  # Defaults to 10737418240.
 
-    def rule(self, property_name):
+    def get(self, property_name, default=''):
         """
-        Construct a regex rule for the specified property.
+        Return the value of the specified property.
 
         @param property_name: the name of the property to be found
         @type property_name: str
-        @return: regex rule of string
+        @param default: value to return if the property is not set
+        @type default: str
+        @return: string value
         """
-        return r'.+<name>{}</name><value>(.+?)</value>'.format(property_name)
+        return self.properties.get(property_name) or default
 
     def logflush_interval(self):
         """
         Return log flush interval value in readable format.
         In case no value was matched, return None.
         """
-        ms = matcher(self.conf, self.rule(
-            'hbase.regionserver.optionallogflushinterval'
-        ), 1000)  # Set to default if not set in conf file.
+        ms = self.get(
+            'hbase.regionserver.optionallogflushinterval', 1000
+        )  # Set to default if not set in conf file.
         if ms:
             return readable_time(int(ms) / 1000, 2)
+
+
+class ClusterStatus(object):
+    """
+    Parsed view of the REST gateway '/status/cluster' output with
+    the nodes and regions indexed by their component ids.
+    """
+    def __init__(self, status):
+        """
+        Parse the status and build the indexes.
+
+        @param status: result of fetch query, either the raw response
+            or the fields collected by ClusterStatusReader
+        @type status: str or dict
+        """
+        if isinstance(status, basestring):
+            status = json.loads(status) if status else None
+        data = status or {}
+        self._loaded = bool(data)
+        self.requests = data.get('requests')
+        self.regions = data.get('regions')
+        self.average_load = data.get('averageLoad')
+        self.live = version_diff(data.get('LiveNodes', []))
+        self.dead = version_diff(data.get('DeadNodes', []))
+
+        # Region server id -> live node.
+        self.nodes = {}
+        # Region id -> region metrics.
+        self.region_metrics = {}
+        for node in self.live:
+            node_id = prepId(node['name'])
+            self.nodes[node_id] = node
+            for region in node['Region']:
+                self.region_metrics[prepId(region['name'])] = region
+        # Ids of dead region servers.
+        self.dead_ids = set(
+            prepId(dead_node_name(node)[0]) for node in self.dead
+        )
+        # Changes when a region server or a region is added or removed.
+        self.fingerprint = hash(
+            frozenset(self.region_metrics).union(self.nodes, self.dead_ids))
+
+    def __nonzero__(self):
+        return self._loaded
+
+
+# Fields of the '/status/cluster' output used by the plugins. None stands
+# for a value kept as is, a dict for an object (or a list of objects)
+# of which only the listed fields are kept.
+REGION_FIELDS = dict.fromkeys((
+    'name', 'stores', 'storefiles', 'storefileSizeMB',
+    'storefileIndexSizeMB', 'memstoreSizeMB', 'readRequestsCount',
+    'writeRequestsCount', 'currentCompactedKVs', 'totalCompactingKVs',
+))
+NODE_FIELDS = dict.fromkeys((
+    'name', 'startCode', 'requests', 'heapSizeMB', 'maxHeapSizeMB',
+))
+NODE_FIELDS['Region'] = REGION_FIELDS
+# Live nodes 0.94.6 version.
+NODE_FIELDS['Node'] = NODE_FIELDS
+STATUS_FIELDS = {
+    'requests': None,
+    'regions': None,
+    'averageLoad': None,
+    'DeadNodes': None,
+    'LiveNodes': NODE_FIELDS,
+}
+
+JSON_SPACE = re.compile(r'[\s,:]*')
+JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+# Numbers, true, false and null, validated by json.loads.
+JSON_SCALAR = re.compile(r'[^\s,:{}\[\]"]+')
+# The longest prefix of an object without nested objects or arrays.
+JSON_FLAT_OBJECT = re.compile(
+    r'\{(?:[^{}\[\]"]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+
+
+class ClusterStatusReader(object):
+    """
+    Incremental parser of the '/status/cluster' output. The response is
+    fed in chunks as it is received and only the fields listed in
+    STATUS_FIELDS are kept, so neither the whole response nor its fully
+    decoded form has to be held in memory. Objects without nested
+    containers, i.e. the regions making up most of the output, are
+    decoded with json.loads at once.
+    """
+
+    def __init__(self, fields=STATUS_FIELDS):
+        self.fields = fields
+        self.result = None
+        self._buffer = ''
+        # Open containers: [container, is object, fields, pending key],
+        # the container is None for the skipped ones.
+        self._stack = []
+
+    def feed(self, data):
+        """
+        Parse the next chunk of the response.
+
+        @param data: a chunk of the response
+        @type data: str
+        """
+        self._buffer += data
+        self._buffer = self._buffer[self._parse(self._buffer, False):]
+
+    def close(self):
+        """
+        Parse the rest of the response and return the collected fields.
+
+        @return: dict
+        """
+        buf, self._buffer = self._buffer, ''
+        if buf[self._parse(buf, True):].strip() or self._stack:
+            raise ValueError('Incomplete cluster status')
+        return self.result
+
+    def _parse(self, buf, final):
+        """
+        Parse the buffer up to the last complete token and return
+        the position to continue from.
+        """
+        stack = self._stack
+        end = len(buf)
+        pos = 0
+        while True:
+            pos = JSON_SPACE.match(buf, pos).end()
+            if pos == end:
+                return pos
+            char = buf[pos]
+            if char in '}]':
+                if not stack:
+                    raise ValueError('Unexpected {0!r}'.format(char))
+                self._add(stack.pop()[0])
+                pos += 1
+                continue
+
+            frame = stack[-1] if stack else None
+            if frame and frame[1] and frame[3] is None:
+                # Object key.
+                match = JSON_STRING.match(buf, pos)
+                if not match:
+                    if char != '"':
+                        raise ValueError('Expected key at {0!r}'.format(
+                            buf[pos:pos + 20]))
+                    return pos
+                # Keys of the skipped objects are not decoded.
+                frame[3] = frame[0] is None or self._string(match.group())
+                pos = match.end()
+                continue
+
+            keep, fields = self._fields(frame)
+            if char == '{':
+                match = JSON_FLAT_OBJECT.match(buf, pos)
+                if match.end() == end or buf[match.end()] == '"':
+                    # The object or one of its strings is not complete.
+                    return pos
+                if buf[match.end()] == '}':
+                    value = None
+                    if keep:
+                        value = json.loads(buf[pos:match.end() + 1])
+                        if fields is not None:
+                            # Field names are shared by all the objects.
+                            value = dict(
+                                (k, value[k]) for k in fields if k in value)
+                    self._add(value)
+                    pos = match.end() + 1
+                else:
+                    stack.append([{} if keep else None, True, fields, None])
+                    pos += 1
+            elif char == '[':
+                stack.append([[] if keep else None, False, fields, None])
+                pos += 1
+            elif char == '"':
+                match = JSON_STRING.match(buf, pos)
+                if not match:
+                    return pos
+                self._add(self._string(match.group()) if keep else None)
+                pos = match.end()
+            else:
+                match = JSON_SCALAR.match(buf, pos)
+                if match.end() == end and not final:
+                    # The number may continue in the next chunk.
+                    return pos
+                self._add(json.loads(match.group()) if keep else None)
+                pos = match.end()
+
+    def _fields(self, frame):
+        """
+        Return whether the next value in the container is kept and
+        which of its fields.
+        """
+        if frame is None:
+            return True, self.fields
+        container, is_object, fields, key = frame
+        if container is None:
+            return False, None
+        if not is_object:
+            # The fields apply to the list items.
+            return True, fields
+        if fields is None:
+            return True, None
+        if key in fields:
+            return True, fields[key]
+        return False, None
+
+    def _add(self, value):
+        """
+        Add the parsed value to the current container.
+        """
+        if not self._stack:
+            self.result = value
+            return
+        frame = self._stack[-1]
+        if frame[0] is None:
+            pass
+        elif not frame[1]:
+            frame[0].append(value)
+        elif frame[2] is None or frame[3] in frame[2]:
+            frame[0][frame[3]] = value
+        frame[3] = None
+
+    @staticmethod
+    def _string(token):
+        if '\\' in token:
+            return json.loads(token)
+        return token[1:-1].decode('utf-8')